@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+'''
+asyncio interface to the database. The blocking database calls are run in a
+bounded thread pool so that disk I/O never blocks the event loop, every
+method returns an awaitable future.
+
+On python 2 the trollius backport of asyncio and the futures backport of
+concurrent.futures are used
+'''
+# Import python libs
+import functools
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+import concurrent.futures
+
+# Import sorbic libs
+import sorbic.db
+
+
+class AsyncDB(object):
+    '''
+    Wrap a DB for use from asyncio. Reads and writes run on a pool of
+    max_workers threads, compaction runs on its own thread so that it can
+    not take up the pool. Concurrent gets of the same key share a single
+    read, so the returned documents are shared and must not be modified.
+    The futures are made on the given loop, by default the event loop of
+    the thread which made the AsyncDB
+    '''
+    def __init__(self, root=None, max_workers=4, db=None, loop=None, **kwargs):
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.db = db if db is not None else sorbic.db.DB(root, **kwargs)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.compact_executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._gets = {}
+
+    def _run(self, func, *args, **kwargs):
+        '''
+        Run the blocking function in the thread pool
+        '''
+        return self.loop.run_in_executor(
+            self.executor,
+            functools.partial(func, *args, **kwargs))
+
+    def _forget_gets(self, key=None):
+        '''
+        Stop sharing the gets in flight for the key, or for every key, so
+        that gets made after a write do not see a read from before it
+        '''
+        for g_key in list(self._gets):
+            if key is None or g_key[0] == key:
+                self._gets.pop(g_key)
+
+    def get(self, key, id_=None, meta=False, **kwargs):
+        '''
+        Retrive a data entry, gets for the same key and id which are already
+        in flight are joined
+        '''
+        if kwargs:
+            return self._run(self.db.get, key, id_, meta, **kwargs)
+        g_key = (key, id_, meta)
+        fut = self._gets.get(g_key)
+        if fut is None:
+            fut = self._run(self.db.get, key, id_, meta)
+            self._gets[g_key] = fut
+
+            def done(_):
+                if self._gets.get(g_key) is fut:
+                    self._gets.pop(g_key)
+            fut.add_done_callback(done)
+        # A cancelled caller must not cancel the read for the others
+        return asyncio.shield(fut)
+
+    def get_many(self, keys, meta=False, **kwargs):
+        '''
+        Retrive the newest data entry for many keys at once
+        '''
+        return self._run(self.db.get_many, list(keys), meta, **kwargs)
+
+    def insert(self, key, data, id_=None, type_='doc', serial=None, **kwargs):
+        '''
+        Insert a key into the database
+        '''
+        self._forget_gets(key)
+        return self._run(
+            self.db.insert, key, data, id_, type_, serial, **kwargs)
+
+    def insert_many(self, items, type_='doc', serial=None, **kwargs):
+        '''
+        Insert many keys into the database at once
+        '''
+        if isinstance(items, dict):
+            items = items.items()
+        items = list(items)
+        for key, _ in items:
+            self._forget_gets(key)
+        return self._run(self.db.insert_many, items, type_, serial, **kwargs)
+
+    def rm(self, key, id_=None, **kwargs):
+        '''
+        Remove a key or a single id of the key
+        '''
+        self._forget_gets(key)
+        return self._run(self.db.rm, key, id_, **kwargs)
+
+    def listdir(self, d_key):
+        '''
+        List the contents of a directory
+        '''
+        return self._run(self.db.listdir, d_key)
+
+    def compress(self, d_key=None, num=None, progress=None):
+        '''
+        Compress a table on the compaction thread, the event loop keeps
+        running while the table is rewritten
+        '''
+        self._forget_gets()
+        return self.loop.run_in_executor(
+            self.compact_executor,
+            functools.partial(self.db.compress, d_key, num, progress))
+
+    def close(self):
+        '''
+        Wait for the running calls, then close the database and the thread
+        pools
+        '''
+        def close():
+            self.compact_executor.shutdown()
+            self.db.close()
+        fut = self._run(close)
+        fut.add_done_callback(lambda _: self.executor.shutdown(wait=False))
+        return fut
@@ -4,14 +4,25 @@ Interface to interact on a database level
 # Import python libs
 import os
 import io
-import shutil
+import logging
+import functools
+import itertools
+import threading
 # Import sorbic libs
 import sorbic.ind.hdht
+import sorbic.stor.wal
+import sorbic.stor.codec
 import sorbic.stor.files
+import sorbic.utils.lru
+import sorbic.utils.rand
+import sorbic.utils.rwlock
+import sorbic.utils.dirlock
 import sorbic.utils.traverse
 # Import third party libs
 import msgpack
 
+log = logging.getLogger(__name__)
+
 DB_OPTS = (
         'key_delim',
         'hash_limit',
@@ -19,12 +30,85 @@ DB_OPTS = (
         'fmt',
         'fmt_map',
         'header_len',
-        'serial')
+        'serial',
+        'probe',
+        'probe_limit',
+        'data_logs',
+        'segment_size',
+        'bloom')
+# Number of keys read from the key index at a time by iter_keys
+KEY_BATCH = 256
+# Number of keys written during a background resize which are copied into
+# the new tables before the lock is handed over
+RECOPY_BATCH = 256
+# Number of buckets a background resize copies before the lock is handed
+# over
+RESIZE_STEP = 64
+
+
+def _reads(func):
+    '''
+    Run the method under the read side of the database lock
+    '''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        self.lock.acquire_read()
+        mark = self._dir_mark()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self._dir_release(mark)
+            self.lock.release_read()
+    return wrapper
+
+
+def _writes(func):
+    '''
+    Run the method under the write side of the database lock. Readers in
+    this process flush the tables they read on demand, with multiprocess
+    the buffered writes and headers are flushed before the directory locks
+    are released so that other processes see them
+    '''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        self.lock.acquire_write()
+        mark = self._dir_mark()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            if self.dir_locks is not None:
+                self.index.flush(True)
+            self._dir_release(mark)
+            self.lock.release_write()
+    return wrapper
+
+
+def _rebuilds(func):
+    '''
+    Run the method under the write side of the database lock once the
+    background resize has finished, for the methods which replace or remove
+    tables
+    '''
+    func = _writes(func)
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._resize_lock:
+            return func(self, *args, **kwargs)
+    return wrapper
 
 
 class DB(object):
     '''
-    Databaseing
+    Databaseing, a DB can be shared by threads. Reads run concurrently and
+    writes are made by one thread at a time. With multiprocess the key
+    directories are also locked between processes, the DB is then safe to
+    open from many processes at once
+
+    The rev field of the bucket fmt limits the revisions of a key, the
+    default 32 bit field holds 2**32 revisions. Databases created with the
+    older '>KsQH' format keep it and hold 65536 revisions of a key, an
+    insert past the limit raises a ValueError
     '''
     def __init__(
             self,
@@ -32,10 +116,32 @@ class DB(object):
             key_delim='/',
             hash_limit=0xfffff,
             key_hash='sha1',
-            fmt='>KsQH',
+            fmt='>KsQI',
             fmt_map=None,
             header_len=1024,
-            serial='msgpack'):
+            serial='msgpack',
+            probe=None,
+            probe_limit=16,
+            data_logs=False,
+            segment_size=0x4000000,
+            bloom=False,
+            codec=None,
+            codec_min=sorbic.stor.codec.CODEC_MIN,
+            mmap_tables=False,
+            max_open_tables=None,
+            cache_entries=0,
+            cache_bytes=0,
+            resize_load=None,
+            wal=False,
+            wal_sync='batch',
+            wal_sync_ms=10,
+            wal_sync_writes=64,
+            wal_size=0x1000000,
+            multiprocess=False):
+        if wal and multiprocess:
+            raise ValueError(
+                'The write ahead log can not be shared by processes')
+        sorbic.stor.codec.check(codec)
         self.root = root
         self.key_delim = key_delim
         self.hash_limit = hash_limit
@@ -44,6 +150,24 @@ class DB(object):
         self.fmt_map = fmt_map
         self.header_len = header_len
         self.serial = serial
+        self.probe = probe
+        self.probe_limit = probe_limit
+        self.data_logs = data_logs
+        self.segment_size = segment_size
+        self.bloom = bloom
+        self.codec = codec
+        self.codec_min = codec_min
+        self.lock = sorbic.utils.rwlock.RWLock()
+        # Held by the background resize and the methods which replace tables,
+        # the resize is only started once the database is open
+        self._resize_lock = threading.RLock()
+        self._resizer = None
+        self._resizing = None
+        self._bg_resize = False
+        self.dir_locks = None
+        if multiprocess:
+            self.dir_locks = sorbic.utils.dirlock.DirLocks(
+                on_stale=self._dir_stale)
         self._get_db_meta()
         self.index = sorbic.ind.hdht.HDHT(
             self.root,
@@ -52,16 +176,48 @@ class DB(object):
             self.key_hash,
             self.fmt,
             self.fmt_map,
-            self.header_len)
+            self.header_len,
+            mmap_tables=mmap_tables,
+            max_open_tables=max_open_tables,
+            probe=self.probe,
+            probe_limit=self.probe_limit,
+            resize_load=resize_load,
+            data_logs=self.data_logs,
+            segment_size=self.segment_size,
+            bloom=self.bloom,
+            codec=self.codec,
+            codec_min=self.codec_min)
         self.write_stor_funcs = self.__gen_write_stor_funcs()
         self.read_stor_funcs = self.__gen_read_stor_funcs()
+        self.copy_stor_funcs = self.__gen_copy_stor_funcs()
+        self.release_stor_funcs = self.__gen_release_stor_funcs()
+        self.open_stor_funcs = self.__gen_open_stor_funcs()
+        self.doc_cache = None
+        self._cache_keys = {}
+        self._cache_lock = threading.Lock()
+        if cache_entries or cache_bytes:
+            self.doc_cache = sorbic.utils.lru.LRU(
+                max_entries=cache_entries or None,
+                max_size=cache_bytes or None,
+                on_evict=self._cache_evict)
+        self.wal = None
+        self.wal_size = wal_size
+        self._wal_timer = None
+        self._open_wal(wal, wal_sync, wal_sync_ms, wal_sync_writes)
+        # The writes of other processes can not be noted during a background
+        # build, with multiprocess the write which passes the load resizes
+        self._bg_resize = not multiprocess
 
     def __gen_write_stor_funcs(self):
         '''
         Return the storage write functions dict mapping to types
         '''
         return {'doc': self.index.write_doc_stor,
-                'file': sorbic.stor.files.write}
+                'file': functools.partial(
+                    sorbic.stor.files.write,
+                    codec=self.codec,
+                    codec_min=self.codec_min,
+                    journal=self._journal_ref)}
 
     def __gen_read_stor_funcs(self):
         '''
@@ -70,6 +226,30 @@ class DB(object):
         return {'doc': self.index.read_doc_stor,
                 'file': sorbic.stor.files.read}
 
+    def __gen_copy_stor_funcs(self):
+        '''
+        Return the storage copy functions dict mapping to types, these are
+        used to move stored data to a new table without deserializing it
+        '''
+        return {'doc': self.index.copy_doc_stor,
+                'file': sorbic.stor.files.copy}
+
+    def __gen_release_stor_funcs(self):
+        '''
+        Return the storage release functions dict mapping to types, these
+        are called once the stored data of a revision is no longer used.
+        Documents live in the tables and are reclaimed by compaction
+        '''
+        return {'file': sorbic.stor.files.release}
+
+    def __gen_open_stor_funcs(self):
+        '''
+        Return the storage open functions dict mapping to types, these
+        return a descriptor backed handle of the stored bytes
+        '''
+        return {'doc': self.index.open_doc_stor,
+                'file': sorbic.stor.files.open_blob}
+
     def _get_db_meta(self):
         '''
         Read in the database metadata to preserve the original behavior
@@ -80,13 +260,320 @@ class DB(object):
         if os.path.isfile(db_meta):
             with io.open(db_meta, 'rb') as fp_:
                 meta = msgpack.loads(fp_.read())
+        old_meta = dict(meta)
         for entry in DB_OPTS:
             meta[entry] = meta.get(entry, getattr(self, entry))
             setattr(self, entry, meta[entry])
+        if meta == old_meta:
+            return
         if not os.path.isdir(self.root):
             os.makedirs(self.root)
-        with io.open(db_meta, 'w+b') as fp_:
+        # Write and rename so other processes never read a partial file
+        tmp_meta = '{0}.{1}'.format(db_meta, os.getpid())
+        with io.open(tmp_meta, 'w+b') as fp_:
             fp_.write(msgpack.dumps(meta))
+        os.rename(tmp_meta, db_meta)
+
+    def _open_wal(self, wal, sync, sync_ms, sync_writes):
+        '''
+        Replay the write ahead log left by an unclean shutdown and open the
+        log if it is enabled
+        '''
+        log = sorbic.stor.wal.WAL(
+            os.path.join(self.root, 'sorbic_wal.log'),
+            sync,
+            sync_ms,
+            sync_writes)
+        records = list(log.records())
+        if records:
+            self._replay_wal(records)
+        if not wal:
+            if os.path.isfile(log.path):
+                os.remove(log.path)
+            return
+        log.open()
+        self.wal = log
+        self.index.journal = self._journal
+        if sync != 'none':
+            # A bucket write handed to the os can reach the disk before the
+            # record of its old contents, so it waits for the next fsync
+            self.index.held = {}
+        if records:
+            self._checkpoint()
+
+    def _replay_wal(self, records):
+        '''
+        Restore the logged buckets in reverse order, which returns them to
+        their state at the last checkpoint, then apply the logged writes
+        again with their original ids. The file blob reference counts are
+        restored as well, so that the writes do not count a reference twice.
+        The writes which were aborted are skipped. A write which is refused
+        again, because its abort record was lost, is dropped and logged so
+        that it can not keep the database from opening, any other error is
+        raised
+        '''
+        for record in reversed(records):
+            if 'pre' in record:
+                self.index.restore_bucket(*record['pre'])
+            elif 'ref' in record:
+                sorbic.stor.files.restore_refs(*record['ref'])
+        aborted = set(
+            record['seq'] for record in records if record.get('abort'))
+        for record in records:
+            if 'op' not in record or record['seq'] in aborted:
+                continue
+            try:
+                self._replay_record(record)
+            except (TypeError, ValueError) as exc:
+                # The errors raised by the checks and the serializers, the
+                # write failed the same way when it was first made
+                keys = [record.get('key')]
+                if record['op'] == 'insert_many':
+                    keys = [key for key, _ in record['items']]
+                log.error(
+                    'Dropped the logged %s of %s, seq %s: %s',
+                    record['op'],
+                    ', '.join(keys),
+                    record['seq'],
+                    exc)
+        self.index.sync()
+
+    def _replay_record(self, record):
+        '''
+        Apply a single logged write again
+        '''
+        if record['op'] == 'insert':
+            self.insert(
+                record['key'],
+                record['data'],
+                record['id'],
+                record['type'],
+                record['serial'],
+                **record['kw'])
+        elif record['op'] == 'insert_many':
+            self.insert_many(
+                record['items'],
+                record['type'],
+                record['serial'],
+                ids=record['ids'])
+        elif record['op'] == 'rm':
+            self.rm(record['key'], record['id'])
+
+    def _journal(self, table, pos):
+        '''
+        Log the contents of a bucket before the index overwrites it, the
+        trans tables are removed when they are not swapped in so their
+        buckets are not logged
+        '''
+        if os.path.basename(table['fn']).startswith('trans_table_'):
+            return False
+        self.wal.pre_image(
+            table['fn'],
+            pos,
+            self.index._read_raw_bucket(table, pos))
+        return True
+
+    def _journal_ref(self, fn_, refs):
+        '''
+        Log the reference count of a file blob before a write raises it
+        '''
+        if self.wal is not None:
+            self.wal.ref_image(fn_, refs)
+
+    def _wal_abort(self, seq):
+        '''
+        Log that the write with the given sequence number failed
+        '''
+        if seq is not None:
+            self.wal.abort(seq)
+
+    def _wal_commit(self, sync):
+        '''
+        Mark a logged write as applied and checkpoint once the log has
+        passed the wal_size
+        '''
+        if self.wal is None:
+            return
+        self.wal.commit(sync)
+        if not self.wal.pending:
+            self.index.release_buckets()
+        elif self.wal.sync_policy == 'batch' and self._wal_timer is None:
+            self._wal_timer = threading.Timer(
+                self.wal.sync_ms / 1000.0,
+                self._wal_tick)
+            self._wal_timer.daemon = True
+            self._wal_timer.start()
+        if self.wal.size() >= self.wal_size:
+            self._checkpoint()
+
+    @_writes
+    def _wal_tick(self):
+        '''
+        Fsync the log sync_ms after the first write which the last fsync
+        did not cover, so that the last writes before the database goes
+        idle are made durable
+        '''
+        self._wal_timer = None
+        if self.wal is not None and self.wal.pending:
+            self._wal_sync()
+
+    def _wal_sync(self):
+        '''
+        Fsync the log and write out the buckets which were held for it
+        '''
+        seq = self.wal.sync()
+        self.index.release_buckets()
+        return seq
+
+    @_writes
+    def sync(self):
+        '''
+        Fsync the write ahead log, making every write made so far durable.
+        Returns the last durable sequence number
+        '''
+        if self.wal is None:
+            self.index.sync()
+            return 0
+        return self._wal_sync()
+
+    @_writes
+    def checkpoint(self):
+        '''
+        Fsync the tables written to since the last checkpoint and empty the
+        write ahead log
+        '''
+        self._checkpoint()
+
+    def _checkpoint(self):
+        if self.wal is not None:
+            self._wal_sync()
+        self.index.sync()
+        if self.wal is not None:
+            self.wal.truncate()
+
+    def _lock_dirs(self, fn_roots, exclusive=False):
+        '''
+        Lock the given key directories against other processes until the
+        running DB method returns
+        '''
+        if self.dir_locks is not None:
+            self.dir_locks.acquire(fn_roots, exclusive)
+
+    def _lock_tree(self, fn_root):
+        '''
+        Lock the key directory and every directory below it exclusively. The
+        directories are walked again once they are locked, if another
+        process has made one meanwhile the locks are taken again
+        '''
+        if self.dir_locks is None:
+            return
+        mark = self.dir_locks.mark()
+        fn_roots = self._dir_tree(fn_root)
+        while True:
+            self.dir_locks.acquire(fn_roots, True)
+            found = self._dir_tree(fn_root)
+            if found == fn_roots:
+                return
+            self.dir_locks.release(mark)
+            fn_roots = found
+
+    def _dir_tree(self, fn_root):
+        '''
+        Return the key directory and the directories below it in sorted
+        order
+        '''
+        fn_roots = [fn_root]
+        for dirpath, dirnames, _ in os.walk(fn_root):
+            fn_roots.extend(
+                os.path.join(dirpath, dirname) for dirname in dirnames)
+        return sorted(fn_roots)
+
+    def _dir_mark(self):
+        if self.dir_locks is None:
+            return 0
+        return self.dir_locks.mark()
+
+    def _dir_release(self, mark):
+        if self.dir_locks is not None:
+            self.dir_locks.release(mark)
+
+    def _dir_stale(self, fn_root):
+        '''
+        Drop the cached tables of a key directory which was changed by
+        another process, along with the document cache
+        '''
+        self.index.refresh_dir(fn_root)
+        with self._cache_lock:
+            self._cache_invalidate()
+
+    def _cache_evict(self, c_key, cached):
+        '''
+        Forget the evicted document cache entry
+        '''
+        ids = self._cache_keys.get(c_key[0])
+        if ids is None:
+            return
+        ids.discard(c_key[1])
+        if not ids:
+            self._cache_keys.pop(c_key[0])
+
+    def _cache_invalidate(self, key=None, d_key=None):
+        '''
+        Drop the cached documents for the given key, every key under the
+        given directory key, or the whole document cache
+        '''
+        if self.doc_cache is None:
+            return
+        if key is None and not (d_key or '').strip(self.key_delim):
+            self.doc_cache.clear()
+            self._cache_keys.clear()
+            return
+        if key is not None:
+            keys = [key.lstrip(self.key_delim)]
+        else:
+            prefix = '{0}{1}'.format(
+                d_key.strip(self.key_delim),
+                self.key_delim)
+            keys = [c_key for c_key in self._cache_keys
+                    if c_key.startswith(prefix)]
+        for c_key in keys:
+            for id_ in self._cache_keys.pop(c_key, ()):
+                self.doc_cache.pop((c_key, id_))
+
+    def _cache_get(self, key, id_):
+        '''
+        Return the cached data and meta for the key and id, reading and
+        caching them on a miss
+        '''
+        c_key = (key.lstrip(self.key_delim), id_)
+        with self._cache_lock:
+            cached = self.doc_cache.get(c_key)
+        if cached is not None:
+            return cached
+        entries = self._get_meta(key, id_)
+        if not entries:
+            return None
+        cached = {'data': self._get_storage(entries), 'meta': entries}
+        # Documents are charged their serialized size, the stored size of a
+        # compressed document is smaller than what the cache holds
+        if entries['data'].get('c') and 'sz' in entries['data']:
+            size = len(self.index.serialize(cached['data']))
+        else:
+            size = entries['data'].get('sz')
+        if size is None:
+            size = len(cached['data'])
+        with self._cache_lock:
+            self.doc_cache.set(c_key, cached, size)
+            self._cache_keys.setdefault(c_key[0], set()).add(id_)
+        return cached
+
+    def doc_cache_stats(self):
+        '''
+        Return the hit rate and memory use of the document cache
+        '''
+        if self.doc_cache is None:
+            return {}
+        return self.doc_cache.stats()
 
     def _get_storage(self, entries, **kwargs):
         stor = self.read_stor_funcs[entries['data']['t']](entries, self.serial, **kwargs)
@@ -101,37 +588,149 @@ class DB(object):
                  data,
                  serial)
 
-    def insert(self, key, data, id_=None, type_='doc', serial=None, **kwargs):
+    @_writes
+    def insert(
+            self,
+            key,
+            data,
+            id_=None,
+            type_='doc',
+            serial=None,
+            sync=False,
+            **kwargs):
         '''
-        Insert a key into the database
+        Insert a key into the database, with the write ahead log enabled
+        sync makes the write durable before returning. The data of a file
+        can be a string, a file like object or an iterator of strings, which
+        is streamed to disk. The log holds the whole data, so with the log
+        enabled streamed files are read into memory first. A ValueError is
+        raised when the key holds the most revisions the fmt allows
         '''
+        self._lock_dirs([self.index.entry_root(key)], True)
+        self._cache_invalidate(key)
         c_key = self.index.raw_crypt_key(key)
         table_entry = self.index.get_table_entry(key, c_key)
-        serial = serial if serial else self.serial
-        kwargs.update(self.write_stor(
-            table_entry,
-            data,
-            serial,
-            type_))
-        return self.index.commit(
-            table_entry,
-            key,
-            c_key,
-            id_,
-            type_,
-            **kwargs)
+        self.index.check_rev(key, table_entry)
+        seq = None
+        if self.wal is not None:
+            if type_ == 'file':
+                data = sorbic.stor.files.collect(data)
+            id_ = id_ if id_ else sorbic.utils.rand.gen_id()
+            seq = self.wal.log(
+                'insert',
+                key=key,
+                data=data,
+                id=id_,
+                type=type_,
+                serial=serial,
+                kw=kwargs)
+        try:
+            serial = serial if serial else self.serial
+            kwargs.update(self.write_stor(
+                table_entry,
+                data,
+                serial,
+                type_))
+            ret = self.index.commit(
+                table_entry,
+                key,
+                c_key,
+                id_,
+                type_,
+                **kwargs)
+        except Exception:
+            self._wal_abort(seq)
+            raise
+        self._resize_note([key])
+        self._wal_commit(sync)
+        self._check_load()
+        return ret
+
+    @_writes
+    def insert_many(
+            self,
+            items,
+            type_='doc',
+            serial=None,
+            sync=False,
+            ids=None):
+        '''
+        Insert many keys into the database at once, items is a dict or an
+        iterable of (key, data) pairs. The keys are grouped by table so that
+        the data for each table is appended in one write. Returns the index
+        entries in the order of the passed items
+        '''
+        if isinstance(items, dict):
+            items = items.items()
+        items = list(items)
+        self._lock_dirs([self.index.entry_root(key) for key, _ in items], True)
+        for key, _ in items:
+            self._cache_invalidate(key)
+        seq = None
+        if self.wal is not None:
+            self.index.check_revs([key for key, _ in items])
+            if type_ == 'file':
+                items = [(key, sorbic.stor.files.collect(data))
+                         for key, data in items]
+            if not ids:
+                ids = [sorbic.utils.rand.gen_id() for _ in items]
+            seq = self.wal.log(
+                'insert_many',
+                items=items,
+                ids=ids,
+                type=type_,
+                serial=serial)
+        try:
+            serial = serial if serial else self.serial
+            ret = self.index.commit_many(
+                items,
+                type_,
+                serial,
+                self.write_stor_funcs[type_],
+                ids)
+        except Exception:
+            self._wal_abort(seq)
+            raise
+        self._resize_note([key for key, _ in items])
+        self._wal_commit(sync)
+        self._check_load()
+        return ret
 
-    def get_meta(self, key, id_=None, count=None):
+    @_reads
+    def get_meta(self, key, id_=None, count=None, rev=None):
         '''
         Retrive a meta entry
         '''
-        return self.index.get_index_entry(key, id_, count)
+        return self._get_meta(key, id_, count, rev)
+
+    def _get_meta(self, key, id_=None, count=None, rev=None):
+        self._lock_dirs([self.index.entry_root(key)])
+        return self.index.get_index_entry(key, id_, count, rev)
 
-    def get(self, key, id_=None, meta=False, count=None, **kwargs):
+    @_reads
+    def get(self, key, id_=None, meta=False, count=None, rev=None, **kwargs):
         '''
-        Retrive a data entry
+        Retrive a data entry, by id or by revision number, documents which
+        are served from the document cache are shared and must not be
+        modified. Files can be read from offset for length bytes, and with
+        stream=True a file like reader is returned which must be closed
         '''
-        entries = self.get_meta(key, id_, count)
+        self._lock_dirs([self.index.entry_root(key)])
+        cacheable = (not count and rev is None and
+                     set(kwargs) <= set(['doc_path']))
+        if self.doc_cache is not None and cacheable:
+            cached = self._cache_get(key, id_)
+            if cached is None:
+                return None
+            data = cached['data']
+            if kwargs.get('doc_path'):
+                data = sorbic.utils.traverse.traverse_dict_and_list(
+                    data,
+                    kwargs['doc_path'])
+            if not meta:
+                return data
+            return {'data': data, 'meta': cached['meta']}
+        entries = self._get_meta(key, id_, count, rev)
         if not entries:
             return None
         if count:
@@ -152,86 +751,371 @@ class DB(object):
             ret['meta'] = entries
             return ret
 
-    def compress(self, d_key=None, num=None):
+    @_reads
+    def open_blob(self, key, id_=None, rev=None):
         '''
-        Compress a single given index, remove any associated data
+        Return a sorbic.stor.blob.Blob handle of the stored bytes of the
+        entry, exposing the file descriptor, offset, size and crc so the data
+        can be sent with os.sendfile or mapped without being copied. Documents
+        are the serialized bytes in the table, compressed documents name the
+        codec and the dictionary, if any, needed to decompress them. The
+        handle must be closed
         '''
-        fn_root = self.root
-        if not d_key or d_key == self.key_delim:
-            pass
-        else:
-            fn_root = self.index.entry_root('{0}/blank'.format(d_key))
+        self._lock_dirs([self.index.entry_root(key)])
+        entries = self._get_meta(key, id_, rev=rev)
+        if not entries:
+            return None
+        return self.open_stor_funcs[entries['data']['t']](entries)
+
+    @_reads
+    def get_many(self, keys, meta=False, **kwargs):
+        '''
+        Retrive the newest data entry for many keys at once, the table and
+        storage reads are made in file offset order. The returned list is in
+        the order of the passed keys, missing keys return None
+        '''
+        keys = list(keys)
+        self._lock_dirs([self.index.entry_root(key) for key in keys])
+        entries = self.index.get_index_entries(keys)
+        rets = [None] * len(keys)
+        order = sorted(
+            [ind for ind in range(len(keys)) if entries[ind]],
+            key=lambda ind: (
+                entries[ind]['table']['tfn'],
+                entries[ind]['data'].get('st', 0),
+                entries[ind]['data'].get('path')))
+        for ind in order:
+            stor = self._get_storage(entries[ind], **kwargs)
+            if meta:
+                rets[ind] = {'data': stor, 'meta': entries[ind]}
+            else:
+                rets[ind] = stor
+        return rets
+
+    @_rebuilds
+    def compress(self, d_key=None, num=None, progress=None):
+        '''
+        Compress a single given index, remove any associated data. The table
+        is streamed once and the kept revisions are copied to a new table
+        which is swapped in. progress is called with the compaction stats as
+        the buckets are scanned, the final stats are returned
+        '''
+        fn_root = self.index.dir_root(d_key)
+        self._lock_tree(fn_root)
+        self._cache_invalidate()
+        self._checkpoint()
         fn_ = os.path.join(fn_root, 'sorbic_table_{0}'.format(num))
         trans_fn = os.path.join(fn_root, 'trans_table_{0}'.format(num))
-        if os.path.exists(trans_fn):
-            os.remove(trans_fn)
-        table = self.index.get_hash_table(fn_)
-        trans_table = self.index.get_hash_table(trans_fn)
-        table_entries = []
-        for entry in self.index._get_table_entries(fn_):
-            table_entries.append(entry)
-        for entry in table_entries:
-            self._compress_entry(entry, table, trans_table)
-        table['fp'].close()
-        trans_table['fp'].close()
-        self.index.tables.pop(fn_)
-        self.index.tables.pop(trans_fn)
-        shutil.move(trans_fn, fn_)
-
-    def _compress_entry(self, entry, table, trans_table):
-        '''
-        Read the table entries to keep out of the given entry and write them
-        fresh to the trans table
-        '''
-        c_key = self.index.raw_crypt_key(entry['key'])
-        i_entries = self.index.get_index_entry(entry['key'], count=0xffffffff)
-        tte = {}
-        tte['tfn'] = trans_table['fp'].name
-        tte['key'] = i_entries['table']['key']
-        tte['prev'] = i_entries['table']['prev']
-        tte['pos'] = i_entries['table']['pos']
-        tte['rev'] = 0
-        keeps = []
-        for ind in reversed(range(len(i_entries['data']))):
-            i_entry = i_entries['data'][ind]
-            if i_entry['_status'] != 'k':
-                continue
-            keeps.append(i_entry)
-        for i_entry in keeps:
-            serial = i_entry.get('serial', self.serial)
-            get_entries = {'table': i_entries['table'], 'data': i_entry}
-            stor = self._get_storage(get_entries)
-            i_entry.update(self.write_stor(
-                tte,
-                stor,
-                serial,
-                i_entry.get('type', 'doc')))
-            kwargs = i_entry
-            key = kwargs.pop('key')
-            id_ = kwargs.pop('id')
-            if 'type' in kwargs:
-                type_ = kwargs.pop('type')
-            else:
-                type_ = 'doc'
-            self.index.commit(tte, key, c_key, id_, type_, **kwargs)
-            tte['rev'] += 1
+        self.index.remove_table(trans_fn)
+        journal, self.index.journal = self.index.journal, None
+        try:
+            stats = self.index.compact_table(
+                fn_,
+                trans_fn,
+                self.copy_stor_funcs,
+                progress,
+                self.release_stor_funcs)
+            self.index.replace_table(trans_fn, fn_)
+        finally:
+            self.index.journal = journal
+        self._checkpoint()
+        return stats
 
+    @_rebuilds
+    def train_dict(self, d_key=None, size=None, samples=None):
+        '''
+        Train a zstd dictionary from the documents of the key directory, the
+        new documents of the directory are then compressed with it. This
+        pays off for small documents which do not compress on their own.
+        Compaction moves the copied documents to the newest dictionary and
+        resize removes the older dictionaries. Returns the dictionary number
+        '''
+        fn_root = self.index.dir_root(d_key)
+        self._lock_dirs([fn_root], True)
+        return self.index.train_dict(
+            fn_root,
+            size if size else sorbic.ind.hdht.DICT_SIZE,
+            samples if samples else sorbic.ind.hdht.DICT_SAMPLES)
+
+    @_rebuilds
+    def resize(self, d_key=None, hash_limit=None, progress=None):
+        '''
+        Rebuild all of the tables in a key directory into new tables with a
+        larger hash_limit. If the hash_limit is not passed then the smallest
+        hash_limit which keeps the load under half of the resize_load, or
+        double the current hash_limit, is used
+        '''
+        fn_root = self.index.dir_root(d_key)
+        self._lock_tree(fn_root)
+        return self._resize_root(fn_root, hash_limit, progress)
+
+    def _resize_root(
+            self,
+            fn_root,
+            hash_limit=None,
+            progress=None,
+            background=False):
+        '''
+        Rebuild the tables in the given directory, the new tables are built
+        as trans_table_N and swapped in the same way as compress. In the
+        background the lock is handed to the waiting threads as the tables
+        are built, the keys they write are copied again before the swap
+        '''
+        self._cache_invalidate()
+        self.index.overloaded.discard(fn_root)
+        fns = self.index.table_fns(fn_root)
+        if not fns:
+            return {}
+        self._checkpoint()
+        for trans_fn in self.index.table_fns(fn_root, 'trans_table_'):
+            self.index.remove_table(trans_fn)
+        if hash_limit is None:
+            hash_limit = self._resize_limit(fns)
+        release = self.release_stor_funcs
+        deferred = None
+        pause = None
+        if background:
+            # Removed revisions are only released once the build is done,
+            # the tables being read are written by the waiting threads
+            release = None
+            deferred = set()
+            steps = itertools.count(1)
+
+            def pause():
+                if not next(steps) % RESIZE_STEP:
+                    self.lock.yield_write()
+            self._resizing = (fn_root, set())
+        try:
+            stats = self.index.compact_dir(
+                fn_root,
+                hash_limit,
+                self.copy_stor_funcs,
+                progress,
+                release,
+                deferred,
+                pause)
+            if background:
+                self._recopy_written(hash_limit, deferred)
+                self.index.release_deferred(deferred, self.release_stor_funcs)
+        except Exception:
+            for trans_fn in self.index.table_fns(fn_root, 'trans_table_'):
+                self.index.remove_table(trans_fn)
+            raise
+        finally:
+            self._resizing = None
+        trans_fns = self.index.table_fns(fn_root, 'trans_table_')
+        # The log holds the buckets of the old tables, it is emptied before
+        # the tables are replaced
+        self.index.unsynced.update(trans_fns)
+        self._checkpoint()
+        fns = self.index.table_fns(fn_root)
+        for num, trans_fn in enumerate(trans_fns):
+            self.index.replace_table(
+                trans_fn,
+                os.path.join(fn_root, 'sorbic_table_{0}'.format(num)))
+        for fn_ in fns[len(trans_fns):]:
+            self.index.remove_table(fn_)
+        self.index.prune_dicts(fn_root)
+        self.index.overloaded.discard(fn_root)
+        self._check_tables(fn_root)
+        self._checkpoint()
+        return stats
+
+    def _recopy_written(self, hash_limit, deferred):
+        '''
+        Copy the keys written during a background build into the new tables
+        again. The lock is handed over between batches, which can write more
+        keys, until the keys left are copied in a single batch
+        '''
+        written = self._resizing[1]
+        while written:
+            keys = sorted(written)
+            written.clear()
+            for ind, key in enumerate(keys):
+                if ind and not ind % RECOPY_BATCH:
+                    self.lock.yield_write()
+                self.index.recopy_key(
+                    key,
+                    hash_limit,
+                    self.copy_stor_funcs,
+                    deferred)
+
+    def _resize_limit(self, fns):
+        '''
+        Return the smallest hash_limit which keeps the load of the tables
+        under half of the resize_load, or double the current hash_limit
+        '''
+        keys = 0
+        for fn_ in fns:
+            keys += self.index.table_keys(self.index.get_hash_table(fn_))
+        hash_limit = (self.index.get_hash_table(fns[0])['hash_limit'] << 1) | 1
+        load = self.index.resize_load or 1.0
+        while keys > (load / 2) * (hash_limit + 1):
+            hash_limit = (hash_limit << 1) | 1
+        return hash_limit
+
+    def _check_tables(self, fn_root):
+        '''
+        Mark the directory as overloaded again if the keys written during a
+        background resize have filled the new tables past the resize_load
+        '''
+        if not self.index.resize_load:
+            return
+        for fn_ in self.index.table_fns(fn_root):
+            table = self.index.get_hash_table(fn_)
+            limit = self.index.resize_load * (table['hash_limit'] + 1)
+            if self.index.table_keys(table) > limit:
+                self.index.overloaded.add(fn_root)
+
+    def _resize_note(self, keys):
+        '''
+        Note the written keys which belong to the directory being resized in
+        the background
+        '''
+        if self._resizing is None:
+            return
+        fn_root, written = self._resizing
+        for key in keys:
+            if self.index.entry_root(key) == fn_root:
+                written.add(key)
+
+    def _check_load(self):
+        '''
+        Resize the directories which hold a table over the resize_load, the
+        resize is left to a background thread once the database is open
+        '''
+        if not self._bg_resize:
+            while self.index.overloaded:
+                self._resize_root(self.index.overloaded.pop())
+            return
+        if self.index.overloaded and self._resizer is None:
+            self._resizer = threading.Thread(target=self._resize_worker)
+            self._resizer.daemon = True
+            self._resizer.start()
+
+    def _resize_worker(self):
+        '''
+        Resize the overloaded directories one at a time until none are left
+        '''
+        while True:
+            with self._resize_lock:
+                self.lock.acquire_write()
+                try:
+                    if not self.index.overloaded:
+                        self._resizer = None
+                        return
+                    self._resize_root(
+                        self.index.overloaded.pop(),
+                        background=True)
+                except Exception:
+                    self._resizer = None
+                    raise
+                finally:
+                    self.lock.release_write()
+
+    def wait_resize(self):
+        '''
+        Block until the background resizes have finished
+        '''
+        resizer = self._resizer
+        if resizer is not None:
+            resizer.join()
+
+    def table_cache_stats(self):
+        '''
+        Return the hit, miss and eviction stats of the open table cache
+        '''
+        return self.index.table_cache_stats()
+
+    @_rebuilds
+    def close(self):
+        '''
+        Close all of the open table files, with the write ahead log enabled
+        the tables are synced and the log is emptied. A background resize
+        which is running is finished first, the directories still waiting
+        for one are resized when their tables next take a key
+        '''
+        self.index.overloaded.clear()
+        if self.wal is not None:
+            self._checkpoint()
+            self.wal.close()
+            self.wal = None
+            self.index.journal = None
+            self.index.held = None
+            if self._wal_timer is not None:
+                self._wal_timer.cancel()
+                self._wal_timer = None
+        self.index.close()
+        if self.dir_locks is not None:
+            self.dir_locks.close()
+
+    @_reads
     def listdir(self, d_key):
         '''
         List the contents of a directory
         '''
+        self._lock_dirs([self.index.dir_root(d_key)])
         return self.index.listdir(d_key)
 
+    def iter_keys(self, prefix='', start=None, end=None, limit=None):
+        '''
+        Lazily yield the keys in the key directory of the prefix which start
+        with the prefix, in sorted order. start and end bound the keys, start
+        is inclusive and end is exclusive
+        '''
+        prefix = prefix.lstrip(self.key_delim)
+        d_key = ''
+        if self.key_delim in prefix:
+            d_key = prefix[:prefix.rfind(self.key_delim)]
+        fn_root = self.index.dir_root(d_key)
+        last = None
+        while limit is None or limit > 0:
+            size = KEY_BATCH if limit is None else min(limit, KEY_BATCH)
+            keys = self._key_batch(fn_root, prefix, start, end, last, size)
+            if not keys:
+                return
+            for key in keys:
+                yield key
+            if limit is not None:
+                limit -= len(keys)
+            last = keys[-1]
+
+    @_reads
+    def _key_batch(self, fn_root, prefix, start, end, after, limit):
+        '''
+        Return the next batch of keys for iter_keys, the key index is only
+        locked while the batch is read
+        '''
+        self._lock_dirs([fn_root])
+        return self.index.iter_keys(fn_root, prefix, start, end, after, limit)
+
+    @_rebuilds
     def rmdir(self, d_key):
         '''
         Recursively remove a key directory and all subdirs and subkeys.
         THIS OPERATION IS IRREVERSIBLE!!
         '''
+        self._lock_tree(self.index.dir_root(d_key))
+        self._cache_invalidate(d_key=d_key)
+        self._checkpoint()
         return self.index.rmdir(d_key)
 
-    def rm(self, key, id_=None):
+    @_writes
+    def rm(self, key, id_=None, sync=False):
         '''
         Make a key for deletion, if the id is omitted then the key itself
         and all revs will be removed. THIS OPERATION IS IRREVERSIBLE!!
         '''
-        return self.index.rm_key(key, id_)
+        self._lock_dirs([self.index.entry_root(key)], True)
+        self._cache_invalidate(key)
+        seq = None
+        if self.wal is not None:
+            seq = self.wal.log('rm', key=key, id=id_)
+        try:
+            ret = self.index.rm_key(key, id_, self.release_stor_funcs)
+        except Exception:
+            self._wal_abort(seq)
+            raise
+        self._resize_note([key])
+        self._wal_commit(sync)
+        return ret
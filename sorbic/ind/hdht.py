@@ -5,34 +5,144 @@ Higherarchical Distributed Hash Table index
 # Import python libs
 import os
 import io
+import errno
+import re
 import sys
+import mmap
 import shutil
 import struct
 import hashlib
+import binascii
+import threading
 
 # Import sorbic libs
+import sorbic.ind.keys
+import sorbic.utils.lru
 import sorbic.utils.rand
 import sorbic.utils.traverse
+import sorbic.stor.blob
+import sorbic.stor.codec
 import sorbic.stor.serial
 
 # Import Third Party Libs
 import msgpack
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
 
 IS_PY3 = sys.version_info >= (3,)
+# Reads are positional so that threads can share the read handles, without
+# os.pread every thread gets its own read handles
+HAS_PREAD = hasattr(os, 'pread')
 
 # index header types:
 # k: "keep" the entry an the data
 # r: "remove" the entry and the data
 # e: "expired" remove the index entry but keep the data, another entry
 #    references it
+# d: "dropped" the entry was removed and the stored data has been released
 HEADER_DELIM = '_||_||_'
 IND_HEAD_FMT = '>Hc'
+IND_HEAD_SIZE = struct.calcsize(IND_HEAD_FMT)
+# Bytes read at once for an index entry, which holds most entries along with
+# their head, the rest of a longer entry is read after it
+IND_READ = 256
+# Table header fields which only live in memory
+HEADER_MEM = (
+    'fp', 'map', 'fn', 'dirty', 'segs', 'seg', 'occ', 'blm', 'wgen')
+# Write the table header every HEADER_SYNC new keys to persist the key count
+HEADER_SYNC = 64
+# Call the compaction progress callback every PROGRESS_STEP buckets
+PROGRESS_STEP = 4096
+# Tables with data_logs in the header keep the index entries and documents
+# in append only segment files named <prefix>_data_<num>_<seg>.seg next to
+# the table. Data positions are (seg << SEG_SHIFT) | offset, segments are
+# numbered from 1 so that a position is never 0
+SEG_SHIFT = 40
+SEG_MASK = (1 << SEG_SHIFT) - 1
+# Number of buckets read at a time when scanning a table
+SCAN_BUCKETS = 8192
+# Tables keep memory mapped sidecar files named <table>.<ext>, after
+# SIDE_HEAD bytes which start with 'd' while the table is open for writing
+# and 'c' once it is cleanly closed. A sidecar which was left dirty, or is
+# missing, is rebuilt from the buckets.
+# occ: the occupancy bitmap, one bit per bucket. The bits are set before a
+#      bucket is written and cleared after it is emptied
+# blm: a Bloom filter of the crypt keys in the table, kept by tables with
+#      bloom, the number of hashes, in the header. Removed keys stay in the
+#      filter until the table is compacted
+SIDECARS = ('occ', 'blm')
+SIDE_HEAD = 8
+# Bits of Bloom filter for every bucket of the table
+BLOOM_KEY_BITS = 10
+BLOOM_HASHES = 7
+# Tables are scanned through the bitmap while fewer than 1 / OCC_SPARSE of
+# the buckets hold a key
+OCC_SPARSE = 16
+OCC_BYTE = re.compile(b'[^\x00]')
+# The numpy types of the struct codes which can be used in a bucket fmt,
+# with numpy the occupied buckets of a scanned chunk are found in one pass
+NUMPY_CODES = {
+    'B': 'u1', 'b': 'i1', 'H': 'u2', 'h': 'i2', 'I': 'u4', 'i': 'i4',
+    'L': 'u4', 'l': 'i4', 'Q': 'u8', 'q': 'i8'}
+# Key directories can keep zstd dictionaries trained from their documents as
+# sorbic_dict_<num>. The newest dictionary compresses the new documents and
+# the documents copied by compaction, the entries name their dictionary in d
+DICT_PREFIX = 'sorbic_dict_'
+DICT_SIZE = 0x4000
+DICT_SAMPLES = 4096
 
 
-def _calc_pos(c_key, hash_limit, b_size, header_len):
+# Index entries carry the revision number of the entry in the chain of the
+# key as r, starting from 1. An entry whose revision is a multiple of
+# 2 ** level also links back to revision r - 2 ** level in tw, for every
+# level from 1 up, so that any revision is reached in a logarithmic number
+# of reads. Level 0 is the p link
+# Ids made by gen_id carry the time they were made after ID_TIME_OFF hex
+# characters, ids of a key are found by time along the skip links
+ID_LEN = 20
+ID_TIME_OFF = 4
+
+
+def _id_time(id_):
+    '''
+    Return the time of an id made by gen_id, or None for other ids
+    '''
+    if not isinstance(id_, str) or len(id_) != ID_LEN:
+        return None
+    try:
+        return int(id_[ID_TIME_OFF:], 16)
+    except ValueError:
+        return None
+
+
+# Bucket position hash types, recorded in the table header as pos_hash:
+# digest: the position is taken from the leading bytes of the crypt key,
+#         stable across processes and interpreters
+# Tables without a pos_hash use the builtin hash()
+POS_HASH = 'digest'
+POS_HASH_FMT = '>Q'
+
+# Table layouts, recorded in the table header as layout:
+# linear: colliding keys probe the following buckets of the same table, up
+#         to the probe_limit in the header, before spilling to the next
+#         table
+# Tables without a layout move every collision to the next table
+# The header fields which decide the bucket position of a key
+POS_FIELDS = ('hash_limit', 'header_len', 'pos_hash', 'layout', 'probe_limit')
+# Number of key directories whose key index is kept in memory
+KEY_INDEXES = 64
+
+
+def _calc_pos(c_key, hash_limit, b_size, header_len, pos_hash=None):
     '''
     Calculate the hash position in the table file
     '''
+    if pos_hash == 'digest':
+        num = struct.unpack_from(POS_HASH_FMT, c_key)[0]
+        return ((num & hash_limit) * b_size) + header_len
     return (abs(hash(c_key) & hash_limit) * b_size) + header_len
 
 
@@ -46,10 +156,20 @@ class HDHT(object):
             key_delim='/',
             hash_limit=0xfffff,
             key_hash='sha1',
-            fmt='>KsQH',
+            fmt='>KsQI',
             fmt_map=None,
             header_len=1024,
-            serial='msgpack'):
+            serial='msgpack',
+            mmap_tables=False,
+            max_open_tables=None,
+            probe=None,
+            probe_limit=16,
+            resize_load=None,
+            data_logs=False,
+            segment_size=0x4000000,
+            bloom=False,
+            codec=None,
+            codec_min=sorbic.stor.codec.CODEC_MIN):
         if fmt_map is None:
             self.fmt_map = ('key', 'prev', 'rev')
         else:
@@ -70,8 +190,57 @@ class HDHT(object):
         else:
             self.fmt = fmt.replace('K', str_key_size)
         self.bucket_size = self.__gen_bucket_size()
+        self.rev_limit = self.__gen_rev_limit()
+        self.probe = probe
+        self.probe_limit = probe_limit
+        self.resize_load = resize_load
+        self.data_logs = data_logs
+        self.segment_size = segment_size
+        self.bloom = bloom
+        self.codec = codec
+        self.codec_min = codec_min
+        # Directories holding a table which has passed the resize_load
+        self.overloaded = set()
+        # Tables written to since the last sync, and the optional callable
+        # which is passed the table and position before a bucket is
+        # overwritten, used by the write ahead log. When held is a dict the
+        # buckets the journal logged are kept in it, keyed by table and
+        # position, until release_buckets writes them out
+        self.unsynced = set()
+        self.journal = None
+        self.held = None
+        # Tables with buffered writes which the read handles can not see
+        # yet, mapped to the byte range which is buffered for each of their
+        # files. A write which does not follow the buffered range flushes
+        # it first, so a read only flushes the table when it overlaps a range
+        self.unflushed = {}
+        # Pools of free read only handles, keyed by table and file. A reader
+        # takes a handle out of the pool for each read, so the handles are
+        # bounded by the concurrent reads, and the pools of a table are
+        # closed when the table is evicted. The handles are buffered and kept
+        # with the write generation of the table they last read at
+        self.read_fps = {}
+        # Guards the table cache, readers in many threads can open tables
+        self.table_lock = threading.RLock()
+        # The ordered key indexes of the recently used key directories, an
+        # evicted index writes out its log and is read again when needed.
+        # Each index holds its log open, so max_open_tables bounds them too
+        self.key_indexes = sorbic.utils.lru.LRU(
+            max_entries=max_open_tables or KEY_INDEXES,
+            on_evict=lambda fn_root, index: index.close())
+        self._dtypes = {}
         self.serial = sorbic.stor.serial.Serial(serial)
-        self.tables = {}
+        self.mmap_tables = mmap_tables
+        # Parsed table headers are kept for the life of the index, the open
+        # handles are bounded by max_open_tables
+        self.headers = {}
+        # The newest dictionary number of the key directories and the loaded
+        # dictionaries, keyed by directory and number
+        self.dict_nums = {}
+        self.dicts = {}
+        self.tables = sorbic.utils.lru.LRU(
+            max_entries=max_open_tables,
+            on_evict=self._release_table)
 
     def __crypt_func(self):
         '''
@@ -108,13 +277,42 @@ class HDHT(object):
                 args.append(1)
         return len(struct.pack(self.fmt, *args))
 
+    def __gen_rev_limit(self):
+        '''
+        Return the highest revision number the rev field of the bucket fmt
+        can hold, the revisions of a key are numbered from 0
+        '''
+        fmt = self.fmt
+        if IS_PY3:
+            fmt = fmt.decode('utf-8')
+        code = re.findall(r'\d*[a-zA-Z?]', fmt)[list(self.fmt_map).index('rev')]
+        limit = (1 << (8 * struct.calcsize('>' + code))) - 1
+        if code.islower():
+            limit >>= 1
+        return limit
+
     def _open_hash_table(self, fn_):
         '''
         Return the header data for the table at the given location, open if
-        needed
+        needed. Open tables are looked up without the lock
         '''
-        if fn_ in self.tables:
-            return self.tables[fn_]
+        table = self.tables.peek(fn_)
+        if table is not None:
+            return table
+        with self.table_lock:
+            return self.__open_hash_table(fn_)
+
+    def __open_hash_table(self, fn_):
+        table = self.tables.get(fn_)
+        if table is not None:
+            return table
+        if fn_ in self.headers:
+            # The header is cached but the handle was evicted, reopen it
+            header = self.headers[fn_]
+            header['fp'] = io.open(fn_, 'r+b')
+            self._map_table(header)
+            self.tables.set(fn_, header)
+            return header
         if not os.path.isfile(fn_):
             raise IOError()
         fp_ = io.open(fn_, 'r+b')
@@ -131,9 +329,758 @@ class HDHT(object):
                         raw_head[:raw_head.find(HEADER_DELIM)]
                         )
                     )
-                self.tables[fn_] = header
+                header['fn'] = fn_
+                self._map_table(header)
+                self.headers[fn_] = header
+                self.tables.set(fn_, header)
                 return header
 
+    def _map_table(self, table):
+        '''
+        Memory map the bucket region of the given table if mmap tables are
+        enabled
+        '''
+        if not self.mmap_tables:
+            return
+        table['fp'].flush()
+        size = ((table['hash_limit'] + 2) * table['bucket_size'])
+        size += table['header_len']
+        table['map'] = mmap.mmap(table['fp'].fileno(), size)
+
+    def _release_table(self, fn_, table):
+        '''
+        Close the file handle and memory map of the table, the parsed header
+        is kept
+        '''
+        if table.get('dirty') and 'fp' in table:
+            self._write_header(table)
+        if 'map' in table:
+            table.pop('map').close()
+        for ext in SIDECARS:
+            if ext not in table:
+                continue
+            side = table.pop(ext)
+            if side[:1] != 'c':
+                side.flush()
+                side[:1] = 'c'
+                side.flush()
+            side.close()
+        for seg_fp in table.pop('segs', {}).values():
+            seg_fp.close()
+        if 'fp' in table:
+            table.pop('fp').close()
+        self._close_read_fps(fn_)
+
+    def _close_read_fps(self, fn_):
+        '''
+        Close the free read handles of the table, the handles which are in
+        use are closed by their readers
+        '''
+        for pool in self.read_fps.pop(fn_, {}).values():
+            while pool:
+                try:
+                    pool.pop()[0].close()
+                except IndexError:
+                    break
+
+    def _write_header(self, table):
+        '''
+        Write the header of an open table back to the table file
+        '''
+        header = dict(
+            (field, value) for field, value in table.items()
+            if field not in HEADER_MEM)
+        header_entry = '{0}{1}'.format(msgpack.dumps(header), HEADER_DELIM)
+        if len(header_entry) > table['header_len']:
+            raise ValueError('The table header does not fit in the header_len')
+        fp_ = self._fp(table)
+        fp_.seek(0)
+        fp_.write(header_entry)
+        table['dirty'] = False
+        self._wrote(table)
+
+    def table_keys(self, table):
+        '''
+        Return the number of occupied buckets in the table, tables created
+        before the key count was kept in the header are counted once from
+        the occupancy bitmap
+        '''
+        if 'keys' not in table:
+            table['keys'] = self._occ_count(table)
+        return table['keys']
+
+    def _count_keys(self, table, num):
+        '''
+        Add num to the key count of the table and check the table load
+        '''
+        if 'keys' not in table and not self.resize_load:
+            return
+        table['keys'] = self.table_keys(table) + num
+        table['dirty'] = True
+        if table['keys'] % HEADER_SYNC == 0:
+            self._write_header(table)
+        if self.resize_load and num > 0:
+            if table['keys'] > self.resize_load * (table['hash_limit'] + 1):
+                self.overloaded.add(os.path.dirname(table['fn']))
+
+    def table_fns(self, fn_root, prefix='sorbic_table_'):
+        '''
+        Return the table files in the directory with the given prefix in
+        table number order
+        '''
+        fns = []
+        if not os.path.isdir(fn_root):
+            return fns
+        for fn_ in os.listdir(fn_root):
+            if not fn_.startswith(prefix):
+                continue
+            num = fn_[len(prefix):]
+            if not num.isdigit():
+                continue
+            fns.append((int(num), os.path.join(fn_root, fn_)))
+        return [fn_ for _, fn_ in sorted(fns)]
+
+    def dir_root(self, d_key):
+        '''
+        Return the directory which holds the tables of the given key
+        directory
+        '''
+        if not d_key or d_key == self.key_delim:
+            return self.root
+        return self.entry_root('{0}/blank'.format(d_key))
+
+    def close_table(self, fn_):
+        '''
+        Close the named table and forget the cached header
+        '''
+        with self.table_lock:
+            self.headers.pop(fn_, None)
+            table = self.tables.pop(fn_)
+            if table is not None:
+                self._release_table(fn_, table)
+            self.unflushed.pop(fn_, None)
+            self._close_read_fps(fn_)
+
+    def refresh_dir(self, fn_root):
+        '''
+        Forget the cached headers and handles of the tables in the directory,
+        used when the tables have been changed by another process
+        '''
+        for fn_ in list(self.headers):
+            if os.path.dirname(fn_) == fn_root:
+                self.close_table(fn_)
+        with self.table_lock:
+            index = self.key_indexes.pop(fn_root)
+        if index is not None:
+            index.close()
+        self._forget_dicts(lambda dict_root: dict_root == fn_root)
+
+    def close(self):
+        '''
+        Close all open tables
+        '''
+        for fn_ in list(self.tables):
+            self.close_table(fn_)
+        self.headers.clear()
+        self._flush_key_indexes(close=True)
+
+    def table_cache_stats(self):
+        '''
+        Return the hit, miss and eviction stats of the open table cache
+        '''
+        return self.tables.stats()
+
+    def flush(self, headers=False):
+        '''
+        Flush the buffered writes of the open tables so that they can be
+        seen by the read handles, with headers the changed table headers are
+        written as well so that other processes see them
+        '''
+        for fn_ in list(self.unflushed):
+            self._flush_table(fn_, headers)
+        self._flush_key_indexes()
+
+    def _flush_key_indexes(self, sync=False, close=False):
+        '''
+        Write out the logs of the key indexes in memory
+        '''
+        with self.table_lock:
+            for fn_root in self.key_indexes:
+                index = self.key_indexes[fn_root]
+                index.flush(sync)
+                if close:
+                    self.key_indexes.pop(fn_root)
+                    index.close()
+
+    def _flush_table(self, fn_, headers=False):
+        '''
+        Flush the buffered writes of the table and its data segments
+        '''
+        try:
+            table = self.tables[fn_]
+        except KeyError:
+            # Evicted, closing the handles flushed them
+            table = {}
+        if headers and table.get('dirty'):
+            self._write_header(table)
+        fps = [table.get('fp')] + list(table.get('segs', {}).values())
+        for fp_ in filter(None, fps):
+            try:
+                fp_.flush()
+            except ValueError:
+                # Closed by an eviction in another thread, which flushed it
+                pass
+        # Only marked as flushed once the data is out, a concurrent reader
+        # which no longer sees the mark reads the flushed data
+        self._wrote(table)
+        self.unflushed.pop(fn_, None)
+
+    def _wrote(self, table):
+        '''
+        Note that the files of the table changed, the buffered read handles
+        drop what they read before the change
+        '''
+        table['wgen'] = table.get('wgen', 0) + 1
+
+    def _buffered(self, table, fp_, fn_, pos, size):
+        '''
+        Note the write of size bytes at pos to the named file of the table,
+        the buffered range is flushed when the write does not follow it
+        '''
+        ranges = self.unflushed.get(table['fn'])
+        if ranges is None:
+            ranges = self.unflushed.setdefault(table['fn'], {})
+        last = ranges.get(fn_)
+        if last is not None and last[1] == pos:
+            ranges[fn_] = (last[0], pos + size)
+            return
+        if last is not None:
+            fp_.flush()
+            self._wrote(table)
+        ranges[fn_] = (pos, pos + size)
+
+    def _read_pools(self, table):
+        '''
+        Return the pools of read only handles for the table file and its
+        data segments
+        '''
+        pools = self.read_fps.get(table['fn'])
+        if pools is None:
+            with self.table_lock:
+                # Pools are only kept for open tables, so that evicting the
+                # table closes them
+                self._open_hash_table(table['fn'])
+                pools = self.read_fps.setdefault(table['fn'], {})
+        return pools
+
+    def _pread(self, table, pos, size, fn_=None):
+        '''
+        Read size bytes from the table file, or the named data segment of the
+        table, at the given position without moving a shared file position
+        '''
+        t_fn = table['fn']
+        fn_ = fn_ if fn_ else t_fn
+        ranges = self.unflushed.get(t_fn)
+        if ranges:
+            last = ranges.get(fn_)
+            if last is not None and pos < last[1] and last[0] < pos + size:
+                self._flush_table(t_fn)
+        pools = self.read_fps.get(t_fn)
+        if pools is None:
+            pools = self._read_pools(table)
+        pool = pools.get(fn_)
+        if pool is None:
+            pool = pools.setdefault(fn_, [])
+        # The generation is taken before the read, a change made during the
+        # read resets the handle on its next use
+        gen = table.get('wgen', 0)
+        try:
+            fp_, last = pool.pop()
+        except IndexError:
+            fp_, last = io.open(fn_, 'rb'), gen
+        try:
+            if HAS_PREAD:
+                return os.pread(fp_.fileno(), size, pos)
+            if last != gen:
+                # Seeking to the end drops the buffered bytes, which can be
+                # older than the change
+                fp_.seek(0, 2)
+            fp_.seek(pos)
+            return fp_.read(size)
+        finally:
+            if self.read_fps.get(t_fn) is pools:
+                pool.append((fp_, gen))
+            else:
+                # The table was evicted during the read
+                fp_.close()
+
+    def sync(self):
+        '''
+        Flush and fsync every table, and the data segments of the tables,
+        written to since the last sync
+        '''
+        for fn_ in sorted(self.unsynced):
+            if fn_ in self.tables:
+                table = self.tables[fn_]
+                if table.get('dirty'):
+                    self._write_header(table)
+                if 'map' in table:
+                    table['map'].flush()
+                fps = [table['fp']] + list(table.get('segs', {}).values())
+                for fp_ in fps:
+                    fp_.flush()
+                    os.fsync(fp_.fileno())
+                continue
+            fns = [seg_fn for _, seg_fn in self._seg_fns(fn_)]
+            if os.path.isfile(fn_):
+                fns.append(fn_)
+            for sync_fn in fns:
+                fd_ = os.open(sync_fn, os.O_RDONLY)
+                try:
+                    os.fsync(fd_)
+                finally:
+                    os.close(fd_)
+        self.unsynced.clear()
+        self._flush_key_indexes(sync=True)
+
+    def restore_bucket(self, fn_, pos, raw):
+        '''
+        Write back the logged contents of a bucket, the key count of the
+        table is dropped so that it is counted again when needed
+        '''
+        if not os.path.isfile(fn_):
+            return
+        table = self.get_hash_table(fn_)
+        self._write_bucket(table, pos, raw)
+        if table.pop('keys', None) is not None:
+            table['dirty'] = True
+
+    def _fp(self, table):
+        '''
+        Return the file handle for the table, reopening it if it has been
+        evicted from the open table cache
+        '''
+        if 'fp' not in table:
+            return self._open_hash_table(table['fn'])['fp']
+        return table['fp']
+
+    def _seg_fn(self, fn_, seg):
+        '''
+        Return the name of the data segment file of the table
+        '''
+        prefix, num = os.path.basename(fn_).rsplit('_table_', 1)
+        return os.path.join(
+            os.path.dirname(fn_),
+            '{0}_data_{1}_{2}.seg'.format(prefix, num, seg))
+
+    def _seg_fns(self, fn_):
+        '''
+        Return the (seg, file name) pairs of the data segments of the table
+        in segment order
+        '''
+        prefix = os.path.basename(self._seg_fn(fn_, ''))[:-4]
+        fns = []
+        dirname = os.path.dirname(fn_)
+        if not os.path.isdir(dirname):
+            return fns
+        for seg_fn in os.listdir(dirname):
+            if not seg_fn.startswith(prefix) or not seg_fn.endswith('.seg'):
+                continue
+            seg = seg_fn[len(prefix):-4]
+            if seg.isdigit():
+                fns.append((int(seg), os.path.join(dirname, seg_fn)))
+        return sorted(fns)
+
+    def _seg_fp(self, table, seg):
+        '''
+        Return the open file handle of the data segment
+        '''
+        self._fp(table)
+        segs = table.setdefault('segs', {})
+        if seg not in segs:
+            seg_fn = self._seg_fn(table['fn'], seg)
+            mode = 'r+b' if os.path.isfile(seg_fn) else 'w+b'
+            segs[seg] = io.open(seg_fn, mode)
+        return segs[seg]
+
+    def _data_fp(self, table, pos):
+        '''
+        Return the file handle and offset which hold the data position
+        '''
+        if not table.get('data_logs'):
+            return self._fp(table), pos
+        return self._seg_fp(table, pos >> SEG_SHIFT), pos & SEG_MASK
+
+    def _data_fn(self, table, pos):
+        '''
+        Return the name of the file which holds the data position
+        '''
+        if not table.get('data_logs'):
+            return table['fn']
+        return self._seg_fn(table['fn'], pos >> SEG_SHIFT)
+
+    def _read_at(self, table, pos, size):
+        '''
+        Read size bytes of data from the table at the given position
+        '''
+        if not table.get('data_logs'):
+            return self._pread(table, pos, size)
+        return self._pread(
+            table,
+            pos & SEG_MASK,
+            size,
+            self._seg_fn(table['fn'], pos >> SEG_SHIFT))
+
+    def _write_at(self, table, pos, raw):
+        '''
+        Write the raw string into the table data at the given position
+        '''
+        self.unsynced.add(table['fn'])
+        fp_, f_pos = self._data_fp(table, pos)
+        self._buffered(table, fp_, self._data_fn(table, pos), f_pos, len(raw))
+        fp_.seek(f_pos)
+        fp_.write(raw)
+
+    def _end(self, table):
+        '''
+        Return the position that the next append to the table data will be
+        written to. Data segments are rolled over once they reach the
+        segment_size, so a single append can run past it
+        '''
+        if not table.get('data_logs'):
+            fp_ = self._fp(table)
+            fp_.seek(0, 2)
+            return fp_.tell()
+        if 'seg' not in table:
+            segs = self._seg_fns(table['fn'])
+            table['seg'] = segs[-1][0] if segs else 1
+        fp_ = self._seg_fp(table, table['seg'])
+        fp_.seek(0, 2)
+        end = fp_.tell()
+        if end >= table['segment_size']:
+            table['seg'] += 1
+            end = 0
+        return (table['seg'] << SEG_SHIFT) | end
+
+    def _append(self, table, raw):
+        '''
+        Append the raw string to the end of the table data and return the
+        position it was written to
+        '''
+        self.unsynced.add(table['fn'])
+        start = self._end(table)
+        fp_, pos = self._data_fp(table, start)
+        self._buffered(table, fp_, self._data_fn(table, start), pos, len(raw))
+        if pos != fp_.tell():
+            # The append rolled over to a new data segment
+            fp_.seek(pos)
+        fp_.write(raw)
+        return start
+
+    def table_size(self, table):
+        '''
+        Return the number of bytes used on disk by the table and its data
+        segments
+        '''
+        fp_ = self._fp(table)
+        fp_.seek(0, 2)
+        size = fp_.tell()
+        for seg, _ in self._seg_fns(table['fn']):
+            seg_fp = self._seg_fp(table, seg)
+            seg_fp.seek(0, 2)
+            size += seg_fp.tell()
+        return size
+
+    def remove_table(self, fn_):
+        '''
+        Close and remove the table and its data segments
+        '''
+        self.close_table(fn_)
+        self.unsynced.discard(fn_)
+        for _, seg_fn in self._seg_fns(fn_):
+            os.remove(seg_fn)
+        for ext in SIDECARS:
+            if os.path.exists(self._side_fn(fn_, ext)):
+                os.remove(self._side_fn(fn_, ext))
+        if os.path.exists(fn_):
+            os.remove(fn_)
+
+    def replace_table(self, src, dst):
+        '''
+        Move the table and data segments at src over the table at dst
+        '''
+        self.close_table(src)
+        self.close_table(dst)
+        for _, seg_fn in self._seg_fns(dst):
+            os.remove(seg_fn)
+        for seg, seg_fn in self._seg_fns(src):
+            shutil.move(seg_fn, self._seg_fn(dst, seg))
+        for ext in SIDECARS:
+            if os.path.exists(self._side_fn(src, ext)):
+                shutil.move(self._side_fn(src, ext), self._side_fn(dst, ext))
+            elif os.path.exists(self._side_fn(dst, ext)):
+                os.remove(self._side_fn(dst, ext))
+        shutil.move(src, dst)
+        if src in self.unsynced:
+            self.unsynced.discard(src)
+            self.unsynced.add(dst)
+
+    def _side_fn(self, fn_, ext):
+        '''
+        Return the name of the sidecar file of the table
+        '''
+        return '{0}.{1}'.format(fn_, ext)
+
+    def _side_size(self, table, ext):
+        if ext == 'blm':
+            bits = (table['hash_limit'] + 1) * BLOOM_KEY_BITS
+            return SIDE_HEAD + (bits + 7) // 8
+        return SIDE_HEAD + (table['hash_limit'] + 9) // 8
+
+    def _sidecars(self, table):
+        '''
+        Return the sidecars kept by the table
+        '''
+        if table.get('bloom'):
+            return SIDECARS
+        return ('occ',)
+
+    def _place_new(self, fn_, raw, size):
+        '''
+        Write the raw string padded with nulls to size under a temporary
+        name and link it into place, so that other processes never see the
+        file partially written or truncated. Returns False without touching
+        the file if it already exists
+        '''
+        tmp_fn = '{0}.{1}.tmp'.format(fn_, os.getpid())
+        try:
+            with io.open(tmp_fn, 'w+b') as fp_:
+                fp_.write(raw)
+                fp_.truncate(size)
+            os.link(tmp_fn, fn_)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+            return False
+        finally:
+            if os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+        return True
+
+    def _new_sidecars(self, table):
+        '''
+        Write empty, clean sidecars for a new table. A sidecar which another
+        process already built for the table is kept
+        '''
+        for ext in self._sidecars(table):
+            self._place_new(
+                self._side_fn(table['fn'], ext),
+                'c' + '\0' * (SIDE_HEAD - 1),
+                self._side_size(table, ext))
+
+    def _build_side(self, table, ext):
+        '''
+        Return the bits of the sidecar built from the buckets of the table
+        '''
+        bits = bytearray(self._side_size(table, ext) - SIDE_HEAD)
+        if ext == 'occ':
+            for bucket in self._scan_occupied(table):
+                ind = self._occ_ind(table, bucket['pos'])
+                bits[ind >> 3] |= 1 << (ind & 7)
+            return bits
+        for bucket in self._iter_occupied(table):
+            for ind in self._bloom_bits(table, bucket['key']):
+                bits[ind >> 3] |= 1 << (ind & 7)
+        return bits
+
+    def _side(self, table, ext):
+        '''
+        Return the memory mapped sidecar of the table, a missing or dirty
+        sidecar is rebuilt from the buckets
+        '''
+        side = table.get(ext)
+        if side is not None:
+            return side
+        with self.table_lock:
+            self._fp(table)
+            if ext in table:
+                return table[ext]
+            side_fn = self._side_fn(table['fn'], ext)
+            size = self._side_size(table, ext)
+            clean = False
+            if os.path.isfile(side_fn) and os.path.getsize(side_fn) == size:
+                with io.open(side_fn, 'rb') as fp_:
+                    clean = fp_.read(1) == 'c'
+            if not clean:
+                bits = self._build_side(table, ext)
+                head = 'c' + '\0' * (SIDE_HEAD - 1)
+                if not self._place_new(side_fn, head + bytes(bits), size):
+                    # Rewritten in place, other processes may have it mapped
+                    with io.open(side_fn, 'r+b') as fp_:
+                        fp_.write(head)
+                        fp_.write(bytes(bits))
+                        fp_.truncate(size)
+            with io.open(side_fn, 'r+b') as fp_:
+                table[ext] = mmap.mmap(fp_.fileno(), size)
+            return table[ext]
+
+    def _side_read(self, table, ext, start=SIDE_HEAD, end=None):
+        '''
+        Return the bytes of the sidecar between the offsets. A reader which
+        opens a table can evict a table other readers are using, which
+        closes the sidecar maps, the read is then made from a new map
+        '''
+        while True:
+            side = self._side(table, ext)
+            try:
+                return side[start:end]
+            except ValueError:
+                # The map was closed by another thread
+                continue
+
+    def _side_bit(self, table, ext, ind):
+        '''
+        Return True if the bit is set in the sidecar
+        '''
+        byte_pos = SIDE_HEAD + (ind >> 3)
+        byte = self._side_read(table, ext, byte_pos, byte_pos + 1)
+        return bool(ord(byte) & (1 << (ind & 7)))
+
+    def _side_mark(self, table, ext, ind, value=True):
+        '''
+        Set or clear the bit in the sidecar
+        '''
+        side = self._side(table, ext)
+        if side[:1] != 'd':
+            # The sidecar is dirty on disk before any bucket can change
+            side[:1] = 'd'
+            side.flush()
+        byte_pos = SIDE_HEAD + (ind >> 3)
+        byte = ord(side[byte_pos:byte_pos + 1])
+        if value:
+            byte |= 1 << (ind & 7)
+        else:
+            byte &= ~(1 << (ind & 7))
+        side[byte_pos:byte_pos + 1] = struct.pack('B', byte)
+
+    def _occ_ind(self, table, pos):
+        return (pos - table['header_len']) // table['bucket_size']
+
+    def _occ_count(self, table):
+        '''
+        Return the number of buckets marked in the occupancy bitmap
+        '''
+        bits = self._side_read(table, 'occ')
+        if not bits.strip('\0'):
+            return 0
+        return bin(int(binascii.hexlify(bits), 16)).count('1')
+
+    def _bloom_bits(self, table, c_key):
+        '''
+        Return the bits of the Bloom filter of the table for the crypt key
+        '''
+        size = (self._side_size(table, 'blm') - SIDE_HEAD) * 8
+        first, step = struct.unpack('>QQ', hashlib.md5(c_key).digest())
+        step |= 1
+        return [(first + ind * step) % size for ind in range(table['bloom'])]
+
+    def _bloom_has(self, table, c_key):
+        '''
+        Return False if the crypt key is not in the table
+        '''
+        for ind in self._bloom_bits(table, c_key):
+            if not self._side_bit(table, 'blm', ind):
+                return False
+        return True
+
+    def _bucket_pos(self, table, c_key):
+        '''
+        Return the bucket position for the crypt key in the given table
+        '''
+        return _calc_pos(
+            c_key,
+            table['hash_limit'],
+            table['bucket_size'],
+            table['header_len'],
+            table.get('pos_hash'))
+
+    def _read_raw_bucket(self, table, pos):
+        '''
+        Return the raw bucket string at the given position
+        '''
+        if self.held:
+            raw = self.held.get((table['fn'], pos))
+            if raw is not None:
+                return raw
+        table_map = table.get('map')
+        if table_map is not None:
+            try:
+                return table_map[pos:pos + table['bucket_size']]
+            except ValueError:
+                # The map was closed by another thread
+                pass
+        return self._pread(table, pos, table['bucket_size'])
+
+    def _read_bucket(self, table, pos):
+        '''
+        Return the unpacked bucket components at the given position
+        '''
+        try:
+            comps = struct.unpack(
+                table['fmt'],
+                self._read_raw_bucket(table, pos))
+            if comps[0] == '\0' * self.key_size:
+                comps = (None, None, -1)
+        except struct.error:
+            comps = (None, None, -1)
+        return comps
+
+    def _write_bucket(self, table, pos, raw):
+        '''
+        Write the raw bucket string to the given position, a bucket which
+        the journal logged is held back while buckets are held
+        '''
+        logged = self.journal is not None and self.journal(table, pos)
+        # Marking can rebuild the sidecars, which flushes the table, so the
+        # bucket is marked before the table is queued for flushing
+        occupied = raw != '\0' * len(raw)
+        if occupied:
+            self._side_mark(table, 'occ', self._occ_ind(table, pos))
+            if table.get('bloom'):
+                key_ind = list(table['fmt_map']).index('key')
+                c_key = struct.unpack(table['fmt'], raw)[key_ind]
+                for ind in self._bloom_bits(table, c_key):
+                    self._side_mark(table, 'blm', ind)
+        if logged and self.held is not None:
+            self.held[(table['fn'], pos)] = raw
+        else:
+            self._put_bucket(table, pos, raw)
+        if not occupied:
+            self._side_mark(table, 'occ', self._occ_ind(table, pos), False)
+
+    def _put_bucket(self, table, pos, raw):
+        self.unsynced.add(table['fn'])
+        fp_ = self._fp(table)
+        if 'map' in table:
+            # The map writes to the page cache, the read handles see it
+            table['map'][pos:pos + len(raw)] = raw
+            self._wrote(table)
+        else:
+            self._buffered(table, fp_, table['fn'], pos, len(raw))
+            fp_.seek(pos)
+            fp_.write(raw)
+
+    def release_buckets(self):
+        '''
+        Write out the held buckets, called once the log records of their
+        old contents are durable
+        '''
+        if not self.held:
+            return
+        held, self.held = self.held, {}
+        for fn_, pos in sorted(held):
+            self._put_bucket(self.get_hash_table(fn_), pos, held[(fn_, pos)])
+
     def raw_crypt_key(self, key):
         '''
         Return the crypted key
@@ -159,32 +1106,69 @@ class HDHT(object):
         key = key.strip(self.key_delim)
         return key[key.rfind(self.key_delim):].replace(self.key_delim, os.sep).lstrip(self.key_delim)
 
-    def get_hash_table(self, fn_):
+    def get_hash_table(self, fn_, hash_limit=None, like=None):
         '''
-        Create a new hash table at the given location
+        Create a new hash table at the given location, new tables are created
+        with the given hash_limit or the index hash_limit. A new table made
+        like another table places the keys in the same bucket positions
         '''
+        table = self.tables.peek(fn_)
+        if table is not None:
+            return table
+        if fn_ in self.headers:
+            return self._open_hash_table(fn_)
+        with self.table_lock:
+            return self.__create_hash_table(fn_, hash_limit, like)
+
+    def __create_hash_table(self, fn_, hash_limit, like=None):
         if os.path.exists(fn_):
             return self._open_hash_table(fn_)
         dirname = os.path.dirname(fn_)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
+        if hash_limit is None:
+            hash_limit = self.hash_limit
         header = {
             'hash': self.key_hash,
-            'hash_limit': self.hash_limit,
+            'hash_limit': hash_limit,
             'header_len': self.header_len,
             'fmt': self.fmt,
             'bucket_size': self.bucket_size,
             'fmt_map': self.fmt_map,
             'dir': os.path.dirname(fn_),
             'num': int(fn_[fn_.rindex('_') + 1:]),
+            'pos_hash': POS_HASH,
+            'keys': 0,
             }
+        if self.probe == 'linear':
+            header['layout'] = 'linear'
+            header['probe_limit'] = self.probe_limit
+        if like is not None:
+            for field in POS_FIELDS:
+                header.pop(field, None)
+                if field in like:
+                    header[field] = like[field]
+            hash_limit = header['hash_limit']
+        if self.data_logs:
+            header['data_logs'] = True
+            header['segment_size'] = self.segment_size
+        if self.bloom:
+            header['bloom'] = BLOOM_HASHES
+        if os.path.basename(fn_) == 'sorbic_table_0':
+            index = sorbic.ind.keys.KeyIndex(dirname)
+            if not index.exists():
+                index.build([])
         header_entry = '{0}{1}'.format(msgpack.dumps(header), HEADER_DELIM)
-        fp_ = io.open(fn_, 'w+b')
-        fp_.write(header_entry)
-        fp_.seek(((self.hash_limit + 2) * self.bucket_size) + self.header_len)
-        fp_.write('\0')
-        header['fp'] = fp_
-        self.tables[fn_] = header
+        size = ((hash_limit + 2) * self.bucket_size) + header['header_len']
+        if not self._place_new(fn_, header_entry, size + 1):
+            # Another process created the table first
+            return self._open_hash_table(fn_)
+        header['fp'] = io.open(fn_, 'r+b')
+        header['fn'] = fn_
+        self._new_sidecars(header)
+        self._map_table(header)
+        self.headers[fn_] = header
+        self.tables.set(fn_, header)
         return header
 
     def index_entry(self, key, id_, type_, prev, **kwargs):
@@ -214,74 +1198,173 @@ class HDHT(object):
             ret[fmt_map[ind]] = comps[ind]
         return ret
 
-    def get_table_entry(self, key, c_key):
+    def _probe_positions(self, table, c_key):
         '''
-        Return the entry location for the given key and crypt key pair
+        Return the bucket positions to probe for the crypt key in the given
+        table. Chained tables only have the one position, linear tables probe
+        the following buckets up to the probe limit
         '''
-        root = self.entry_root(key)
-        num = 0
-        while True:
-            table_fn = os.path.join(root, 'sorbic_table_{0}'.format(num))
-            table = self.get_hash_table(table_fn)
-            pos = _calc_pos(
-                c_key,
-                table['hash_limit'],
-                table['bucket_size'],
-                table['header_len'])
-            table['fp'].seek(pos)
-            bucket = table['fp'].read(table['bucket_size'])
-            try:
-                comps = struct.unpack(table['fmt'], bucket)
-                if comps[0] == '\0' * self.key_size:
-                    comps = (None, None, -1)
-            except struct.error:
-                comps = (None, None, -1)
-            ret = self._table_map(comps, table['fmt_map'])
+        pos = self._bucket_pos(table, c_key)
+        if table.get('layout') != 'linear':
+            return [pos]
+        slots = table['hash_limit'] + 1
+        slot = (pos - table['header_len']) // table['bucket_size']
+        return [
+            ((slot + ind) % slots) * table['bucket_size'] + table['header_len']
+            for ind in range(min(table['probe_limit'], slots))]
+
+    def _probe_table(self, table, c_key, pending=None):
+        '''
+        Return the bucket entry in the given table which holds the crypt key
+        or the free bucket it should be written to. If the probed buckets
+        are all held by other keys return None. When the Bloom filter of the
+        table does not hold the crypt key the buckets are not read, the
+        occupancy bitmap tells the free buckets from those of other keys
+        '''
+        missing = table.get('bloom') and not self._bloom_has(table, c_key)
+        for pos in self._probe_positions(table, c_key):
+            if pending and (table['fn'], pos) in pending:
+                ret = dict(pending[(table['fn'], pos)])
+            elif missing:
+                if self._side_bit(table, 'occ', self._occ_ind(table, pos)):
+                    continue
+                ret = self._table_map((None, None, -1), table['fmt_map'])
+            else:
+                comps = self._read_bucket(table, pos)
+                ret = self._table_map(comps, table['fmt_map'])
             ret['pos'] = pos
-            ret['tfn'] = table['fp'].name
-            ret['num'] = num
             if ret['key'] is None:
                 return ret
             if ret['key'] == c_key:
                 return ret
-            # Adding these lines in will show keys that collide
-            # in the hash table in the tests
-            #print('***************')
-            #print(self._read_index_entry(table, ret['prev']))
-            #print(key)
-            #print('***************')
+        return None
+
+    def get_table_entry(
+            self,
+            key,
+            c_key,
+            pending=None,
+            prefix='sorbic_table_',
+            hash_limit=None):
+        '''
+        Return the entry location for the given key and crypt key pair,
+        pending maps (table file, position) pairs to bucket entries which have
+        been claimed but not yet written. New overflow tables are created
+        with the hash_limit of the table before them
+        '''
+        root = self.entry_root(key)
+        num = 0
+        while True:
+            table_fn = os.path.join(root, '{0}{1}'.format(prefix, num))
+            table = self.get_hash_table(table_fn, hash_limit)
+            hash_limit = table['hash_limit']
+            ret = self._probe_table(table, c_key, pending)
+            if ret is not None:
+                ret['tfn'] = table_fn
+                ret['num'] = num
+                return ret
             num += 1
 
+    def get_table_entries(self, keys):
+        '''
+        Return the table entries for many keys at once. The buckets are read
+        one table at a time in position order, keys which collide move on to
+        the next table in the following pass
+        '''
+        rets = [None] * len(keys)
+        todo = []
+        for ind, key in enumerate(keys):
+            c_key = self.raw_crypt_key(key)
+            todo.append((ind, key, c_key, self.entry_root(key)))
+        num = 0
+        while todo:
+            locs = []
+            for ind, key, c_key, root in todo:
+                table_fn = os.path.join(root, 'sorbic_table_{0}'.format(num))
+                table = self.get_hash_table(table_fn)
+                pos = self._bucket_pos(table, c_key)
+                locs.append((table_fn, pos, ind, key, c_key, root))
+            todo = []
+            for table_fn, pos, ind, key, c_key, root in sorted(locs):
+                table = self.get_hash_table(table_fn)
+                ret = self._probe_table(table, c_key)
+                if ret is None:
+                    todo.append((ind, key, c_key, root))
+                    continue
+                ret['tfn'] = table_fn
+                ret['num'] = num
+                rets[ind] = ret
+            num += 1
+        return rets
+
+    def get_index_entries(self, keys):
+        '''
+        Return the newest index entries for many keys, the index entries are
+        read in file offset order. Keys which are not found return None
+        '''
+        table_entries = self.get_table_entries(keys)
+        rets = [None] * len(keys)
+        locs = []
+        for ind, table_entry in enumerate(table_entries):
+            if not table_entry['key'] or not table_entry['prev']:
+                continue
+            locs.append((table_entry['tfn'], table_entry['prev'], ind))
+        for tfn, prev, ind in sorted(locs):
+            table = self.get_hash_table(tfn)
+            rets[ind] = {
+                'table': table_entries[ind],
+                'data': self._read_index_entry(table, prev)}
+        return rets
+
     def _read_index_entry(self, table, prev):
-        table['fp'].seek(prev)
-        table['fp'].seek(prev)
-        data_head = struct.unpack(IND_HEAD_FMT, table['fp'].read(3))
-        index = msgpack.loads(table['fp'].read(data_head[0]))
-        index['_status'] = data_head[1]
+        raw = self._read_at(table, prev, IND_READ)
+        size, status = struct.unpack_from(IND_HEAD_FMT, raw)
+        end = IND_HEAD_SIZE + size
+        if len(raw) < end:
+            raw += self._read_at(table, prev + len(raw), end - len(raw))
+        index = msgpack.loads(raw[IND_HEAD_SIZE:end])
+        index['_status'] = status
         return index
 
-    def get_index_entry(self, key, id_=None, count=None):
+    def get_index_entry(self, key, id_=None, count=None, rev=None):
         '''
-        Get the data entry for the given key
+        Get the data entry for the given key, the newest entry, the entry
+        with the given id or revision, or the newest count entries
         '''
         ret = {}
         c_key = self.raw_crypt_key(key)
         table_entry = self.get_table_entry(key, c_key)
         if not table_entry['key']:
             return None
-        table = self.tables[table_entry['tfn']]
+        table = self.get_hash_table(table_entry['tfn'])
         prev = table_entry['prev']
         if prev == 0:
             # There is no data, stubbed out for deletion, return None
             return None
         ret['table'] = table_entry
+        if rev is not None and not 0 <= rev <= table_entry['rev']:
+            return None
+        if id_ or rev is not None:
+            found = self._find_entry(table, prev, id_, rev)
+            if found is not None:
+                ret['data'] = found[1]
+                ret['table']['rev'] = found[1]['r'] - 1
+                return ret
+        rev_ = rev
         rev = table_entry['rev']
         counted = 0
         rets = {'data': [], 'table': table_entry}
         while True:
             index_entry = self._read_index_entry(table, prev)
             ret['data'] = index_entry
-            if id_:
+            if rev_ is not None:
+                if rev == rev_:
+                    return ret
+                if not index_entry['p']:
+                    return None
+                prev = index_entry['p']
+                rev -= 1
+            elif id_:
                 if index_entry['id'] == id_:
                     ret['table']['rev'] = rev
                     return ret
@@ -295,78 +1378,660 @@ class HDHT(object):
                     rets['data'].append(index_entry)
                     counted += 1
                     prev = index_entry['p']
-                    if prev is None:
+                    if not prev:
                         return rets
                 else:
                     return rets
             else:
                 return ret
 
+    def _find_entry(self, table, prev, id_=None, rev=None):
+        '''
+        Follow the skip links from the newest index entry at prev to the
+        entry with the given id or revision. Return the offset and index
+        entry, or None if the entry can not be found along the links and
+        the chain has to be walked
+        '''
+        index_entry = self._read_index_entry(table, prev)
+        if rev is not None:
+            found = self._skip_back(table, prev, index_entry, rev + 1)
+        else:
+            target = _id_time(id_)
+            if target is None:
+                return None
+            found = self._skip_back(
+                table,
+                prev,
+                index_entry,
+                target,
+                lambda entry: _id_time(entry['id']))
+        if found is None or (id_ and found[1]['id'] != id_):
+            return None
+        return found
+
+    def _skip_back(self, table, prev, index_entry, target, rank=None):
+        '''
+        Follow the skip links back from the index entry at prev to the entry
+        whose rank is target, taking the longest link which does not pass
+        it. Entries are ranked by revision, which is known for the linked
+        entries without reading them, or by the passed rank function whose
+        values must fall along the chain. Return the offset and the index
+        entry, or None
+        '''
+        limit = None
+        while True:
+            here = index_entry.get('r') if rank is None else rank(index_entry)
+            if here is None or here < target:
+                return None
+            if here == target:
+                return prev, index_entry
+            links = [index_entry['p']] + index_entry.get('tw', [])
+            if limit is not None:
+                links = links[:limit]
+            for level in range(len(links) - 1, -1, -1):
+                if not links[level]:
+                    continue
+                if rank is None and index_entry['r'] - (1 << level) < target:
+                    limit = level
+                    continue
+                entry = self._read_index_entry(table, links[level])
+                if rank is not None:
+                    there = rank(entry)
+                    if there is None or there < target:
+                        # Nothing past this link is newer than the target
+                        limit = level
+                        continue
+                prev, index_entry = links[level], entry
+                break
+            else:
+                return None
+
+    def _skip_links(self, table, table_entry, written=None):
+        '''
+        Return the revision number and the skip links of a new index entry
+        written over the table entry. The links are found by following the
+        links of the entries below it, written maps the offsets of the
+        entries of a batch which has not been appended yet to the entries
+        '''
+        rev = table_entry['rev'] + 2
+        links = []
+        prev = table_entry['prev']
+        level = 1
+        while prev and not rev & ((1 << level) - 1):
+            if written and prev in written:
+                entry = written[prev]
+            else:
+                entry = self._read_index_entry(table, prev)
+            if entry.get('r') != rev - (1 << (level - 1)):
+                # The chain was written before the skip links
+                break
+            if level == 1:
+                link = entry['p']
+            else:
+                link = (entry.get('tw', []) + [0] * level)[level - 2]
+            if not link:
+                break
+            links.append(link)
+            prev = link
+            level += 1
+        return rev, links
+
+    def _iter_chunks(self, table):
+        '''
+        Yield the position and raw string of the bucket region of the table
+        in chunks of SCAN_BUCKETS buckets
+        '''
+        b_size = table['bucket_size']
+        seek_lim = ((table['hash_limit'] + 2) * b_size) + table['header_len']
+        pos = table['header_len']
+        while pos + b_size <= seek_lim:
+            size = min(SCAN_BUCKETS * b_size, seek_lim - pos)
+            table_map = table.get('map')
+            chunk = None
+            if table_map is not None:
+                try:
+                    chunk = table_map[pos:pos + size]
+                except ValueError:
+                    pass
+            if chunk is None:
+                chunk = self._pread(table, pos, size)
+            if self.held:
+                chunk = self._held_chunk(table, pos, chunk)
+            yield pos, chunk
+            pos += size
+
+    def _held_chunk(self, table, pos, chunk):
+        '''
+        Return the chunk of the bucket region with the held buckets in it
+        written over
+        '''
+        end = pos + len(chunk)
+        for (fn_, b_pos), raw in self.held.items():
+            if fn_ == table['fn'] and pos <= b_pos < end:
+                start = b_pos - pos
+                chunk = chunk[:start] + raw + chunk[start + len(raw):]
+        return chunk
+
+    def _iter_buckets(self, table):
+        '''
+        Yield the position and raw string of every bucket in the table
+        '''
+        b_size = table['bucket_size']
+        for pos, chunk in self._iter_chunks(table):
+            for start in range(0, len(chunk) - b_size + 1, b_size):
+                yield pos + start, chunk[start:start + b_size]
+
+    def _bucket_dtype(self, table):
+        '''
+        Return the numpy dtype of the buckets of the table, or None if numpy
+        is not available or can not represent the bucket fmt
+        '''
+        if not HAS_NUMPY:
+            return None
+        d_key = (table['fmt'], tuple(table['fmt_map']))
+        if d_key in self._dtypes:
+            return self._dtypes[d_key]
+        dtype = None
+        fmt = table['fmt']
+        fields = re.findall(r'(\d*)(\w)', fmt[1:])
+        if fmt[:1] in ('>', '<', '!') and len(fields) == len(table['fmt_map']):
+            order = '<' if fmt[0] == '<' else '>'
+            formats = []
+            for count, code in fields:
+                if code == 's':
+                    formats.append('S{0}'.format(count or 1))
+                elif code in NUMPY_CODES and count in ('', '1'):
+                    formats.append(order + NUMPY_CODES[code])
+                else:
+                    break
+            else:
+                dtype = numpy.dtype({
+                    'names': list(table['fmt_map']),
+                    'formats': formats})
+                if dtype.itemsize != table['bucket_size']:
+                    dtype = None
+                elif 'key' not in dtype.names:
+                    dtype = None
+        self._dtypes[d_key] = dtype
+        return dtype
+
     def _get_table_entries(self, fn_):
         '''
         Return the table entries in a given table
         '''
         table = self.get_hash_table(fn_)
-        table['fp'].seek(table['header_len'])
-        seek_lim = ((self.hash_limit + 2) * self.bucket_size) + self.header_len
-        while True:
-            bucket = table['fp'].read(table['bucket_size'])
-            if table['fp'].tell() > seek_lim:
-                break
-            if bucket.startswith('\0'):
+        for ret in self._iter_occupied(table):
+            if not ret['prev']:
                 continue
-            try:
-                comps = struct.unpack(table['fmt'], bucket)
-                if comps[0] == '\0' * self.key_size:
-                    comps = (None, None, -1)
-            except struct.error:
-                comps = (None, None, -1)
-            if not comps[0]:
-                continue
-            ret = self._table_map(comps, table['fmt_map'])
-            table_start = table['fp'].tell()
             data = self._read_index_entry(table, ret['prev'])
-            table['fp'].seek(table_start)
+            ret['c_key'] = ret['key']
             ret['key'] = data['key']
             yield ret
 
-    def rm_key(self, key, id_=None):
+    def _iter_occupied(self, table):
+        '''
+        Yield the bucket entry of every occupied bucket in the table without
+        reading the index entries, removed key stubs have a prev of 0. Sparse
+        tables are read through the occupancy bitmap
+        '''
+        keys = table.get('keys')
+        if keys is None:
+            keys = self._occ_count(table)
+        if keys * OCC_SPARSE < table['hash_limit'] + 2:
+            for ret in self._iter_occupied_occ(table):
+                yield ret
+            return
+        for ret in self._scan_occupied(table):
+            yield ret
+
+    def _iter_occupied_occ(self, table):
+        '''
+        Yield the occupied buckets of the table found in the occupancy
+        bitmap, only the marked buckets are read
+        '''
+        bits = self._side_read(table, 'occ')
+        empty_key = '\0' * self.key_size
+        key_ind = list(table['fmt_map']).index('key')
+        for match in OCC_BYTE.finditer(bits):
+            byte = ord(match.group())
+            for bit in range(8):
+                if not byte & (1 << bit):
+                    continue
+                ind = (match.start() << 3) | bit
+                pos = table['header_len'] + ind * table['bucket_size']
+                comps = struct.unpack(
+                    table['fmt'],
+                    self._read_raw_bucket(table, pos))
+                if comps[key_ind] == empty_key:
+                    continue
+                ret = self._table_map(comps, table['fmt_map'])
+                ret['pos'] = pos
+                yield ret
+
+    def _scan_occupied(self, table):
+        '''
+        Yield the occupied buckets of the table by scanning the whole bucket
+        region
+        '''
+        dtype = self._bucket_dtype(table)
+        if dtype is not None:
+            for ret in self._iter_occupied_vector(table, dtype):
+                yield ret
+            return
+        empty = '\0' * table['bucket_size']
+        empty_key = '\0' * self.key_size
+        key_ind = list(table['fmt_map']).index('key')
+        for pos, bucket in self._iter_buckets(table):
+            if bucket == empty:
+                continue
+            comps = struct.unpack(table['fmt'], bucket)
+            if comps[key_ind] == empty_key:
+                continue
+            ret = self._table_map(comps, table['fmt_map'])
+            ret['pos'] = pos
+            yield ret
+
+    def _iter_occupied_vector(self, table, dtype):
+        '''
+        Yield the occupied buckets of the table, each chunk of the bucket
+        region is checked for buckets with a key in one numpy pass
+        '''
+        b_size = table['bucket_size']
+        key_off = dtype.fields['key'][1]
+        key_end = key_off + self.key_size
+        names = dtype.names
+        for pos, chunk in self._iter_chunks(table):
+            count = len(chunk) // b_size
+            raw = numpy.frombuffer(chunk, numpy.uint8, count * b_size)
+            raw = raw.reshape(count, b_size)
+            occupied = numpy.flatnonzero(raw[:, key_off:key_end].any(axis=1))
+            if not len(occupied):
+                continue
+            rows = numpy.frombuffer(chunk, dtype, count)[occupied].tolist()
+            for ind, row in zip(occupied.tolist(), rows):
+                ret = dict(zip(names, row))
+                # numpy strips the trailing null bytes of the key
+                start = ind * b_size
+                ret['key'] = chunk[start + key_off:start + key_end]
+                ret['pos'] = pos + start
+                yield ret
+
+    def _copy_chain(
+            self,
+            table,
+            bucket,
+            dest,
+            copy_stor,
+            stats,
+            release=None,
+            deferred=None,
+            stub=None):
+        '''
+        Walk the revision chain of the bucket once and write the kept
+        revisions, oldest first, to the table entry returned by calling dest
+        with the key and the bucket. Only the offsets of the kept revisions
+        are held in memory, the stored data of removed revisions is released,
+        or with deferred their table and offset are added to the set so that
+        they are released later by release_deferred. A key with no kept
+        revisions is removed from the key index of its directory, its bucket
+        is passed to stub so that compaction which keeps the bucket positions
+        leaves the keys stored past it reachable
+        '''
+        keeps = []
+        key = None
+        revs = 0
+        prev = bucket['prev']
+        while prev:
+            index_entry = self._read_index_entry(table, prev)
+            key = index_entry['key']
+            revs += 1
+            if index_entry['_status'] == 'k':
+                keeps.append(prev)
+            elif index_entry['_status'] == 'r' and deferred is not None:
+                deferred.add((table['fn'], prev))
+            elif index_entry['_status'] == 'r' and release:
+                head = self._read_at(table, prev, 3)
+                size = struct.unpack(IND_HEAD_FMT, head)[0]
+                self._write_at(
+                    table,
+                    prev,
+                    struct.pack(IND_HEAD_FMT, size, 'd'))
+                self._release_stor(release, table, index_entry)
+            prev = index_entry['p']
+        stats['revs'] += revs
+        stats['kept'] += len(keeps)
+        stats['dropped'] += revs - len(keeps)
+        if not keeps:
+            # Every revision was removed by id, the key is gone
+            index = self.key_index(self.entry_root(key))
+            index.remove(key.strip(self.key_delim))
+            if stub:
+                stub(bucket)
+            return
+        stats['keys'] += 1
+        tte = dest(key, bucket)
+        src = {'tfn': table['fn']}
+        for prev in reversed(keeps):
+            kwargs = self._read_index_entry(table, prev)
+            kwargs.update(copy_stor[kwargs.get('t', 'doc')](
+                {'table': src, 'data': kwargs},
+                tte))
+            for field in ('_status', 'p', 'rev', 'r', 'tw'):
+                kwargs.pop(field, None)
+            key = kwargs.pop('key')
+            id_ = kwargs.pop('id')
+            type_ = kwargs.pop('t', 'doc')
+            prev, _ = self.write_index_entry(tte, key, id_, type_, **kwargs)
+            tte['rev'] = self.write_table_entry(tte, bucket['key'], prev)
+            tte['key'] = bucket['key']
+            tte['prev'] = prev
+
+    def _compact_stats(self, fns, progress):
+        '''
+        Return a fresh compaction stats dict for the given source tables
+        '''
+        stats = {
+            'buckets': 0,
+            'total': 0,
+            'keys': 0,
+            'revs': 0,
+            'kept': 0,
+            'dropped': 0,
+            'bytes_before': 0,
+            'bytes_after': 0,
+            'reclaimed': 0,
+            'grown': 0}
+        for fn_ in fns:
+            table = self.get_hash_table(fn_)
+            stats['total'] += table['hash_limit'] + 2
+            stats['bytes_before'] += self.table_size(table)
+        if progress:
+            progress(dict(stats))
+        return stats
+
+    def _compact_table(
+            self,
+            fn_,
+            dest,
+            copy_stor,
+            stats,
+            progress,
+            stub=None,
+            release=None,
+            deferred=None,
+            pause=None):
+        '''
+        Stream the occupied buckets of one table through _copy_chain,
+        removed key stubs and keys left without revisions are passed to stub
+        and pause is called after every bucket
+        '''
+        table = self.get_hash_table(fn_)
+        base = stats['buckets']
+        last = base
+        for bucket in self._iter_occupied(table):
+            if bucket['prev']:
+                self._copy_chain(
+                    table,
+                    bucket,
+                    dest,
+                    copy_stor,
+                    stats,
+                    release,
+                    deferred,
+                    stub)
+            elif stub:
+                stub(bucket)
+            if pause:
+                pause()
+            offset = bucket['pos'] - table['header_len']
+            stats['buckets'] = base + offset // table['bucket_size']
+            if progress and stats['buckets'] - last >= PROGRESS_STEP:
+                last = stats['buckets']
+                progress(dict(stats))
+        stats['buckets'] = base + table['hash_limit'] + 2
+
+    def _compact_done(self, trans_fns, stats, progress):
+        '''
+        Finish the compaction stats with the size of the new tables. The
+        copied entries of tables written before the skip fields were added
+        grow, so the new tables can be larger. reclaimed holds the bytes
+        saved and grown the bytes added, the other is 0
+        '''
+        for trans_fn in trans_fns:
+            trans = self.get_hash_table(trans_fn)
+            stats['bytes_after'] += self.table_size(trans)
+        saved = stats['bytes_before'] - stats['bytes_after']
+        stats['reclaimed'] = max(saved, 0)
+        stats['grown'] = max(-saved, 0)
+        if progress:
+            progress(dict(stats))
+        return stats
+
+    def compact_table(
+            self,
+            fn_,
+            trans_fn,
+            copy_stor,
+            progress=None,
+            release=None):
         '''
-        Remove a key id_, if no id_ is specified the key is recursively removed
+        Compact the table into trans_fn in a single pass over the buckets,
+        the kept revisions of every key are written into the same bucket
+        position of the new table. copy_stor maps the storage types to the
+        functions which move the stored data and release to the functions
+        which release the data of dropped revisions. Returns the compaction
+        stats
+        '''
+        stats = self._compact_stats([fn_], progress)
+        table = self.get_hash_table(fn_)
+        # The keys keep their bucket positions, so the new table has to
+        # place keys the way the compacted table does, tables written before
+        # the pos_hash or layout fields were added included
+        self.get_hash_table(trans_fn, like=table)
+
+        def dest(key, bucket):
+            return {'tfn': trans_fn,
+                    'num': table['num'],
+                    'key': None,
+                    'prev': None,
+                    'pos': bucket['pos'],
+                    'rev': -1}
+
+        def stub(bucket):
+            self.write_stub(
+                trans_fn,
+                {'pos': bucket['pos'], 'c_key': bucket['key']})
+
+        self._compact_table(
+            fn_,
+            dest,
+            copy_stor,
+            stats,
+            progress,
+            stub,
+            release)
+        return self._compact_done([trans_fn], stats, progress)
+
+    def compact_dir(
+            self,
+            fn_root,
+            hash_limit,
+            copy_stor,
+            progress=None,
+            release=None,
+            deferred=None,
+            pause=None):
+        '''
+        Compact every table in the directory into new trans_table_N tables
+        built with the given hash_limit, removed key stubs are dropped. With
+        deferred the source tables are only read, see _copy_chain, and pause
+        is called between the buckets. Returns the compaction stats
+        '''
+        fns = self.table_fns(fn_root)
+        stats = self._compact_stats(fns, progress)
+
+        def dest(key, bucket):
+            return self.get_table_entry(
+                key,
+                bucket['key'],
+                prefix='trans_table_',
+                hash_limit=hash_limit)
+
+        for fn_ in fns:
+            self._compact_table(
+                fn_,
+                dest,
+                copy_stor,
+                stats,
+                progress,
+                release=release,
+                deferred=deferred,
+                pause=pause)
+        return self._compact_done(
+            self.table_fns(fn_root, 'trans_table_'),
+            stats,
+            progress)
+
+    def recopy_key(self, key, hash_limit, copy_stor, deferred):
+        '''
+        Copy the revisions of the key into the trans tables of its directory
+        again, replacing the copy compact_dir made before the key was
+        written to
+        '''
+        c_key = self.raw_crypt_key(key)
+        tte = self.get_table_entry(
+            key,
+            c_key,
+            prefix='trans_table_',
+            hash_limit=hash_limit)
+        if tte['key'] is not None:
+            # Stub out the earlier copy, the bucket keeps the key so that it
+            # is not counted again
+            trans = self.get_hash_table(tte['tfn'])
+            self._write_bucket(
+                trans,
+                tte['pos'],
+                struct.pack(trans['fmt'], c_key, 0, 0))
+        src = self.get_table_entry(key, c_key)
+        if src['key'] is None or not src['prev']:
+            return
+
+        def dest(key, bucket):
+            tte['prev'] = None
+            tte['rev'] = -1
+            return tte
+
+        self._copy_chain(
+            self.get_hash_table(src['tfn']),
+            src,
+            dest,
+            copy_stor,
+            self._compact_stats([], None),
+            deferred=deferred)
+
+    def release_deferred(self, deferred, release):
+        '''
+        Release the stored data of the removed revisions collected by
+        compact_dir, the revisions which were released since then by the
+        removal of their key are skipped
+        '''
+        for fn_, prev in sorted(deferred):
+            table = self.get_hash_table(fn_)
+            size, status = struct.unpack(
+                IND_HEAD_FMT,
+                self._read_at(table, prev, 3))
+            if status != 'r':
+                continue
+            index_entry = self._read_index_entry(table, prev)
+            self._write_at(table, prev, struct.pack(IND_HEAD_FMT, size, 'd'))
+            self._release_stor(release, table, index_entry)
+
+    def write_stub(self, fn_, entry):
+        '''
+        Write a removed key stub bucket for the given table entry into the
+        named table
+        '''
+        table = self.get_hash_table(fn_)
+        self._write_bucket(
+                table,
+                entry['pos'],
+                struct.pack(table['fmt'], entry['c_key'], 0, 0))
+        self._count_keys(table, 1)
+
+    def _release_stor(self, release, table, index_entry):
+        '''
+        Release the data stored outside of the table for the index entry,
+        release maps the storage types to the release functions
+        '''
+        func = release.get(index_entry.get('t', 'doc')) if release else None
+        if func:
+            func({'table': {'tfn': table['fn']}, 'data': index_entry})
+
+    def rm_key(self, key, id_=None, release=None):
+        '''
+        Remove a key id_, if no id_ is specified the key is recursively removed.
+        The revisions of a removed key can no longer be reached, so their
+        stored data is released through release, removed ids are released
+        when compaction drops them
         '''
         ret = False
         c_key = self.raw_crypt_key(key)
         table_entry = self.get_table_entry(key, c_key)
-        table = self.tables[table_entry['tfn']]
+        table = self.get_hash_table(table_entry['tfn'])
         prev = table_entry['prev']
+        if id_:
+            found = self._find_entry(table, prev, id_)
+            if found is not None:
+                prev = found[0]
         while True:
             stub = True
-            table['fp'].seek(prev)
-            data_head = struct.unpack(IND_HEAD_FMT, table['fp'].read(3))
-            index_entry = msgpack.loads(table['fp'].read(data_head[0]))
+            data_head = struct.unpack(
+                IND_HEAD_FMT,
+                self._read_at(table, prev, 3))
+            index_entry = msgpack.loads(
+                self._read_at(table, prev + 3, data_head[0]))
             if id_:
                 if index_entry['id'] != id_:
                     stub = False
             else:
                 stub = True
             if stub:
-                table['fp'].seek(prev)
-                table['fp'].write(struct.pack(IND_HEAD_FMT, data_head[0], 'r'))
+                # The entry is marked before the data is released so that a
+                # replayed rm never releases it twice
+                if data_head[1] != 'd':
+                    status = 'r' if id_ else 'd'
+                    self._write_at(
+                        table,
+                        prev,
+                        struct.pack(IND_HEAD_FMT, data_head[0], status))
+                    if status == 'd':
+                        self._release_stor(release, table, index_entry)
                 ret = True
                 if id_:
                     break
             prev = index_entry['p']
             if not prev:
                 break
-        if not id_:
+        if not id_ and table.get('layout') == 'linear':
+            # Keys further along the probe sequence may have passed this
+            # bucket, always keep a stub
+            self._write_bucket(
+                    table,
+                    table_entry['pos'],
+                    struct.pack(table['fmt'], table_entry['key'], 0, 0))
+            ret = True
+        elif not id_:
             # Chck if the next table has a collision entry, if so keey this
             # table entry and mark it for removal in a compact call
-            next_fn = '{0}{1}'.format(table['fp'].name[:-1], table['num'] + 1)
+            next_fn = os.path.join(
+                    os.path.dirname(table_entry['tfn']),
+                    'sorbic_table_{0}'.format(table['num'] + 1))
             collision = False
             if os.path.isfile(next_fn):
                 next_table = self.get_hash_table(next_fn)
-                next_table['fp'].seek(table_entry['pos'])
-                next_raw_entry = next_table['fp'].read(next_table['bucket_size'])
+                next_raw_entry = self._read_raw_bucket(
+                        next_table,
+                        self._bucket_pos(next_table, table_entry['key']))
                 if next_raw_entry != '\0' * next_table['bucket_size']:
                     collision = True
             # Stub out the table entry as well
@@ -374,9 +2039,13 @@ class HDHT(object):
                 stub_entry = '\0' * table['bucket_size']
             else:
                 stub_entry = struct.pack(table['fmt'], table_entry['key'], 0, 0)
-            table['fp'].seek(table_entry['pos'])
-            table['fp'].write(stub_entry)
+            self._write_bucket(table, table_entry['pos'], stub_entry)
+            if not collision:
+                self._count_keys(table, -1)
             ret = True
+        if not id_:
+            index = self.key_index(self.entry_root(key))
+            index.remove(key.strip(self.key_delim))
         return ret
 
     def rmdir(self, d_key):
@@ -384,40 +2053,102 @@ class HDHT(object):
         Recursively remove a key directory and all keys and key data
         therein and below.
         '''
-        fn_root = self.root
-        if not d_key or d_key == self.key_delim:
-            pass
-        else:
-            fn_root = self.entry_root('{0}/blank'.format(d_key))
+        fn_root = self.dir_root(d_key)
+        for fn_ in list(self.headers):
+            if fn_.startswith(os.path.join(fn_root, '')):
+                self.close_table(fn_)
+        with self.table_lock:
+            for key_root in self.key_indexes:
+                if key_root == fn_root or key_root.startswith(
+                        os.path.join(fn_root, '')):
+                    self.key_indexes.pop(key_root).close()
+        self._forget_dicts(
+            lambda dict_root: dict_root == fn_root or dict_root.startswith(
+                os.path.join(fn_root, '')))
         shutil.rmtree(fn_root)
         return True
 
+    def key_index(self, fn_root):
+        '''
+        Return the ordered key index of the key directory, directories
+        written before the index existed are scanned once to build it
+        '''
+        index = self.key_indexes.peek(fn_root)
+        if index is not None:
+            return index
+        with self.table_lock:
+            index = self.key_indexes.get(fn_root)
+            if index is not None:
+                return index
+            index = sorbic.ind.keys.KeyIndex(fn_root)
+            if index.exists():
+                index.load()
+            else:
+                keys = []
+                for fn_ in self.table_fns(fn_root):
+                    for entry in self._get_table_entries(fn_):
+                        keys.append(entry['key'].strip(self.key_delim))
+                index.build(keys)
+            self.key_indexes.set(fn_root, index)
+            return index
+
+    def iter_keys(
+            self,
+            fn_root,
+            prefix='',
+            start=None,
+            end=None,
+            after=None,
+            limit=None):
+        '''
+        Return the sorted keys of the key directory, see KeyIndex.range
+        '''
+        return self.key_index(fn_root).range(prefix, start, end, after, limit)
+
     def listdir(self, d_key):
         '''
         Return a list of the keys
         '''
-        fn_root = self.root
         ret = []
-        if not d_key or d_key == self.key_delim:
-            pass
-        else:
-            fn_root = self.entry_root('{0}/blank'.format(d_key))
-        for fn_ in os.listdir(fn_root):
-            if not fn_.startswith('sorbic_table_'):
-                continue
-            full = os.path.join(fn_root, fn_)
-            for entry in self._get_table_entries(full):
+        for fn_ in self.table_fns(self.dir_root(d_key)):
+            for entry in self._get_table_entries(fn_):
                 ret.append(entry)
         return ret
 
+    def check_rev(self, key, table_entry, count=1):
+        '''
+        Raise a ValueError if the key can not take count more revisions, the
+        check is made before any of the data is written
+        '''
+        if table_entry['rev'] + count > self.rev_limit:
+            raise ValueError(
+                'The key {0} has reached the limit of {1} revisions of the '
+                'table format, remove revisions and compress the directory '
+                'to write it again'.format(
+                    key,
+                    self.rev_limit + 1))
+
+    def check_revs(self, keys):
+        '''
+        Raise a ValueError if a batch of the keys would pass the revision
+        limit of a key
+        '''
+        counts = {}
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+        keys = sorted(counts)
+        for key, table_entry in zip(keys, self.get_table_entries(keys)):
+            self.check_rev(key, table_entry, counts[key])
+
     def write_table_entry(self, table_entry, c_key, prev):
         '''
         Write a table entry
         '''
         table = self.get_hash_table(table_entry['tfn'])
         t_str = struct.pack(table['fmt'], c_key, prev, table_entry['rev'] + 1)
-        table['fp'].seek(table_entry['pos'])
-        table['fp'].write(t_str)
+        self._write_bucket(table, table_entry['pos'], t_str)
+        if table_entry['key'] is None:
+            self._count_keys(table, 1)
         return table_entry['rev'] + 1
 
     def write_index_entry(
@@ -431,15 +2162,16 @@ class HDHT(object):
         Write a data entry
         '''
         table = self.get_hash_table(table_entry['tfn'])
+        kwargs['r'], links = self._skip_links(table, table_entry)
+        if links:
+            kwargs['tw'] = links
         raw, entry = self.index_entry(
             key,
             id_,
             type_,
             table_entry['prev'],
             **kwargs)
-        table['fp'].seek(0, 2)
-        prev = table['fp'].tell()
-        table['fp'].write(raw)
+        prev = self._append(table, raw)
         return prev, entry
 
     def commit(
@@ -457,28 +2189,292 @@ class HDHT(object):
             type_,
             **kwargs)
         entry['rev'] = self.write_table_entry(table_entry, c_key, prev)
+        if not table_entry['prev']:
+            self.key_index(self.entry_root(key)).add(key.strip(self.key_delim))
         return entry
 
+    def commit_many(
+            self,
+            items,
+            type_='doc',
+            serial=None,
+            write_stor=None,
+            ids=None):
+        '''
+        Commit many key/data pairs at once. The bucket for every key is
+        located first, then the document and index data for each table is
+        appended in a single write and the buckets are patched in position
+        order. ids optionally holds the id of each item. Returns the index
+        entries in the order of the passed items.
+        '''
+        items = list(items)
+        pending = {}
+        groups = {}
+        order = []
+        roots = [self.entry_root(key) for key, _ in items]
+        for ind in sorted(range(len(items)), key=lambda ind: roots[ind]):
+            key, data = items[ind]
+            c_key = self.raw_crypt_key(key)
+            table_entry = self.get_table_entry(key, c_key, pending)
+            self.check_rev(key, table_entry)
+            loc = (table_entry['tfn'], table_entry['pos'])
+            pending[loc] = {
+                'key': c_key,
+                'prev': None,
+                'rev': table_entry['rev'] + 1,
+                'ref': ind}
+            if table_entry['tfn'] not in groups:
+                groups[table_entry['tfn']] = []
+                order.append(table_entry['tfn'])
+            groups[table_entry['tfn']].append(
+                (ind, key, c_key, table_entry, data))
+        rets = [None] * len(items)
+        new_keys = []
+        for tfn in order:
+            table = self.get_hash_table(tfn)
+            start = self._end(table)
+            chunks = []
+            size = 0
+            offsets = {}
+            written = {}
+            for ind, key, c_key, table_entry, data in groups[tfn]:
+                if 'ref' not in table_entry and not table_entry['prev']:
+                    new_keys.append(key)
+                if type_ == 'doc':
+                    serial_data, kwargs = self._pack_doc(
+                        os.path.dirname(tfn),
+                        self.serialize(data, serial))
+                    kwargs.update({'st': start + size, 'sz': len(serial_data)})
+                    chunks.append(serial_data)
+                    size += len(serial_data)
+                else:
+                    kwargs = write_stor(table_entry, data, serial)
+                if 'ref' in table_entry:
+                    table_entry['prev'] = offsets[table_entry['ref']]
+                kwargs['r'], links = self._skip_links(
+                    table,
+                    table_entry,
+                    written)
+                if links:
+                    kwargs['tw'] = links
+                raw, entry = self.index_entry(
+                    key,
+                    ids[ind] if ids else None,
+                    type_,
+                    table_entry['prev'],
+                    **kwargs)
+                offsets[ind] = start + size
+                written[offsets[ind]] = entry
+                chunks.append(raw)
+                size += len(raw)
+                rets[ind] = entry
+            self._append(table, ''.join(chunks))
+            for ind, key, c_key, table_entry, data in sorted(
+                    groups[tfn],
+                    key=lambda group: (group[3]['pos'], group[0])):
+                rets[ind]['rev'] = self.write_table_entry(
+                    table_entry,
+                    c_key,
+                    offsets[ind])
+        for key in new_keys:
+            self.key_index(self.entry_root(key)).add(key.strip(self.key_delim))
+        return rets
+
+    def serialize(self, data, serial=None):
+        '''
+        Return the serialized string for the given data
+        '''
+        serial = serial if serial else self.serial.default
+        serial_fun = getattr(self.serial, '{0}_dump'.format(serial))
+        return serial_fun(data)
+
     def write_doc_stor(self, table_entry, data, serial=None):
         '''
         Write the data to the storage file
         '''
         table = self.get_hash_table(table_entry['tfn'])
-        serial = serial if serial else self.serial.default
-        serial_fun = getattr(self.serial, '{0}_dump'.format(serial))
-        serial_data = serial_fun(data)
-        table['fp'].seek(0, 2)
-        start = table['fp'].tell()
-        table['fp'].write(serial_data)
-        return {'st': start, 'sz': len(serial_data)}
+        packed, ret = self._pack_doc(
+            os.path.dirname(table['fn']),
+            self.serialize(data, serial))
+        start = self._append(table, packed)
+        ret.update({'st': start, 'sz': len(packed)})
+        return ret
+
+    def _dict_num(self, fn_root):
+        '''
+        Return the number of the newest dictionary of the key directory, 0
+        when it has none
+        '''
+        num = self.dict_nums.get(fn_root)
+        if num is None:
+            fns = self.table_fns(fn_root, DICT_PREFIX)
+            num = 0
+            if fns:
+                num = int(os.path.basename(fns[-1])[len(DICT_PREFIX):])
+            self.dict_nums[fn_root] = num
+        return num
+
+    def _doc_dict(self, fn_root, num):
+        '''
+        Return the loaded dictionary of the key directory
+        '''
+        zdict = self.dicts.get((fn_root, num))
+        if zdict is None:
+            fn_ = os.path.join(fn_root, '{0}{1}'.format(DICT_PREFIX, num))
+            with io.open(fn_, 'rb') as fp_:
+                zdict = sorbic.stor.codec.load_dict(fp_.read())
+            self.dicts[(fn_root, num)] = zdict
+        return zdict
+
+    def _pack_doc(self, fn_root, raw):
+        '''
+        Return the stored form of the serialized document and the index
+        fields which name its compression. The newest dictionary of the
+        directory is used for documents of any size
+        '''
+        num = self._dict_num(fn_root)
+        if num:
+            packed = sorbic.stor.codec.compress_dict(
+                self._doc_dict(fn_root, num),
+                raw)
+            if len(packed) < len(raw):
+                return packed, {'c': 'zstd', 'd': num}
+        packed, codec = sorbic.stor.codec.compress(
+            self.codec,
+            raw,
+            self.codec_min)
+        if codec:
+            return packed, {'c': codec}
+        return packed, {}
+
+    def _unpack_doc(self, fn_root, index_entry, packed):
+        '''
+        Return the serialized document from the stored form
+        '''
+        if index_entry.get('d'):
+            return sorbic.stor.codec.decompress_dict(
+                self._doc_dict(fn_root, index_entry['d']),
+                packed)
+        return sorbic.stor.codec.decompress(index_entry.get('c'), packed)
+
+    def train_dict(self, fn_root, size=DICT_SIZE, samples=DICT_SAMPLES):
+        '''
+        Train a dictionary from the newest revisions of up to samples
+        documents of the key directory and make it the newest dictionary.
+        Returns the number of the dictionary
+        '''
+        raws = []
+        for fn_ in self.table_fns(fn_root):
+            table = self.get_hash_table(fn_)
+            for bucket in self._iter_occupied(table):
+                if len(raws) >= samples:
+                    break
+                if not bucket['prev']:
+                    continue
+                index_entry = self._read_index_entry(table, bucket['prev'])
+                if index_entry['_status'] != 'k':
+                    continue
+                if index_entry.get('t', 'doc') != 'doc':
+                    continue
+                raws.append(self._unpack_doc(
+                    fn_root,
+                    index_entry,
+                    self._read_at(table, index_entry['st'], index_entry['sz'])))
+        raw_dict = sorbic.stor.codec.train(raws, size)
+        num = self._dict_num(fn_root) + 1
+        fn_ = os.path.join(fn_root, '{0}{1}'.format(DICT_PREFIX, num))
+        tmp_fn = '{0}.{1}'.format(fn_, os.getpid())
+        with io.open(tmp_fn, 'w+b') as fp_:
+            fp_.write(raw_dict)
+        os.rename(tmp_fn, fn_)
+        self.dict_nums[fn_root] = num
+        return num
+
+    def _forget_dicts(self, match):
+        '''
+        Drop the cached dictionaries of the key directories which match
+        '''
+        for fn_root in [fn_root for fn_root in list(self.dict_nums)
+                        if match(fn_root)]:
+            self.dict_nums.pop(fn_root, None)
+        for key in [key for key in list(self.dicts) if match(key[0])]:
+            self.dicts.pop(key, None)
+
+    def prune_dicts(self, fn_root):
+        '''
+        Remove the dictionaries older than the newest, called once every
+        table of the directory has been rebuilt so that no entry uses them
+        '''
+        num = self._dict_num(fn_root)
+        for fn_ in self.table_fns(fn_root, DICT_PREFIX):
+            old = int(os.path.basename(fn_)[len(DICT_PREFIX):])
+            if old < num:
+                os.remove(fn_)
+                self.dicts.pop((fn_root, old), None)
+
+    def copy_doc_stor(self, entries, table_entry):
+        '''
+        Copy the stored document bytes of the given entries to the table of
+        the table entry and return the new storage location
+        '''
+        table = self.get_hash_table(entries['table']['tfn'])
+        dest = self.get_hash_table(table_entry['tfn'])
+        raw = self._read_at(table, entries['data']['st'], entries['data']['sz'])
+        ret = {}
+        for field in ('c', 'd'):
+            if field in entries['data']:
+                ret[field] = entries['data'][field]
+        fn_root = os.path.dirname(dest['fn'])
+        num = self._dict_num(fn_root)
+        if num and entries['data'].get('d') != num:
+            # Move the document to the newest dictionary of the directory
+            raw, ret = self._pack_doc(
+                fn_root,
+                self._unpack_doc(
+                    os.path.dirname(table['fn']),
+                    entries['data'],
+                    raw))
+        start = self._append(dest, raw)
+        ret.update({'st': start, 'sz': len(raw)})
+        return ret
+
+    def open_doc_stor(self, entries):
+        '''
+        Return a handle of the serialized document bytes in the table file,
+        or in the data segment which holds them. A document compressed with
+        a dictionary names the dictionary file
+        '''
+        table = self.get_hash_table(entries['table']['tfn'])
+        if table['fn'] in self.unflushed:
+            self._flush_table(table['fn'])
+        pos = entries['data']['st']
+        fn_ = table['fn']
+        if table.get('data_logs'):
+            fn_ = self._seg_fn(table['fn'], pos >> SEG_SHIFT)
+            pos &= SEG_MASK
+        num = entries['data'].get('d')
+        dict_path = None
+        if num:
+            dict_path = os.path.join(
+                os.path.dirname(table['fn']),
+                '{0}{1}'.format(DICT_PREFIX, num))
+        return sorbic.stor.blob.Blob(
+            fn_,
+            pos,
+            entries['data']['sz'],
+            codec=entries['data'].get('c'),
+            dict_num=num,
+            dict_path=dict_path)
 
     def read_doc_stor(self, entries, serial=None, **kwargs):
         '''
         Read in the data
         '''
         table = self.get_hash_table(entries['table']['tfn'])
-        table['fp'].seek(entries['data']['st'])
-        raw = table['fp'].read(entries['data']['sz'])
+        raw = self._unpack_doc(
+            os.path.dirname(table['fn']),
+            entries['data'],
+            self._read_at(table, entries['data']['st'], entries['data']['sz']))
         serial = serial if serial else self.serial.default
         serial_fun = getattr(self.serial, '{0}_load'.format(serial))
         ret = serial_fun(raw)
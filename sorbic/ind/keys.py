@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+'''
+Ordered index of the keys in a key directory. The hash tables can not be
+walked in key order, so every directory keeps its keys in a sorted file,
+sorbic_keys, and appends the keys added and removed since the file was
+written to sorbic_keys.log. Only the changes in the log and every
+FENCE'th key of the sorted file, with its offset, are held in memory. Listing
+bisects the fence keys, seeks the sorted file and streams it from there. The
+log is folded into the sorted file once it grows past the number of keys
+'''
+# Import python libs
+import os
+import io
+import bisect
+import struct
+
+# Import third party libs
+import msgpack
+
+KEYS_FN = 'sorbic_keys'
+LOG_FN = 'sorbic_keys.log'
+# Always allow this many log records before the sorted file is rewritten
+LOG_MIN = 1024
+# One key in this many of the sorted file is held in memory to seek the file
+FENCE = 128
+# The sorted file is written with a 32 bit msgpack array header, the count is
+# filled in once the keys are written
+ARRAY_HEAD_FMT = '>BI'
+ARRAY_32 = 0xdd
+
+
+class KeyIndex(object):
+    '''
+    The sorted keys of a single key directory
+    '''
+    def __init__(self, fn_root):
+        self.fn_root = fn_root
+        self.keys_fn = os.path.join(fn_root, KEYS_FN)
+        self.log_fn = os.path.join(fn_root, LOG_FN)
+        # The fence keys of the sorted file and their offsets, read on demand
+        self._fences = None
+        # The keys added and removed since the sorted file was written
+        self.added = []
+        self.removed = set()
+        # Number of keys in the sorted file and of records in the log
+        self.written = 0
+        self.logged = 0
+        self.log_fp = None
+
+    def exists(self):
+        '''
+        Return True if the index has been written for the directory
+        '''
+        return os.path.isfile(self.keys_fn)
+
+    def load(self):
+        '''
+        Read the number of keys in the sorted file and apply the log
+        '''
+        with io.open(self.keys_fn, 'rb') as fp_:
+            self.written = msgpack.Unpacker(fp_).read_array_header()
+        self._fences = None
+        self.added = []
+        self.removed = set()
+        self.logged = 0
+        if not os.path.isfile(self.log_fn):
+            return
+        with io.open(self.log_fn, 'rb') as fp_:
+            unpacker = msgpack.Unpacker(fp_)
+            while True:
+                try:
+                    op_, key = next(unpacker)
+                except StopIteration:
+                    break
+                except ValueError:
+                    # A torn record at the end of the log
+                    break
+                self.logged += 1
+                if op_ == '+':
+                    self._add(key)
+                else:
+                    self._remove(key)
+
+    @property
+    def keys(self):
+        '''
+        All of the keys in order
+        '''
+        return list(self._iter_keys())
+
+    def _file_fences(self):
+        '''
+        Return the fence keys of the sorted file and their offsets, the file
+        is scanned once to find them
+        '''
+        fences = self._fences
+        if fences is None:
+            keys = []
+            offsets = []
+            with io.open(self.keys_fn, 'rb') as fp_:
+                unpacker = msgpack.Unpacker(fp_)
+                for ind in range(unpacker.read_array_header()):
+                    if ind % FENCE:
+                        unpacker.skip()
+                        continue
+                    offsets.append(unpacker.tell())
+                    keys.append(unpacker.unpack())
+            fences = self._fences = (keys, offsets)
+        return fences
+
+    def _file_keys(self, low='', after=None):
+        '''
+        Yield the keys of the sorted file in order which are not less than
+        low and are greater than after, starting from the last fence before
+        them
+        '''
+        keys, offsets = self._file_fences()
+        first = low if after is None or after < low else after
+        ind = max(bisect.bisect_right(keys, first) - 1, 0)
+        if not offsets:
+            return
+        with io.open(self.keys_fn, 'rb') as fp_:
+            fp_.seek(offsets[ind])
+            unpacker = msgpack.Unpacker(fp_)
+            for _ in range(self.written - ind * FENCE):
+                key = unpacker.unpack()
+                if key < low or (after is not None and key <= after):
+                    continue
+                yield key
+
+    def build(self, keys):
+        '''
+        Write a new index holding the given keys
+        '''
+        self._write(sorted(set(keys)))
+
+    def rewrite(self):
+        '''
+        Fold the log into the sorted file and empty the log, the keys are
+        streamed into the new file
+        '''
+        self._write(self._iter_keys())
+
+    def _write(self, keys):
+        '''
+        Write the keys, which are in order, to a new sorted file
+        '''
+        self.close()
+        if not os.path.isdir(self.fn_root):
+            os.makedirs(self.fn_root)
+        tmp_fn = '{0}.{1}'.format(self.keys_fn, os.getpid())
+        packer = msgpack.Packer()
+        fence_keys = []
+        offsets = []
+        count = 0
+        with io.open(tmp_fn, 'w+b') as fp_:
+            fp_.write(struct.pack(ARRAY_HEAD_FMT, ARRAY_32, 0))
+            for key in keys:
+                if not count % FENCE:
+                    fence_keys.append(key)
+                    offsets.append(fp_.tell())
+                fp_.write(packer.pack(key))
+                count += 1
+            fp_.seek(0)
+            fp_.write(struct.pack(ARRAY_HEAD_FMT, ARRAY_32, count))
+        os.rename(tmp_fn, self.keys_fn)
+        if os.path.isfile(self.log_fn):
+            os.remove(self.log_fn)
+        self._fences = (fence_keys, offsets)
+        self.added = []
+        self.removed = set()
+        self.written = count
+        self.logged = 0
+
+    def _add(self, key):
+        self.removed.discard(key)
+        ind = bisect.bisect_left(self.added, key)
+        if ind < len(self.added) and self.added[ind] == key:
+            return False
+        self.added.insert(ind, key)
+        return True
+
+    def _remove(self, key):
+        ind = bisect.bisect_left(self.added, key)
+        if ind < len(self.added) and self.added[ind] == key:
+            self.added.pop(ind)
+        # The key can also be in the sorted file
+        self.removed.add(key)
+
+    def _log(self, op_, key):
+        '''
+        Append the change to the log, rewriting the sorted file once the log
+        is larger than the sorted file. The log handle is kept open, the
+        records are written out by flush
+        '''
+        self.logged += 1
+        if self.logged > max(LOG_MIN, self.written):
+            self.rewrite()
+            return
+        if self.log_fp is None:
+            self.log_fp = io.open(self.log_fn, 'ab')
+        self.log_fp.write(msgpack.dumps([op_, key]))
+
+    def flush(self, sync=False):
+        '''
+        Write the buffered log records to the log file, with sync the log
+        is also fsynced
+        '''
+        if self.log_fp is not None:
+            self.log_fp.flush()
+            if sync:
+                os.fsync(self.log_fp.fileno())
+
+    def close(self):
+        '''
+        Flush and close the log handle
+        '''
+        if self.log_fp is not None:
+            self.log_fp.close()
+            self.log_fp = None
+
+    def add(self, key):
+        '''
+        Add the key to the index
+        '''
+        if self._add(key):
+            self._log('+', key)
+
+    def remove(self, key):
+        '''
+        Remove the key from the index
+        '''
+        self._remove(key)
+        self._log('-', key)
+
+    def _iter_keys(self, low='', after=None):
+        '''
+        Yield the keys in order from low, merging the sorted file with the
+        keys added and removed since it was written
+        '''
+        keys = self._file_keys(low, after)
+        added = self.added
+        a_ind = bisect.bisect_left(added, low)
+        if after is not None:
+            a_ind = max(a_ind, bisect.bisect_right(added, after))
+        f_key = next(keys, None)
+        while f_key is not None or a_ind < len(added):
+            if a_ind == len(added) or (
+                    f_key is not None and f_key <= added[a_ind]):
+                key = f_key
+                f_key = next(keys, None)
+                if a_ind < len(added) and added[a_ind] == key:
+                    a_ind += 1
+            else:
+                key = added[a_ind]
+                a_ind += 1
+            if key not in self.removed:
+                yield key
+
+    def range(self, prefix='', start=None, end=None, after=None, limit=None):
+        '''
+        Return the keys in order which start with the prefix, are not less
+        than start, are less than end and are greater than after
+        '''
+        low = prefix
+        if start is not None and start > low:
+            low = start
+        ret = []
+        for key in self._iter_keys(low, after):
+            if limit is not None and len(ret) >= limit:
+                break
+            if not key.startswith(prefix):
+                break
+            if end is not None and key >= end:
+                break
+            ret.append(key)
+        return ret
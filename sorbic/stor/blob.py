@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+'''
+Descriptor backed handles of stored data. A handle owns a file descriptor on
+the file which holds the data, with the offset and size of the data in it,
+so the bytes can be sent or mapped without being read into python first.
+The handle keeps the data readable even when the table is compacted or the
+blob is released after it was opened. The handle exposes the stored bytes,
+codec names the compression of compressed data and dict_num and dict_path
+the trained dictionary of documents compressed with one. Those documents are
+zstd frames without the magic number, sorbic.stor.codec.decompress_dict
+reads them
+'''
+# Import python libs
+import os
+import io
+import mmap
+import binascii
+
+# Size of the reads made when the data is copied through python
+CHUNK_SIZE = 0x10000
+HAS_PREAD = hasattr(os, 'pread')
+HAS_SENDFILE = hasattr(os, 'sendfile')
+
+
+class Blob(object):
+    '''
+    The stored data at offset for size bytes of the file fn_
+    '''
+    def __init__(
+            self,
+            fn_,
+            offset,
+            size=None,
+            crc=None,
+            codec=None,
+            dict_num=None,
+            dict_path=None):
+        self.fp_ = io.open(fn_, 'rb')
+        self.path = fn_
+        self.offset = offset
+        self.codec = codec
+        # The dictionary is held open with the data, a resize can remove it
+        self.dict_num = dict_num
+        self.dict_path = dict_path
+        self.dict_fp = io.open(dict_path, 'rb') if dict_path else None
+        if size is None:
+            size = os.fstat(self.fp_.fileno()).st_size - offset
+        self.size = size
+        self._crc = crc
+        self.pos = 0
+        self.map = None
+
+    def fileno(self):
+        '''
+        Return the file descriptor which holds the data at self.offset
+        '''
+        return self.fp_.fileno()
+
+    @property
+    def crc(self):
+        '''
+        The crc32 of the data, computed on the first use when the storage
+        does not keep one
+        '''
+        if self._crc is None:
+            crc = 0
+            for chunk in self._chunks(0, self.size):
+                crc = binascii.crc32(chunk, crc)
+            self._crc = crc & 0xffffffff
+        return self._crc
+
+    def read_dict(self):
+        '''
+        Return the raw zstd dictionary which the data was compressed with,
+        None if it was compressed without one
+        '''
+        if self.dict_fp is None:
+            return None
+        self.dict_fp.seek(0)
+        return self.dict_fp.read()
+
+    def _pread(self, pos, size):
+        if HAS_PREAD:
+            return os.pread(self.fileno(), size, self.offset + pos)
+        self.fp_.seek(self.offset + pos)
+        return self.fp_.read(size)
+
+    def _chunks(self, pos, size):
+        end = pos + size
+        while pos < end:
+            chunk = self._pread(pos, min(CHUNK_SIZE, end - pos))
+            if not chunk:
+                break
+            pos += len(chunk)
+            yield chunk
+
+    def read(self, size=-1):
+        '''
+        Read from the current position, the data ends at self.size
+        '''
+        if size is None or size < 0 or size > self.size - self.pos:
+            size = self.size - self.pos
+        data = b''.join(self._chunks(self.pos, size))
+        self.pos += len(data)
+        return data
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += self.size
+        self.pos = max(0, min(pos, self.size))
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def view(self):
+        '''
+        Map the data and return a zero copy view of it, the view is valid
+        until the handle is closed
+        '''
+        if self.map is None:
+            if not self.size:
+                return memoryview(b'')
+            # The mapping has to start on an allocation boundary
+            start = self.offset - self.offset % mmap.ALLOCATIONGRANULARITY
+            self.map = mmap.mmap(
+                self.fileno(),
+                self.offset - start + self.size,
+                access=mmap.ACCESS_READ,
+                offset=start)
+            self.map_start = self.offset - start
+        end = self.map_start + self.size
+        try:
+            return memoryview(self.map)[self.map_start:end]
+        except TypeError:
+            # Python 2 mmaps only expose the old buffer interface
+            # pylint: disable=undefined-variable
+            return buffer(self.map, self.map_start, self.size)
+
+    def send(self, sock):
+        '''
+        Send the data to the socket, or any object with a fileno, with
+        os.sendfile when it is available. Returns the number of bytes sent
+        '''
+        sent = 0
+        if HAS_SENDFILE:
+            while sent < self.size:
+                num = os.sendfile(
+                    sock.fileno(),
+                    self.fileno(),
+                    self.offset + sent,
+                    self.size - sent)
+                if not num:
+                    break
+                sent += num
+            return sent
+        for chunk in self._chunks(0, self.size):
+            sent += len(chunk)
+            if hasattr(sock, 'sendall'):
+                sock.sendall(chunk)
+                continue
+            while chunk:
+                chunk = chunk[os.write(sock.fileno(), chunk):]
+        return sent
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.dict_fp is not None:
+            self.dict_fp.close()
+        self.fp_.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
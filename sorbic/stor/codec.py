@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+'''
+Compression codecs for the stored data. Index entries of compressed data
+name the codec in the c field, data without the field is stored as is.
+zlib and bz2 are always available, lzma, lz4 and zstd are used when their
+libraries are installed. With zstd small documents can also be compressed
+with a dictionary trained from other documents
+'''
+# Import python libs
+import bz2
+import zlib
+
+# Import third party libs
+try:
+    import lzma
+    HAS_LZMA = True
+except ImportError:
+    try:
+        from backports import lzma
+        HAS_LZMA = True
+    except ImportError:
+        HAS_LZMA = False
+try:
+    import lz4.frame
+    HAS_LZ4 = True
+except ImportError:
+    HAS_LZ4 = False
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+# Data shorter than this is stored uncompressed unless the database sets
+# codec_min
+CODEC_MIN = 256
+# The magic number which starts a zstd frame. Documents compressed with a
+# dictionary are written as frames without it, and without the content size,
+# checksum and dictionary id, so that small documents shrink. A frame without
+# the magic number can not start with it, so the older frames which have it
+# are still read
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def _zstd_decompress(raw):
+    return zstandard.ZstdDecompressor().decompress(raw)
+
+
+def train(samples, size):
+    '''
+    Train a zstd dictionary of up to size bytes from the sample strings and
+    return the raw dictionary
+    '''
+    if not HAS_ZSTD:
+        raise ValueError('Training a dictionary needs the zstandard library')
+    try:
+        return zstandard.train_dictionary(size, samples).as_bytes()
+    except zstandard.ZstdError as exc:
+        raise ValueError('The dictionary could not be trained: {0}'.format(exc))
+
+
+def load_dict(raw):
+    '''
+    Return the dictionary object of the raw dictionary, prepared for
+    compression
+    '''
+    check('zstd')
+    zdict = zstandard.ZstdCompressionDict(raw)
+    zdict.precompute_compress(level=3)
+    return zdict
+
+
+def compress_dict(zdict, data):
+    '''
+    Compress the data with the dictionary into a frame without the magic
+    number, content size, checksum or dictionary id, the index entry names
+    the dictionary
+    '''
+    params = zstandard.ZstdCompressionParameters.from_level(
+        3,
+        format=zstandard.FORMAT_ZSTD1_MAGICLESS,
+        write_content_size=False,
+        write_checksum=False,
+        write_dict_id=False)
+    compressor = zstandard.ZstdCompressor(
+        dict_data=zdict,
+        compression_params=params)
+    return compressor.compress(data)
+
+
+def decompress_dict(zdict, raw):
+    '''
+    Return the data compressed with the dictionary, frames written with the
+    magic number are read as well
+    '''
+    if raw[:4] == ZSTD_MAGIC:
+        return zstandard.ZstdDecompressor(dict_data=zdict).decompress(raw)
+    decompressor = zstandard.ZstdDecompressor(
+        dict_data=zdict,
+        format=zstandard.FORMAT_ZSTD1_MAGICLESS)
+    # The frame has no content size, so it is streamed out
+    return decompressor.decompressobj().decompress(raw)
+
+
+def _gen_codecs():
+    '''
+    Return the available codecs, mapping the name to the compress and
+    decompress functions
+    '''
+    codecs = {'zlib': (zlib.compress, zlib.decompress),
+              'bz2': (bz2.compress, bz2.decompress)}
+    if HAS_LZMA:
+        codecs['lzma'] = (lzma.compress, lzma.decompress)
+    if HAS_LZ4:
+        codecs['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+    if HAS_ZSTD:
+        codecs['zstd'] = (_zstd_compress, _zstd_decompress)
+    return codecs
+
+
+CODECS = _gen_codecs()
+
+
+def check(codec):
+    '''
+    Raise a ValueError if the codec is not available
+    '''
+    if codec and codec not in CODECS:
+        raise ValueError(
+            'The codec {0} is not available, use one of {1}'.format(
+                codec,
+                ', '.join(sorted(CODECS))))
+
+
+def compress(codec, data, codec_min=CODEC_MIN):
+    '''
+    Return the stored form of the data and the codec which compressed it,
+    None if the data is stored as is. Data shorter than codec_min, or which
+    does not shrink, is not compressed
+    '''
+    if not codec or len(data) < codec_min:
+        return data, None
+    raw = CODECS[codec][0](data)
+    if len(raw) >= len(data):
+        return data, None
+    return raw, codec
+
+
+def decompress(codec, raw):
+    '''
+    Return the data from the stored form
+    '''
+    if not codec:
+        return raw
+    check(codec)
+    return CODECS[codec][1](raw)
@@ -1,14 +1,38 @@
 # -*- coding: utf-8 -*-
 '''
 Read and Write files to disk and return the relative path data for the index
+
+Files are stored once per key directory under .blobs, named by the sha256
+digest of the contents, so inserting the same contents again only adds an
+index entry. Every blob has a <digest>.ref file holding the number of index
+entries which reference it, the blob is removed when the last one is
+released. Files written before the blob store live under .files_N and are
+removed when their entry is released
+
+The contents can be passed as a string, a file like object or an iterator
+of strings, which are streamed to disk. Reads can return a byte range or a
+file like reader instead of the whole file
+
+Contents passed as a string are compressed when the database sets a codec,
+the blob of compressed contents is named <digest>.<codec>. Streamed contents
+are stored as is
 '''
 # Import python libs
 import os
 import io
+import struct
+import hashlib
 import binascii
 # Import sorbic libs
+import sorbic.stor.blob
+import sorbic.stor.codec
 import sorbic.utils.rand
 
+BLOB_DIR = '.blobs'
+REF_FMT = '>Q'
+# Size of the reads made from streamed contents
+CHUNK_SIZE = 0x10000
+
 
 def _file_loc(files_dir):
     while True:
@@ -17,32 +41,268 @@ def _file_loc(files_dir):
             return fn_
 
 
-def write(table_entry, data, serial=None):
+def _ref_fn(fn_):
+    return '{0}.ref'.format(fn_)
+
+
+def _refs(fn_):
+    '''
+    Return the number of references to the blob
+    '''
+    try:
+        with io.open(_ref_fn(fn_), 'rb') as fp_:
+            return struct.unpack(REF_FMT, fp_.read())[0]
+    except (OSError, IOError, struct.error):
+        return 0
+
+
+def _set_refs(fn_, refs):
+    '''
+    Write the number of references to the blob, the blob is removed once
+    nothing references it
     '''
-    Write the file entry and return the needed metadata to find it
+    if refs <= 0:
+        for rm_fn in (fn_, _ref_fn(fn_)):
+            if os.path.exists(rm_fn):
+                os.remove(rm_fn)
+        return
+    _write_new(_ref_fn(fn_), struct.pack(REF_FMT, refs))
+
+
+def restore_refs(fn_, refs):
+    '''
+    Write back a logged reference count of the blob, a blob which had no
+    references is removed
+    '''
+    _set_refs(fn_, refs)
+
+
+def _write_new(fn_, data):
+    '''
+    Write the file and rename it into place so that it is never seen
+    partially written
+    '''
+    tmp_fn = '{0}.{1}'.format(fn_, os.getpid())
+    with io.open(tmp_fn, 'w+b') as fp_:
+        fp_.write(data)
+    os.rename(tmp_fn, fn_)
+
+
+def _chunks(data):
+    '''
+    Yield the contents passed as a string, file like object or iterator in
+    chunks
+    '''
+    if isinstance(data, (str, bytes)):
+        yield data
+    elif hasattr(data, 'read'):
+        while True:
+            chunk = data.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        for chunk in data:
+            yield chunk
+
+
+def collect(data):
+    '''
+    Return the contents passed as a string, file like object or iterator as
+    a single string
+    '''
+    if isinstance(data, (str, bytes)):
+        return data
+    return b''.join(_chunks(data))
+
+
+def _spool(blob_dir, data):
+    '''
+    Stream the contents into a temporary file in the blob directory and
+    return the temporary file name, the digest and the crc
+    '''
+    digest = hashlib.sha256()
+    crc = 0
+    tmp_fn = os.path.join(
+        blob_dir,
+        '{0}.tmp'.format(sorbic.utils.rand.rand_hex_str(24)))
+    try:
+        with io.open(tmp_fn, 'w+b') as fp_:
+            for chunk in _chunks(data):
+                digest.update(chunk)
+                crc = binascii.crc32(chunk, crc)
+                fp_.write(chunk)
+    except Exception:
+        # Do not leave the partial file behind in the blob directory
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        raise
+    return tmp_fn, digest.hexdigest(), crc & 0xffffffff
+
+
+def write(
+        table_entry,
+        data,
+        serial=None,
+        codec=None,
+        codec_min=sorbic.stor.codec.CODEC_MIN,
+        journal=None):
+    '''
+    Write the file entry and return the needed metadata to find it. journal
+    is passed the blob and its reference count before the count is raised,
+    the write ahead log uses it to restore the count
     '''
     if serial:
         serial = None
-    files_dir = os.path.join(
-            os.path.dirname(table_entry['tfn']),
-            '.files_{0}'.format(table_entry['num']))
-    if not os.path.isdir(files_dir):
-        os.makedirs(files_dir)
-    fn_ = _file_loc(files_dir)
-    with io.open(fn_, 'wb+') as fp_:
-        fp_.write(data)
+    blob_dir = os.path.join(os.path.dirname(table_entry['tfn']), BLOB_DIR)
+    if not os.path.isdir(blob_dir):
+        os.makedirs(blob_dir)
+    if isinstance(data, (str, bytes)):
+        digest = hashlib.sha256(data).hexdigest()
+        crc = binascii.crc32(data) & 0xffffffff
+        raw, codec = sorbic.stor.codec.compress(codec, data, codec_min)
+        if codec:
+            digest = '{0}.{1}'.format(digest, codec)
+        fn_ = os.path.join(blob_dir, digest)
+        if not os.path.isfile(fn_):
+            _write_new(fn_, raw)
+    else:
+        codec = None
+        # The digest is only known once the contents have been read
+        tmp_fn, digest, crc = _spool(blob_dir, data)
+        fn_ = os.path.join(blob_dir, digest)
+        if os.path.isfile(fn_):
+            os.remove(tmp_fn)
+        else:
+            os.rename(tmp_fn, fn_)
+    # The reference is counted before the index entry is written, a crash
+    # can only leave a blob which is never removed
+    refs = _refs(fn_)
+    if journal:
+        journal(fn_, refs)
+    _set_refs(fn_, refs + 1)
     ret = {'path': fn_,
-           'crc': binascii.crc32(data) & 0xffffffff}
+           'crc': crc,
+           'blob': digest}
+    if codec:
+        ret['c'] = codec
     return ret
 
 
-def read(entries, serial=None, **kwargs):
+class RangeReader(object):
     '''
-    Return the file data
+    File like reader over length bytes of an open file
+    '''
+    def __init__(self, fp_, length):
+        self.fp_ = fp_
+        self.left = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.left:
+            size = self.left
+        data = self.fp_.read(size)
+        self.left -= len(data)
+        return data
+
+    def close(self):
+        self.fp_.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return iter(lambda: self.read(CHUNK_SIZE), b'')
+
+
+def read(
+        entries,
+        serial=None,
+        offset=None,
+        length=None,
+        stream=False,
+        **kwargs):
+    '''
+    Return the file data, or length bytes of it from offset. With stream a
+    file like reader is returned instead, which the caller has to close
     '''
     fn_ = entries['data']['path']
+    if entries['data'].get('c'):
+        return _read_compressed(entries, offset, length, stream)
     try:
-        with io.open(fn_, 'rb') as fp_:
+        fp_ = io.open(fn_, 'rb')
+    except (OSError, IOError):
+        return io.BytesIO(b'') if stream else ''
+    if offset:
+        fp_.seek(offset)
+    if stream:
+        if length is None:
+            return fp_
+        return RangeReader(fp_, length)
+    with fp_:
+        if length is None:
             return fp_.read()
+        return fp_.read(length)
+
+
+def _read_compressed(entries, offset, length, stream):
+    '''
+    Compressed files can not be read from an offset, they are read whole
+    and the range is taken from the contents
+    '''
+    try:
+        with io.open(entries['data']['path'], 'rb') as fp_:
+            data = sorbic.stor.codec.decompress(
+                entries['data']['c'],
+                fp_.read())
     except (OSError, IOError):
-        return ''
+        data = b''
+    offset = offset if offset else 0
+    end = len(data) if length is None else offset + length
+    if stream:
+        return io.BytesIO(data[offset:end])
+    return data[offset:end]
+
+
+def open_blob(entries):
+    '''
+    Return a handle of the stored file, None if the file is missing. The crc
+    of the entry is the crc of the contents, so for compressed files the
+    handle computes the crc of the stored bytes
+    '''
+    codec = entries['data'].get('c')
+    try:
+        return sorbic.stor.blob.Blob(
+            entries['data']['path'],
+            0,
+            crc=None if codec else entries['data'].get('crc'),
+            codec=codec)
+    except (OSError, IOError):
+        return None
+
+
+def copy(entries, table_entry):
+    '''
+    Files are stored outside of the table, so moving the entry to a new table
+    keeps the existing file
+    '''
+    ret = {'path': entries['data']['path'],
+           'crc': entries['data']['crc']}
+    for field in ('blob', 'c'):
+        if field in entries['data']:
+            ret[field] = entries['data'][field]
+    return ret
+
+
+def release(entries):
+    '''
+    Drop the reference of the entry to the stored file
+    '''
+    fn_ = entries['data']['path']
+    if 'blob' not in entries['data']:
+        if os.path.isfile(fn_):
+            os.remove(fn_)
+        return
+    _set_refs(fn_, _refs(fn_) - 1)
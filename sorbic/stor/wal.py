@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+'''
+Write ahead log used to make writes to the tables durable. Every insert and
+rm is logged with a sequence number before it is applied, followed by the
+old contents of every bucket it overwrites and the old reference count of
+every file blob it references. The log is fsynced in groups, after every
+write, after a number of writes or after a number of milliseconds, so that
+many writes share a single fsync.
+
+A write which fails is followed by an abort record so that it is not
+applied again. When the database is opened again the logged buckets and
+reference counts are restored and the logged writes which were not aborted
+are applied again.
+The log is emptied at checkpoints once the tables have been synced to disk.
+'''
+# Import python libs
+import os
+import time
+import zlib
+import struct
+
+# Import third party libs
+import msgpack
+
+# Every record is prefixed with the length and crc32 of the packed record
+REC_HEAD_FMT = '>II'
+REC_HEAD_SIZE = struct.calcsize(REC_HEAD_FMT)
+SYNC_POLICIES = ('always', 'batch', 'none')
+
+
+class WAL(object):
+    '''
+    Append only log of the writes made since the last checkpoint. sync is
+    one of "always", "batch" or "none". With "batch" the log is fsynced once
+    sync_writes writes have been logged or sync_ms milliseconds have passed
+    since the last fsync. The time is checked as writes are made, the DB
+    also fsyncs from a timer so that the last writes are not left waiting
+    '''
+    def __init__(self, path, sync='batch', sync_ms=10, sync_writes=64):
+        if sync not in SYNC_POLICIES:
+            raise ValueError('Unknown wal sync policy {0}'.format(sync))
+        self.path = path
+        self.sync_policy = sync
+        self.sync_ms = sync_ms
+        self.sync_writes = sync_writes
+        self.seq = 0
+        self.synced = 0
+        self.pending = 0
+        self.last_sync = time.time()
+        self.fd = None
+
+    def records(self):
+        '''
+        Yield the records in the log, a torn or corrupt record ends the log
+        '''
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb') as fp_:
+            raw = fp_.read()
+        pos = 0
+        while pos + REC_HEAD_SIZE <= len(raw):
+            size, crc = struct.unpack_from(REC_HEAD_FMT, raw, pos)
+            pos += REC_HEAD_SIZE
+            packed = raw[pos:pos + size]
+            if len(packed) < size or zlib.crc32(packed) & 0xffffffff != crc:
+                return
+            pos += size
+            yield msgpack.loads(packed)
+
+    def open(self):
+        '''
+        Open the log for appending, the sequence numbers carry on from the
+        records already in the log
+        '''
+        for record in self.records():
+            self.seq = max(self.seq, record.get('seq', 0))
+        self.synced = self.seq
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND)
+
+    def _write(self, record):
+        '''
+        Append a single record to the log, the record is handed to the os
+        before the write it describes is made to the tables
+        '''
+        packed = msgpack.dumps(record)
+        head = struct.pack(
+            REC_HEAD_FMT,
+            len(packed),
+            zlib.crc32(packed) & 0xffffffff)
+        os.write(self.fd, head + packed)
+
+    def log(self, op, **kwargs):
+        '''
+        Log a write operation and return the sequence number assigned to it
+        '''
+        self.seq += 1
+        kwargs['op'] = op
+        kwargs['seq'] = self.seq
+        self._write(kwargs)
+        return self.seq
+
+    def abort(self, seq):
+        '''
+        Mark the logged write as failed, it is skipped when the log is
+        replayed
+        '''
+        self._write({'seq': seq, 'abort': True})
+
+    def ref_image(self, fn_, refs):
+        '''
+        Log the reference count of a file blob before a write raises it
+        '''
+        self._write({'seq': self.seq, 'ref': [fn_, refs]})
+
+    def pre_image(self, fn_, pos, raw):
+        '''
+        Log the contents of a bucket before it is overwritten
+        '''
+        self._write({'seq': self.seq, 'pre': [fn_, pos, raw]})
+
+    def commit(self, sync=False):
+        '''
+        Mark the logged write as applied, fsync the log if the sync policy
+        calls for it or sync is True
+        '''
+        self.pending += 1
+        if sync or self.sync_policy == 'always':
+            return self.sync()
+        if self.sync_policy == 'batch':
+            if self.pending >= self.sync_writes:
+                return self.sync()
+            if (time.time() - self.last_sync) * 1000 >= self.sync_ms:
+                return self.sync()
+        return self.synced
+
+    def sync(self):
+        '''
+        Fsync the log and return the last durable sequence number
+        '''
+        if self.fd is not None and self.pending:
+            os.fsync(self.fd)
+        self.synced = self.seq
+        self.pending = 0
+        self.last_sync = time.time()
+        return self.synced
+
+    def size(self):
+        '''
+        Return the size of the log in bytes
+        '''
+        if self.fd is None:
+            return 0
+        return os.fstat(self.fd).st_size
+
+    def truncate(self):
+        '''
+        Empty the log, called once the tables are synced
+        '''
+        os.ftruncate(self.fd, 0)
+        os.fsync(self.fd)
+        self.synced = self.seq
+        self.pending = 0
+
+    def close(self):
+        '''
+        Sync and close the log
+        '''
+        if self.fd is None:
+            return
+        self.sync()
+        os.close(self.fd)
+        self.fd = None
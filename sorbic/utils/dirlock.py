@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+'''
+Advisory locks shared between processes on the key directories of a
+database. Every key directory has a lock file which is flocked shared by
+readers and exclusive by writers, the lock file also holds the generation
+of the directory which writers bump so that other processes know to drop
+what they have cached about the directory
+'''
+# Import python libs
+import os
+import fcntl
+import struct
+import threading
+
+LOCK_FN = 'sorbic_lock'
+GEN_FMT = '>Q'
+
+
+class DirLocks(object):
+    '''
+    The directory locks held by this process. The flock is taken once per
+    process and counted for the threads in the process, on_stale is called
+    with the directory when it was changed by another process since it was
+    last locked
+    '''
+    def __init__(self, on_stale=None):
+        self.on_stale = on_stale
+        self._fds = {}
+        self._holds = {}
+        self._exclusive = {}
+        self._gens = {}
+        self._mutex = threading.Lock()
+        self._local = threading.local()
+
+    def _held(self):
+        if not hasattr(self._local, 'held'):
+            self._local.held = []
+        return self._local.held
+
+    def _current(self, fn_root, fd_):
+        '''
+        Return True if the open lock file is still the lock file of the
+        directory
+        '''
+        try:
+            return os.path.samestat(
+                os.fstat(fd_),
+                os.stat(os.path.join(fn_root, LOCK_FN)))
+        except OSError:
+            return False
+
+    def _fd(self, fn_root):
+        '''
+        Return the open lock file of the directory, the lock file is
+        reopened if it has been removed or replaced since it was opened
+        '''
+        fd_ = self._fds.get(fn_root)
+        if fd_ is not None:
+            if self._current(fn_root, fd_):
+                return fd_
+            os.close(fd_)
+        if not os.path.isdir(fn_root):
+            os.makedirs(fn_root)
+        fd_ = os.open(os.path.join(fn_root, LOCK_FN), os.O_RDWR | os.O_CREAT)
+        self._fds[fn_root] = fd_
+        return fd_
+
+    def _read_gen(self, fd_):
+        os.lseek(fd_, 0, 0)
+        raw = os.read(fd_, struct.calcsize(GEN_FMT))
+        if len(raw) < struct.calcsize(GEN_FMT):
+            return 0
+        return struct.unpack(GEN_FMT, raw)[0]
+
+    def generation(self, fn_root):
+        '''
+        Return the generation of the directory as last seen by this process
+        '''
+        return self._gens.get(fn_root, 0)
+
+    def mark(self):
+        '''
+        Return a marker for the locks held by this thread, pass it to
+        release to release the locks taken after it
+        '''
+        return len(self._held())
+
+    def acquire(self, fn_roots, exclusive=False):
+        '''
+        Lock the given directories, in sorted order so that processes do not
+        deadlock
+        '''
+        for fn_root in sorted(set(fn_roots)):
+            with self._mutex:
+                if self._holds.get(fn_root):
+                    if exclusive and not self._exclusive[fn_root]:
+                        raise RuntimeError(
+                            'Can not upgrade a shared directory lock')
+                    self._holds[fn_root] += 1
+                    self._held().append(fn_root)
+                    continue
+                while True:
+                    fd_ = self._fd(fn_root)
+                    if exclusive:
+                        fcntl.flock(fd_, fcntl.LOCK_EX)
+                    else:
+                        fcntl.flock(fd_, fcntl.LOCK_SH)
+                    if self._current(fn_root, fd_):
+                        break
+                    # The lock file was replaced while waiting for it
+                    fcntl.flock(fd_, fcntl.LOCK_UN)
+                self._holds[fn_root] = 1
+                self._exclusive[fn_root] = exclusive
+                self._held().append(fn_root)
+                gen = self._read_gen(fd_)
+                last = self._gens.get(fn_root)
+                self._gens[fn_root] = gen
+                if last is not None and last != gen and self.on_stale:
+                    self.on_stale(fn_root)
+
+    def release(self, mark=0):
+        '''
+        Release the locks taken by this thread since the mark, the
+        generation of directories which were locked exclusive is bumped
+        '''
+        held = self._held()
+        while len(held) > mark:
+            fn_root = held.pop()
+            with self._mutex:
+                self._holds[fn_root] -= 1
+                if self._holds[fn_root]:
+                    continue
+                fd_ = self._fds[fn_root]
+                if self._exclusive[fn_root]:
+                    gen = self._read_gen(fd_) + 1
+                    os.lseek(fd_, 0, 0)
+                    os.write(fd_, struct.pack(GEN_FMT, gen))
+                    self._gens[fn_root] = gen
+                fcntl.flock(fd_, fcntl.LOCK_UN)
+
+    def close(self):
+        '''
+        Close the lock files
+        '''
+        with self._mutex:
+            for fd_ in self._fds.values():
+                os.close(fd_)
+            self._fds.clear()
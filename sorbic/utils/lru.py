@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+'''
+A least recently used mapping, used to bound caches of open files and data
+'''
+# Import python libs
+import collections
+
+
+class LRU(object):
+    '''
+    Mapping which evicts the least recently used entries once max_entries
+    or max_size is exceeded. Every entry can carry a size, on_evict is called
+    with the key and value of each evicted entry
+    '''
+    def __init__(self, max_entries=None, max_size=None, on_evict=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._sizes = {}
+        # Keys read by peek since they were last moved to the new end
+        self._used = set()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        '''
+        Return the value for the key and mark it as recently used
+        '''
+        if key not in self._data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def peek(self, key, default=None):
+        '''
+        Return the value for the key without reordering the mapping, so the
+        lookup is safe to make without the lock which guards the changes.
+        The use is recorded and the entry is kept when it comes up for
+        eviction, misses are left to get to count
+        '''
+        value = self._data.get(key, default)
+        if value is not default:
+            self.hits += 1
+            self._used.add(key)
+        return value
+
+    def set(self, key, value, size=0):
+        '''
+        Add the key to the mapping, evicting old entries if needed
+        '''
+        self.pop(key)
+        self._data[key] = value
+        self._sizes[key] = size
+        self.size += size
+        self._evict(key)
+
+    def pop(self, key, default=None):
+        '''
+        Remove the key without calling on_evict
+        '''
+        if key not in self._data:
+            return default
+        self._used.discard(key)
+        self.size -= self._sizes.pop(key)
+        return self._data.pop(key)
+
+    def clear(self):
+        '''
+        Remove all entries without calling on_evict
+        '''
+        self._data.clear()
+        self._sizes.clear()
+        self._used.clear()
+        self.size = 0
+
+    def _evict(self, keep):
+        '''
+        Evict the oldest entries until the bounds are met, the keep key is
+        never evicted
+        '''
+        while len(self._data) > 1:
+            if (self.max_entries is not None and
+                    len(self._data) > self.max_entries):
+                pass
+            elif self.max_size is not None and self.size > self.max_size:
+                pass
+            else:
+                return
+            key = next(iter(self._data))
+            if key == keep:
+                return
+            if key in self._used:
+                # Peeked at since it was last moved, give it another round
+                self._used.discard(key)
+                self._data[key] = self._data.pop(key)
+                continue
+            value = self.pop(key)
+            self.evictions += 1
+            if self.on_evict:
+                self.on_evict(key, value)
+
+    def stats(self):
+        '''
+        Return the usage statistics for the mapping
+        '''
+        lookups = self.hits + self.misses
+        return {'entries': len(self._data),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+'''
+A readers/writer lock, many threads can read at once while writes are made
+by one thread at a time
+'''
+# Import python libs
+import threading
+import contextlib
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
+
+
+class RWLock(object):
+    '''
+    Lock which is shared by readers and held alone by a writer. Waiting
+    writers keep new readers out so that they are not starved. Both sides
+    can be taken again by the thread which holds them, and the writer can
+    also read
+    '''
+    def __init__(self):
+        # The lock is taken directly, the condition is only used to wait
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._local = threading.local()
+        self._readers = 0
+        self._writer = None
+        self._writes = 0
+        self._waiting = 0
+        # Readers blocked by a writer and the number of times the lock has
+        # been taken, used to hand the lock over in yield_write
+        self._blocked = 0
+        self._turns = 0
+        self._yielding = False
+
+    def _held(self):
+        return getattr(self._local, 'reads', 0)
+
+    def acquire_read(self):
+        '''
+        Take the lock for reading
+        '''
+        if self._held() or self._writer == get_ident():
+            self._local.reads = self._held() + 1
+            return
+        with self._lock:
+            while self._writer is not None or self._waiting:
+                self._blocked += 1
+                self._cond.wait()
+                self._blocked -= 1
+            self._readers += 1
+            self._take()
+        self._local.reads = 1
+
+    def release_read(self):
+        '''
+        Release a read hold of the lock
+        '''
+        self._local.reads -= 1
+        if self._local.reads:
+            return
+        if self._writer == get_ident():
+            return
+        with self._lock:
+            self._readers -= 1
+            # Only writers wait for the readers to leave
+            if not self._readers and self._waiting:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        '''
+        Take the lock for writing
+        '''
+        ident = get_ident()
+        if self._writer == ident:
+            self._writes += 1
+            return
+        if self._held():
+            raise RuntimeError('Can not take the write lock while reading')
+        with self._lock:
+            self._waiting += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting -= 1
+            self._writer = ident
+            self._writes = 1
+            self._take()
+
+    def _take(self):
+        # Wake the writer waiting in yield_write for the lock to be taken
+        self._turns += 1
+        if self._yielding:
+            self._cond.notify_all()
+
+    def release_write(self):
+        '''
+        Release a write hold of the lock
+        '''
+        with self._lock:
+            self._writes -= 1
+            if not self._writes:
+                self._writer = None
+                self._cond.notify_all()
+
+    def yield_write(self):
+        '''
+        Let the threads waiting for the lock take it and take it back once
+        one of them has, so that a long write can be made in steps without
+        starving the other threads. Does nothing if no thread is waiting
+        '''
+        with self._lock:
+            if not self._waiting and not self._blocked:
+                return
+            writes = self._writes
+            turn = self._turns
+            self._writer = None
+            self._writes = 0
+            self._yielding = True
+            self._cond.notify_all()
+            while self._turns == turn:
+                self._cond.wait()
+            self._yielding = False
+        self.acquire_write()
+        self._writes = writes
+
+    @contextlib.contextmanager
+    def read(self):
+        '''
+        Hold the lock for reading in a with block
+        '''
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write(self):
+        '''
+        Hold the lock for writing in a with block
+        '''
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+'''
+Test the asyncio interface
+'''
+# Import sorbic libs
+import sorbic.db
+
+# Import python libs
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    import sorbic.aio
+    # asyncio or the trollius backport
+    asyncio = sorbic.aio.asyncio
+    HAS_ASYNCIO = True
+except ImportError:
+    HAS_ASYNCIO = False
+
+
+class MemDB(object):
+    '''
+    Blocking in memory stand in for the DB, which counts the reads and can
+    hold a compaction until a get was served
+    '''
+    def __init__(self):
+        self.data = {}
+        self.calls = []
+        self.closed = False
+        self.served = threading.Event()
+
+    def get(self, key, id_=None, meta=False, **kwargs):
+        self.calls.append(('get', key))
+        self.served.set()
+        return self.data.get(key)
+
+    def get_many(self, keys, meta=False, **kwargs):
+        return [self.data.get(key) for key in keys]
+
+    def insert(self, key, data, id_=None, type_='doc', serial=None, **kwargs):
+        self.data[key] = data
+        return {'id': id_}
+
+    def insert_many(self, items, type_='doc', serial=None, **kwargs):
+        for key, data in items:
+            self.data[key] = data
+        return [{} for _ in items]
+
+    def rm(self, key, id_=None, **kwargs):
+        return self.data.pop(key, None) is not None
+
+    def listdir(self, d_key):
+        prefix = '{0}/'.format(d_key)
+        return [key for key in self.data if key.startswith(prefix)]
+
+    def compress(self, d_key=None, num=None, progress=None):
+        # Only finishes once the loop has served a get on the pool
+        if not self.served.wait(5):
+            raise RuntimeError('The pool was blocked by the compaction')
+        return {'keys': len(self.data)}
+
+    def close(self):
+        self.closed = True
+
+
+@unittest.skipUnless(HAS_ASYNCIO, 'asyncio is not available')
+class TestAIO(unittest.TestCase):
+    '''
+    Cover the AsyncDB methods
+    '''
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.db = MemDB()
+        self.adb = sorbic.aio.AsyncDB(db=self.db, max_workers=2)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.adb.close())
+        self.assertTrue(self.db.closed)
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def _run(self, *futs):
+        return self.loop.run_until_complete(asyncio.gather(*futs))
+
+    def test_loop(self):
+        '''
+        Verify that the futures are made on the loop of the AsyncDB when it
+        is used outside of a running loop
+        '''
+        self.assertIs(self.adb.loop, self.loop)
+        other = asyncio.new_event_loop()
+        try:
+            adb = sorbic.aio.AsyncDB(db=MemDB(), loop=other)
+            fut = adb.insert('foo', {1: 1})
+            self.assertEqual(other.run_until_complete(fut), {'id': None})
+            other.run_until_complete(adb.close())
+        finally:
+            other.close()
+
+    def test_insert_get(self):
+        '''
+        Verify that data can be written and read through the event loop
+        '''
+        self._run(*[self.adb.insert('foo/{0}'.format(num), {1: num})
+                    for num in range(20)])
+        rets = self._run(*[self.adb.get('foo/{0}'.format(num))
+                           for num in range(20)])
+        self.assertEqual(rets, [{1: num} for num in range(20)])
+        rets = self._run(self.adb.get_many(['foo/1', 'foo/2', 'bar']))
+        self.assertEqual(rets, [[{1: 1}, {1: 2}, None]])
+        self.assertEqual(len(self._run(self.adb.listdir('foo'))[0]), 20)
+        self._run(self.adb.insert_many({'foo/20': {1: 20}}))
+        self._run(self.adb.rm('foo/1'))
+        self.assertEqual(self._run(self.adb.get('foo/1')), [None])
+        self.assertEqual(self._run(self.adb.get('foo/20')), [{1: 20}])
+
+    def test_coalesce(self):
+        '''
+        Verify that concurrent gets of a key share one read and that a get
+        after a write does not join a read made before it
+        '''
+        self._run(self.adb.insert('foo', {1: 1}))
+        rets = self._run(*[self.adb.get('foo') for _ in range(10)])
+        self.assertEqual(rets, [{1: 1}] * 10)
+        self.assertEqual(self.db.calls, [('get', 'foo')])
+        first = self.adb.get('foo')
+        self._run(self.adb.insert('foo', {1: 2}))
+        self.assertEqual(self._run(first, self.adb.get('foo'))[1], {1: 2})
+
+    def test_compress(self):
+        '''
+        Verify that compaction runs while the loop keeps serving
+        '''
+        self._run(*[self.adb.insert(str(num), {1: num}) for num in range(50)])
+        self._run(*[self.adb.rm(str(num)) for num in range(0, 50, 2)])
+        stats, ret = self._run(self.adb.compress('', 0), self.adb.get('1'))
+        self.assertEqual(ret, {1: 1})
+        self.assertEqual(stats['keys'], 25)
+
+
+@unittest.skipUnless(HAS_ASYNCIO, 'asyncio is not available')
+class TestAIODB(unittest.TestCase):
+    '''
+    Cover the AsyncDB methods against a database on disk
+    '''
+    def setUp(self):
+        self.w_dir = tempfile.mkdtemp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.adb = sorbic.aio.AsyncDB(
+            os.path.join(self.w_dir, 'db_root'),
+            max_workers=4)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.adb.close())
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        shutil.rmtree(self.w_dir)
+
+    def _run(self, *futs):
+        return self.loop.run_until_complete(asyncio.gather(*futs))
+
+    def test_db(self):
+        '''
+        Verify that the calls run against the database in the thread pool
+        '''
+        self.assertIsInstance(self.adb.db, sorbic.db.DB)
+        self._run(*[self.adb.insert('foo/{0}'.format(num), {1: num})
+                    for num in range(50)])
+        rets = self._run(*[self.adb.get('foo/{0}'.format(num))
+                           for num in range(50)])
+        self.assertEqual(rets, [{1: num} for num in range(50)])
+        rets = self._run(*[self.adb.get('foo/7') for _ in range(10)])
+        self.assertEqual(rets, [{1: 7}] * 10)
+        rets = self._run(self.adb.get_many(['foo/1', 'foo/2', 'bar']))
+        self.assertEqual(rets, [[{1: 1}, {1: 2}, None]])
+        self.assertEqual(len(self._run(self.adb.listdir('foo'))[0]), 50)
+        self._run(self.adb.insert_many({'foo/50': {1: 50}}))
+        self._run(*[self.adb.rm('foo/{0}'.format(num))
+                    for num in range(0, 50, 2)])
+        self.assertEqual(self._run(self.adb.get('foo/0')), [None])
+        stats, ret = self._run(
+            self.adb.compress('foo', 0),
+            self.adb.get('foo/1'))
+        self.assertEqual(ret, {1: 1})
+        self.assertEqual(stats['keys'], 26)
+        self.assertEqual(len(self._run(self.adb.listdir('foo'))[0]), 26)
+        self.assertEqual(self._run(self.adb.get('foo/50')), [{1: 50}])
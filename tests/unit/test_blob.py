@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+'''
+Test the descriptor backed handles of stored data
+'''
+# Import sorbic libs
+import sorbic.db
+
+# Import python libs
+import os
+import socket
+import shutil
+import binascii
+import unittest
+import tempfile
+
+# Import third party libs
+import msgpack
+
+
+class TestBlob(unittest.TestCase):
+    '''
+    Cover opening files and documents as blobs
+    '''
+    def setUp(self):
+        self.w_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.w_dir, 'db_root')
+
+    def tearDown(self):
+        shutil.rmtree(self.w_dir)
+
+    def _send(self, blob):
+        '''
+        Send the blob over a socket pair and return the received bytes
+        '''
+        left, right = socket.socketpair()
+        try:
+            self.assertEqual(blob.send(left), blob.size)
+            left.close()
+            ret = []
+            while True:
+                chunk = right.recv(0x10000)
+                if not chunk:
+                    break
+                ret.append(chunk)
+            return ''.join(ret)
+        finally:
+            left.close()
+            right.close()
+
+    def test_file(self):
+        '''
+        Verify that file blobs expose the stored file
+        '''
+        db_ = sorbic.db.DB(self.root)
+        data = ''.join(chr(num % 251) for num in range(100000))
+        db_.insert('foo', data, type_='file')
+        old_id = db_.insert('bar', 'old', type_='file')['id']
+        db_.insert('bar', 'new', type_='file')
+        with db_.open_blob('foo') as blob:
+            self.assertEqual(blob.size, len(data))
+            self.assertEqual(blob.crc, binascii.crc32(data) & 0xffffffff)
+            self.assertEqual(os.read(blob.fileno(), 10), data[:10])
+            self.assertEqual(bytes(blob.view()), data)
+            self.assertEqual(self._send(blob), data)
+            self.assertEqual(blob.read(5), data[:5])
+            self.assertEqual(blob.read(), data[5:])
+        with db_.open_blob('bar', old_id) as blob:
+            self.assertEqual(blob.read(), 'old')
+        with db_.open_blob('bar', rev=1) as blob:
+            blob.seek(1)
+            self.assertEqual(blob.read(), 'ew')
+        self.assertIsNone(db_.open_blob('missing'))
+        blob = db_.open_blob('foo')
+        db_.rm('foo')
+        self.assertEqual(blob.read(), data)
+        blob.close()
+        db_.close()
+
+    def test_doc(self):
+        '''
+        Verify that document blobs expose the serialized bytes in the table
+        '''
+        for data_logs in (False, True):
+            root = os.path.join(self.w_dir, str(data_logs))
+            db_ = sorbic.db.DB(root, data_logs=data_logs)
+            for num in range(50):
+                db_.insert(str(num), {'num': num, 'pad': 'x' * num})
+            for num in range(50):
+                with db_.open_blob(str(num)) as blob:
+                    doc = msgpack.loads(blob.read())
+                    self.assertEqual(doc, {'num': num, 'pad': 'x' * num})
+                    raw = bytes(blob.view())
+                    self.assertEqual(self._send(blob), raw)
+                    self.assertEqual(blob.crc, binascii.crc32(raw) & 0xffffffff)
+            blob = db_.open_blob('10')
+            db_.rm('10')
+            db_.compress('', 0)
+            self.assertEqual(
+                msgpack.loads(blob.read()),
+                {'num': 10, 'pad': 'x' * 10})
+            blob.close()
+            db_.close()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+'''
+Test the Bloom filters of the tables
+'''
+# Import sorbic libs
+import sorbic.db
+
+# Import python libs
+import os
+import shutil
+import unittest
+import tempfile
+
+
+class TestBloom(unittest.TestCase):
+    '''
+    Cover skipping the tables of a collision chain with the Bloom filters
+    '''
+    def setUp(self):
+        self.w_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.w_dir)
+
+    def _db(self, name, **kwargs):
+        db_ = sorbic.db.DB(
+            os.path.join(self.w_dir, name),
+            hash_limit=0xf,
+            **kwargs)
+        for num in range(200):
+            db_.insert(str(num), {1: num})
+        return db_
+
+    def _reads(self, db_, keys):
+        '''
+        Get the keys and return the number of buckets read
+        '''
+        reads = []
+        read_raw_bucket = db_.index._read_raw_bucket
+
+        def counted(table, pos):
+            reads.append(pos)
+            return read_raw_bucket(table, pos)
+        db_.index._read_raw_bucket = counted
+        for key in keys:
+            db_.get(key)
+        del db_.index._read_raw_bucket
+        return len(reads)
+
+    def test_chain(self):
+        '''
+        Verify that misses and deep hits skip the tables
+        '''
+        bloom = self._db('bloom', bloom=True)
+        plain = self._db('plain')
+        root = os.path.join(self.w_dir, 'bloom')
+        self.assertTrue(len(bloom.index.table_fns(root)) > 4)
+        blm_fn = os.path.join(root, 'sorbic_table_0.blm')
+        self.assertTrue(os.path.isfile(blm_fn))
+        for num in range(200):
+            self.assertEqual(bloom.get(str(num)), {1: num})
+        misses = ['miss_{0}'.format(num) for num in range(100)]
+        for key in misses:
+            self.assertIsNone(bloom.get(key))
+        self.assertTrue(
+            self._reads(bloom, misses) * 4 < self._reads(plain, misses))
+        hits = [str(num) for num in range(200)]
+        self.assertTrue(self._reads(bloom, hits) * 2 < self._reads(plain, hits))
+        bloom.close()
+        plain.close()
+
+    def test_rebuild(self):
+        '''
+        Verify that a missing filter is rebuilt and that compaction drops
+        the removed keys
+        '''
+        root = os.path.join(self.w_dir, 'bloom')
+        db_ = self._db('bloom', bloom=True)
+        db_.close()
+        for fn_ in os.listdir(root):
+            if fn_.endswith('.blm'):
+                os.remove(os.path.join(root, fn_))
+        db_ = sorbic.db.DB(root)
+        for num in range(200):
+            self.assertEqual(db_.get(str(num)), {1: num})
+        for num in range(0, 200, 2):
+            db_.rm(str(num))
+        for num in range(len(db_.index.table_fns(root))):
+            db_.compress('', num)
+        for num in range(200):
+            expected = None if num % 2 == 0 else {1: num}
+            self.assertEqual(db_.get(str(num)), expected)
+        table = db_.index.get_hash_table(os.path.join(root, 'sorbic_table_0'))
+        c_keys = [db_.index.raw_crypt_key(str(num)) for num in range(0, 200, 2)]
+        hits = sum(db_.index._bloom_has(table, c_key) for c_key in c_keys)
+        self.assertTrue(hits < 20)
+        db_.close()
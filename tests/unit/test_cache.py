@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+'''
+Test the document cache
+'''
+# Import sorbic libs
+import sorbic.db
+
+# Import python libs
+import os
+import shutil
+import unittest
+import tempfile
+
+
+class TestCache(unittest.TestCase):
+    '''
+    Cover the document cache
+    '''
+    def setUp(self):
+        self.w_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.w_dir, 'db_root')
+
+    def tearDown(self):
+        shutil.rmtree(self.w_dir)
+
+    def test_hits(self):
+        '''
+        Verify that repeated gets are served from the cache
+        '''
+        db_ = sorbic.db.DB(self.root, cache_entries=10)
+        data = {'cheese': {'spam': 'bacon'}}
+        entry = db_.insert('foo/bar', data)
+        for _ in range(5):
+            self.assertEqual(data, db_.get('foo/bar'))
+        self.assertEqual('bacon', db_.get('foo/bar', doc_path='cheese:spam'))
+        self.assertEqual(data, db_.get('foo/bar', entry['id']))
+        pull = db_.get('foo/bar', meta=True)
+        self.assertEqual(entry['id'], pull['meta']['data']['id'])
+        stats = db_.doc_cache_stats()
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hits'], 6)
+        self.assertEqual(stats['entries'], 2)
+        self.assertTrue(stats['size'] > 0)
+
+    def test_invalidate(self):
+        '''
+        Verify that writes and removals invalidate the cached documents
+        '''
+        db_ = sorbic.db.DB(self.root, cache_entries=10)
+        db_.insert('foo/bar', {1: 1})
+        db_.insert('foo/baz', {1: 1})
+        self.assertEqual({1: 1}, db_.get('foo/bar'))
+        db_.insert('foo/bar', {1: 2})
+        self.assertEqual({1: 2}, db_.get('foo/bar'))
+        db_.insert_many([('foo/bar', {1: 3})])
+        self.assertEqual({1: 3}, db_.get('foo/bar'))
+        db_.rm('foo/bar')
+        self.assertIsNone(db_.get('foo/bar'))
+        self.assertEqual({1: 1}, db_.get('foo/baz'))
+        db_.rmdir('foo')
+        self.assertIsNone(db_.get('foo/baz'))
+        self.assertEqual(db_.doc_cache_stats()['entries'], 0)
+
+    def test_bounds(self):
+        '''
+        Verify that the cache stays within the entry and byte bounds
+        '''
+        db_ = sorbic.db.DB(self.root, cache_entries=5, cache_bytes=1024)
+        for num in range(20):
+            db_.insert(str(num), {1: num})
+            db_.get(str(num))
+        self.assertEqual(db_.doc_cache_stats()['entries'], 5)
+        db_ = sorbic.db.DB(self.root, cache_bytes=100)
+        for num in range(20):
+            db_.insert(str(num), {1: 'x' * 40})
+            db_.get(str(num))
+        stats = db_.doc_cache_stats()
+        self.assertTrue(stats['size'] <= 100)
+        self.assertEqual(stats['evictions'], 18)
+        self.assertEqual(len(db_._cache_keys), 2)
+
+    def test_codec_bounds(self):
+        '''
+        Verify that compressed documents are charged their serialized size
+        '''
+        db_ = sorbic.db.DB(self.root, cache_bytes=2048, codec='zlib')
+        for num in range(5):
+            db_.insert(str(num), {1: 'x' * 1000})
+            self.assertEqual({1: 'x' * 1000}, db_.get(str(num)))
+        stats = db_.doc_cache_stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertTrue(2000 < stats['size'] <= 2048)
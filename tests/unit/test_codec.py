@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+'''
+Test the compression of the stored data
+'''
+# Import sorbic libs
+import sorbic.db
+import sorbic.stor.codec
+
+# Import python libs
+import os
+import shutil
+import unittest
+import tempfile
+
+
+class TestCodec(unittest.TestCase):
+    '''
+    Cover compressing documents and files with the codecs
+    '''
+    def setUp(self):
+        self.w_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.w_dir)
+
+    def _doc(self, num):
+        return {'num': num, 'items': [{'name': 'item', 'state': 'ok'}] * 40}
+
+    def test_docs(self):
+        '''
+        Verify that every codec stores smaller documents and that the
+        documents are read back by a database with another codec
+        '''
+        for codec in sorted(sorbic.stor.codec.CODECS):
+            root = os.path.join(self.w_dir, codec)
+            db_ = sorbic.db.DB(root, hash_limit=0xff, codec=codec)
+            ids = [db_.insert('foo', self._doc(num))['id'] for num in range(20)]
+            db_.insert('small', {1: 2})
+            db_.insert_many([('many', self._doc(1)), ('many', self._doc(2))])
+            self.assertEqual(db_.get_meta('many')['data']['c'], codec)
+            self.assertEqual(db_.get('many', rev=0), self._doc(1))
+            meta = db_.get_meta('foo')['data']
+            self.assertEqual(meta['c'], codec)
+            size = len(db_.index.serialize(self._doc(19)))
+            self.assertTrue(meta['sz'] * 4 < size)
+            self.assertNotIn('c', db_.get_meta('small')['data'])
+            with db_.open_blob('foo') as blob:
+                self.assertEqual(blob.codec, codec)
+                self.assertEqual(blob.size, meta['sz'])
+            db_.rm('foo', ids[0])
+            db_.compress('', 0)
+            self.assertEqual(db_.get_meta('foo')['data']['c'], codec)
+            db_.close()
+            db_ = sorbic.db.DB(root)
+            for num in range(1, 20):
+                self.assertEqual(db_.get('foo', ids[num]), self._doc(num))
+            self.assertEqual(db_.get('foo', doc_path='items:0:state'), 'ok')
+            self.assertEqual(db_.get('small'), {1: 2})
+            db_.close()
+
+    def test_files(self):
+        '''
+        Verify that files are compressed, deduplicated and read in ranges
+        '''
+        root = os.path.join(self.w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, codec='zlib')
+        data = 'line of a log file\n' * 1000
+        db_.insert('foo', data, type_='file')
+        db_.insert('bar', data, type_='file')
+        db_.insert('baz', iter([data]), type_='file')
+        meta = db_.get_meta('foo')['data']
+        self.assertEqual(meta['c'], 'zlib')
+        self.assertTrue(meta['path'].endswith('.zlib'))
+        self.assertEqual(meta['path'], db_.get_meta('bar')['data']['path'])
+        self.assertTrue(os.path.getsize(meta['path']) * 10 < len(data))
+        self.assertNotIn('c', db_.get_meta('baz')['data'])
+        for key in ('foo', 'baz'):
+            self.assertEqual(db_.get(key), data)
+            self.assertEqual(db_.get(key, offset=19, length=19), data[19:38])
+            reader = db_.get(key, offset=len(data) - 5, stream=True)
+            self.assertEqual(reader.read(), data[-5:])
+            reader.close()
+        db_.rm('foo')
+        db_.rm('bar')
+        self.assertFalse(os.path.exists(meta['path']))
+        db_.close()
+
+    def test_reopen(self):
+        '''
+        Verify that the codec is chosen on every open and is not kept in
+        the database metadata
+        '''
+        root = os.path.join(self.w_dir, 'db_root')
+        db_ = sorbic.db.DB(root)
+        db_.insert('plain', self._doc(1))
+        db_.close()
+        db_ = sorbic.db.DB(root, codec='zlib')
+        db_.insert('zlib', self._doc(2))
+        self.assertEqual(db_.get_meta('zlib')['data']['c'], 'zlib')
+        db_.close()
+        db_ = sorbic.db.DB(root)
+        db_.insert('again', self._doc(3))
+        self.assertNotIn('c', db_.get_meta('again')['data'])
+        self.assertNotIn('c', db_.get_meta('plain')['data'])
+        self.assertEqual(db_.get('zlib'), self._doc(2))
+        db_.close()
+
+    def test_unknown(self):
+        '''
+        Verify that an unavailable codec is refused
+        '''
+        root = os.path.join(self.w_dir, 'db_root')
+        self.assertRaises(ValueError, sorbic.db.DB, root, codec='nothing')
+        self.assertFalse(os.path.exists(root))
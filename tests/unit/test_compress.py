@@ -4,6 +4,7 @@ Test database compression functions
 '''
 # Import sorbic libs
 import sorbic.db
+import sorbic.ind.hdht
 
 # Import python libs
 import os
@@ -104,3 +105,164 @@ class TestCompress(unittest.TestCase):
             pull_data = db.get(key)
             self.assertEqual(data, pull_data)
         shutil.rmtree(w_dir)
+
+    def test_compress_revs(self):
+        '''
+        Verify that the revision chain of a key is intact after compression
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db = sorbic.db.DB(root)
+        ids = []
+        for num in xrange(10):
+            ids.append(db.insert('foo', {1: num})['id'])
+        db.rm('foo', ids[5])
+        db.compress('', 0)
+        self.assertEqual(
+                db.get('foo', count=10),
+                [{1: num} for num in xrange(9, -1, -1) if num != 5])
+        self.assertEqual({1: 2}, db.get('foo', ids[2]))
+        shutil.rmtree(w_dir)
+
+    def test_compress_file(self):
+        '''
+        Verify that file entries survive compression
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db = sorbic.db.DB(root)
+        db.insert('foo', 'file contents', type_='file')
+        db.compress('', 0)
+        pull_data = db.get('foo', meta=True)
+        self.assertEqual('file contents', pull_data['data'])
+        self.assertEqual('file', pull_data['meta']['data']['t'])
+        shutil.rmtree(w_dir)
+
+    def test_compress_raw_copy(self):
+        '''
+        Verify that the stored document bytes are copied unchanged
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db = sorbic.db.DB(root, serial='json')
+        data = {u'cheese': [1, 2, 3]}
+        db.insert('foo', {u'old': 1})
+        db.insert('foo', data)
+        db.rm('foo', db.get('foo', count=2, meta=True)[1]['meta']['id'])
+        before = db.get('foo', meta=True)['meta']['data']
+        db.compress('', 0)
+        after = db.get('foo', meta=True)
+        self.assertEqual(data, after['data'])
+        self.assertEqual(before['sz'], after['meta']['data']['sz'])
+        self.assertTrue(after['meta']['data']['st'] < before['st'])
+        shutil.rmtree(w_dir)
+
+    def test_compress_stats(self):
+        '''
+        Verify the compaction progress and stats reporting
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db = sorbic.db.DB(root, hash_limit=0xffff)
+        for num in xrange(100):
+            db.insert(str(num), {1: num})
+            db.insert(str(num), {1: num})
+        for num in xrange(50):
+            db.rm(str(num))
+        for num in xrange(50, 60):
+            entries = db.get(str(num), count=2, meta=True)
+            db.rm(str(num), entries[1]['meta']['id'])
+        calls = []
+        stats = db.compress('', 0, progress=calls.append)
+        self.assertEqual(stats['keys'], 50)
+        self.assertEqual(stats['revs'], 100)
+        self.assertEqual(stats['kept'], 90)
+        self.assertEqual(stats['dropped'], 10)
+        self.assertEqual(stats['buckets'], stats['total'])
+        self.assertTrue(stats['reclaimed'] > 0)
+        self.assertEqual(stats['grown'], 0)
+        self.assertEqual(
+                stats['reclaimed'],
+                stats['bytes_before'] - stats['bytes_after'])
+        self.assertTrue(len(calls) > 2)
+        self.assertEqual(calls[-1], stats)
+        self.assertEqual(calls[0]['buckets'], 0)
+        for num in xrange(100):
+            if num < 50:
+                self.assertIsNone(db.get(str(num)))
+            else:
+                self.assertEqual({1: num}, db.get(str(num)))
+        shutil.rmtree(w_dir)
+
+    def test_compress_removed_ids(self):
+        '''
+        Verify that a key whose revisions were all removed by id keeps its
+        bucket through compaction, so the colliding keys stored past it can
+        still be found
+        '''
+        for probe in (None, 'linear'):
+            w_dir = tempfile.mkdtemp()
+            root = os.path.join(w_dir, 'db_root')
+            db = sorbic.db.DB(root, hash_limit=0xf, probe=probe)
+            for num in xrange(40):
+                db.insert(str(num), {1: num})
+            for num in xrange(0, 40, 4):
+                db.rm(str(num), db.get_meta(str(num))['data']['id'])
+            for num in xrange(len(db.index.table_fns(root))):
+                db.compress('', num)
+            for num in xrange(40):
+                if num % 4:
+                    self.assertEqual({1: num}, db.get(str(num)))
+                else:
+                    self.assertIsNone(db.get(str(num)))
+            db.close()
+            shutil.rmtree(w_dir)
+
+    def test_compress_grown_stats(self):
+        '''
+        Verify that compaction which makes the tables larger reports the
+        growth instead of a negative reclaimed size
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db = sorbic.db.DB(root)
+        db.insert('foo', {1: 1})
+        fn_ = os.path.join(root, 'sorbic_table_0')
+        stats = db.index._compact_stats([], None)
+        stats['bytes_before'] = 100
+        stats = db.index._compact_done([fn_], stats, None)
+        self.assertEqual(stats['reclaimed'], 0)
+        self.assertEqual(stats['grown'], stats['bytes_after'] - 100)
+        self.assertTrue(stats['grown'] > 0)
+        shutil.rmtree(w_dir)
+
+    def test_compress_old_format(self):
+        '''
+        Verify that tables written with other bucket position fields keep
+        their keys through compression
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        pos_hash = sorbic.ind.hdht.POS_HASH
+        # Tables written before the digest positions hashed with hash()
+        sorbic.ind.hdht.POS_HASH = None
+        try:
+            db = sorbic.db.DB(root, hash_limit=0xff, probe='linear')
+            for num in xrange(50):
+                db.insert(str(num), {1: num})
+            db.close()
+        finally:
+            sorbic.ind.hdht.POS_HASH = pos_hash
+        db = sorbic.db.DB(root, probe=None)
+        db.rm('0')
+        db.compress('', 0)
+        table = db.index.get_hash_table(os.path.join(root, 'sorbic_table_0'))
+        self.assertIsNone(table.get('pos_hash'))
+        self.assertEqual(table['layout'], 'linear')
+        for num in xrange(1, 50):
+            self.assertEqual({1: num}, db.get(str(num)))
+        self.assertIsNone(db.get('0'))
+        db.insert('new', {1: 'new'})
+        self.assertEqual({1: 'new'}, db.get('new'))
+        db.close()
+        shutil.rmtree(w_dir)
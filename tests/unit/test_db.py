@@ -218,6 +218,25 @@ class TestDB(unittest.TestCase):
         self.assertEqual(pull_data, data2)
         shutil.rmtree(w_dir)
 
+    def test_rm_collide_small_table(self):
+        '''
+        Verify that removing keys from a table with many collisions leaves
+        the keys in the overflow tables reachable
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, hash_limit=0xf)
+        for num in range(100):
+            db_.insert(str(num), {1: num})
+        for num in range(0, 100, 2):
+            db_.rm(str(num))
+        for num in range(100):
+            if num % 2:
+                self.assertEqual({1: num}, db_.get(str(num)))
+            else:
+                self.assertIsNone(db_.get(str(num)))
+        shutil.rmtree(w_dir)
+
     def test_doc_data(self):
         '''
         Test database creation
@@ -251,3 +270,64 @@ class TestDB(unittest.TestCase):
             db_.insert('foo', data, **ind_extra)
             pull_data = db_.get('foo', meta=True)
             self.assertIn(top_key, pull_data['meta']['data'])
+
+    def test_insert_many(self):
+        '''
+        Verify that a batch insert can be read back key by key
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root)
+        items = []
+        for num in range(100):
+            items.append(('foo/{0}'.format(num), {1: num}))
+            items.append((str(num), {2: num}))
+        items.append(('foo/1', {3: 1}))
+        entries = db_.insert_many(items)
+        self.assertEqual(len(entries), len(items))
+        for num in range(100):
+            self.assertEqual({2: num}, db_.get(str(num)))
+        for num in range(2, 100):
+            self.assertEqual({1: num}, db_.get('foo/{0}'.format(num)))
+        self.assertEqual({3: 1}, db_.get('foo/1'))
+        self.assertEqual({1: 1}, db_.get('foo/1', entries[2]['id']))
+        self.assertEqual(entries[-1]['rev'], entries[2]['rev'] + 1)
+        db_.insert('foo/1', {4: 1})
+        self.assertEqual([{4: 1}, {3: 1}, {1: 1}], db_.get('foo/1', count=3))
+        shutil.rmtree(w_dir)
+
+    def test_insert_many_collide(self):
+        '''
+        Verify that keys which collide in a batch go to overflow tables
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, hash_limit=0xf)
+        db_.insert_many(dict((str(num), {1: num}) for num in range(100)))
+        for num in range(100):
+            self.assertEqual({1: num}, db_.get(str(num)))
+        shutil.rmtree(w_dir)
+
+    def test_get_many(self):
+        '''
+        Verify that a batch get returns the data in the order of the keys
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, hash_limit=0xf)
+        keys = []
+        for num in range(50):
+            db_.insert(str(num), {1: num})
+            db_.insert('foo/{0}'.format(num), {2: num})
+            keys.extend(['foo/{0}'.format(num), str(num)])
+        db_.insert('0', {1: 'new'})
+        db_.rm('1')
+        keys.extend(['missing', 'foo/missing'])
+        pull_data = db_.get_many(keys)
+        self.assertEqual(len(pull_data), len(keys))
+        for ind, key in enumerate(keys):
+            self.assertEqual(db_.get(key), pull_data[ind])
+        self.assertEqual({1: 'new'}, pull_data[1])
+        meta = db_.get_many(['foo/0'], meta=True)
+        self.assertEqual('foo/0', meta[0]['meta']['data']['key'])
+        shutil.rmtree(w_dir)
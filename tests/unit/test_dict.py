@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+'''
+Test the trained compression dictionaries of the key directories
+'''
+# Import sorbic libs
+import sorbic.db
+import sorbic.stor.codec
+
+# Import python libs
+import os
+import shutil
+import unittest
+import tempfile
+
+
+@unittest.skipUnless(sorbic.stor.codec.HAS_ZSTD, 'zstandard is not installed')
+class TestDict(unittest.TestCase):
+    '''
+    Cover training dictionaries and moving documents to them
+    '''
+    def setUp(self):
+        self.w_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.w_dir, 'db_root')
+
+    def tearDown(self):
+        shutil.rmtree(self.w_dir)
+
+    def _doc(self, num):
+        return {'name': 'host-{0}.example.com'.format(num),
+                'state': 'running',
+                'num': num}
+
+    def _dicts(self, root):
+        return sorted(fn_ for fn_ in os.listdir(root)
+                      if fn_.startswith('sorbic_dict_'))
+
+    def test_train(self):
+        '''
+        Verify that documents written after training are compressed with
+        the dictionary and that older documents stay readable
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xfff)
+        for num in range(1000):
+            db_.insert(str(num), self._doc(num))
+        size = db_.get_meta('999')['data']['sz']
+        self.assertEqual(db_.train_dict(''), 1)
+        self.assertEqual(self._dicts(self.root), ['sorbic_dict_1'])
+        for num in range(1000, 1100):
+            db_.insert(str(num), self._doc(num))
+        meta = db_.get_meta('1099')['data']
+        self.assertEqual((meta['c'], meta['d']), ('zstd', 1))
+        self.assertTrue(meta['sz'] * 3 < size * 2, (meta['sz'], size))
+        self.assertNotIn('d', db_.get_meta('0')['data'])
+        db_.insert_many([('many', self._doc(5))])
+        self.assertEqual(db_.get_meta('many')['data']['d'], 1)
+        db_.close()
+        db_ = sorbic.db.DB(self.root)
+        for num in range(0, 1100, 7):
+            self.assertEqual(db_.get(str(num)), self._doc(num))
+        self.assertEqual(db_.get('many'), self._doc(5))
+        db_.close()
+
+    def test_compaction(self):
+        '''
+        Verify that compaction moves documents to the newest dictionary and
+        that resize removes the older dictionaries
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xff)
+        for num in range(1000):
+            db_.insert(str(num), self._doc(num))
+        db_.train_dict('')
+        db_.insert('first', self._doc(1))
+        self.assertEqual(db_.train_dict(''), 2)
+        db_.compress('', 0)
+        table = db_.index.get_hash_table(
+            os.path.join(self.root, 'sorbic_table_0'))
+        for bucket in db_.index._iter_occupied(table):
+            entry = db_.index._read_index_entry(table, bucket['prev'])
+            self.assertEqual(entry['d'], 2)
+        self.assertEqual(len(self._dicts(self.root)), 2)
+        db_.resize('')
+        self.assertEqual(self._dicts(self.root), ['sorbic_dict_2'])
+        for num in range(1000):
+            self.assertEqual(db_.get(str(num)), self._doc(num))
+        self.assertEqual(db_.get('first'), self._doc(1))
+        self.assertEqual(db_.get_meta('first')['data']['d'], 2)
+        db_.close()
+
+    def test_blob(self):
+        '''
+        Verify that a blob of a document compressed with a dictionary names
+        the dictionary and keeps it readable after a resize removes it
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xfff)
+        for num in range(1000):
+            db_.insert(str(num), self._doc(num))
+        db_.train_dict('')
+        db_.insert('foo', self._doc(1))
+        with db_.open_blob('0') as blob:
+            self.assertIsNone(blob.dict_num)
+            self.assertIsNone(blob.read_dict())
+        blob = db_.open_blob('foo')
+        self.assertEqual((blob.codec, blob.dict_num), ('zstd', 1))
+        self.assertEqual(
+            blob.dict_path,
+            os.path.join(self.root, 'sorbic_dict_1'))
+        db_.train_dict('')
+        db_.resize('')
+        self.assertFalse(os.path.exists(blob.dict_path))
+        zdict = sorbic.stor.codec.load_dict(blob.read_dict())
+        raw = sorbic.stor.codec.decompress_dict(zdict, blob.read())
+        blob.close()
+        self.assertEqual(raw, db_.index.serialize(self._doc(1)))
+        db_.close()
+
+    def test_small_docs(self):
+        '''
+        Verify that documents of a few bytes shrink with the dictionary and
+        that frames written with the magic number are still read
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xfff)
+        for num in range(1000):
+            db_.insert(str(num), self._doc(num))
+        db_.train_dict('')
+        doc = {'state': 'running', 'num': 7}
+        raw = db_.index.serialize(doc)
+        self.assertTrue(len(raw) < 24, len(raw))
+        db_.insert('small', doc)
+        meta = db_.get_meta('small')['data']
+        self.assertEqual(meta['d'], 1)
+        self.assertTrue(meta['sz'] < len(raw), (meta['sz'], len(raw)))
+        self.assertEqual(db_.get('small'), doc)
+        zdict = db_.index._doc_dict(self.root, 1)
+        framed = sorbic.stor.codec.zstandard.ZstdCompressor(
+            dict_data=zdict,
+            write_dict_id=False).compress(raw)
+        self.assertEqual(framed[:4], sorbic.stor.codec.ZSTD_MAGIC)
+        self.assertEqual(sorbic.stor.codec.decompress_dict(zdict, framed), raw)
+        db_.close()
+
+    def test_few_docs(self):
+        '''
+        Verify that a directory without enough documents is refused
+        '''
+        db_ = sorbic.db.DB(self.root)
+        db_.insert('foo', {1: 1})
+        self.assertRaises(ValueError, db_.train_dict, '')
+        self.assertEqual(self._dicts(self.root), [])
+        db_.close()
@@ -4,8 +4,10 @@ Test core database functions
 '''
 # Import sorbic libs
 import sorbic.db
+import sorbic.stor.files
 
 # Import python libs
+import io
 import os
 import shutil
 import unittest
@@ -28,3 +30,139 @@ class TestDB(unittest.TestCase):
         pull_data = db_.get('foo')
         self.assertEqual(data, pull_data)
         shutil.rmtree(w_dir)
+
+    def test_insert_many(self):
+        '''
+        Test a batch of file inserts
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root)
+        items = [('foo/{0}'.format(num), 'contents {0}'.format(num))
+                 for num in range(10)]
+        db_.insert_many(items, type_='file')
+        for key, data in items:
+            self.assertEqual(data, db_.get(key))
+        shutil.rmtree(w_dir)
+
+    def _blobs(self, root):
+        blob_dir = os.path.join(root, '.blobs')
+        if not os.path.isdir(blob_dir):
+            return []
+        return sorted(fn_ for fn_ in os.listdir(blob_dir)
+                      if not fn_.endswith('.ref'))
+
+    def test_dedup(self):
+        '''
+        Verify that the same contents are stored once and released with the
+        last entry
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root)
+        ids = [db_.insert('foo', 'artifact', type_='file')['id']
+               for _ in range(3)]
+        db_.insert('bar', 'artifact', type_='file')
+        db_.insert('baz', 'other', type_='file')
+        self.assertEqual(len(self._blobs(root)), 2)
+        fn_ = db_.get_meta('foo')['data']['path']
+        self.assertEqual(sorbic.stor.files._refs(fn_), 4)
+        db_.rm('foo', ids[0])
+        self.assertEqual(sorbic.stor.files._refs(fn_), 4)
+        db_.compress('', 0)
+        self.assertEqual(sorbic.stor.files._refs(fn_), 3)
+        self.assertEqual(db_.get('foo', ids[1]), 'artifact')
+        db_.rm('foo')
+        self.assertEqual(sorbic.stor.files._refs(fn_), 1)
+        db_.rm('bar')
+        db_.compress('', 0)
+        self.assertEqual(len(self._blobs(root)), 1)
+        self.assertEqual(db_.get('baz'), 'other')
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_legacy_release(self):
+        '''
+        Verify that files written before the blob store are removed when
+        compaction drops their entry
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root)
+
+        def legacy(table_entry, data, serial=None):
+            files_dir = os.path.join(root, '.files_0')
+            if not os.path.isdir(files_dir):
+                os.makedirs(files_dir)
+            fn_ = sorbic.stor.files._file_loc(files_dir)
+            with open(fn_, 'wb') as fp_:
+                fp_.write(data)
+            return {'path': fn_, 'crc': 0}
+        db_.write_stor_funcs['file'] = legacy
+        old_id = db_.insert('foo', 'old', type_='file')['id']
+        db_.insert('foo', 'new', type_='file')
+        fns = sorted(os.listdir(os.path.join(root, '.files_0')))
+        self.assertEqual(len(fns), 2)
+        db_.rm('foo', old_id)
+        db_.compress('', 0)
+        self.assertEqual(len(os.listdir(os.path.join(root, '.files_0'))), 1)
+        self.assertEqual(db_.get('foo'), 'new')
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_stream(self):
+        '''
+        Verify that file like objects and iterators are streamed to the
+        blob store and that files can be read in ranges
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root)
+        data = ''.join(chr(num % 251) for num in range(200000))
+        db_.insert('foo', data, type_='file')
+        db_.insert('bar', io.BytesIO(data), type_='file')
+
+        def gen():
+            for num in range(0, len(data), 777):
+                yield data[num:num + 777]
+        db_.insert('baz', gen(), type_='file')
+        self.assertEqual(len(self._blobs(root)), 1)
+        meta = db_.get_meta('foo')['data']
+        fn_ = meta['path']
+        self.assertEqual(sorbic.stor.files._refs(fn_), 3)
+        for key in ('foo', 'bar', 'baz'):
+            self.assertEqual(db_.get_meta(key)['data']['crc'], meta['crc'])
+            self.assertEqual(db_.get(key), data)
+        self.assertEqual(
+            db_.get('bar', offset=70000, length=10),
+            data[70000:70010])
+        self.assertEqual(db_.get('bar', offset=199990), data[199990:])
+        reader = db_.get('baz', stream=True)
+        self.assertEqual(reader.read(5), data[:5])
+        self.assertEqual(reader.read(), data[5:])
+        reader.close()
+        with db_.get('baz', offset=100, length=100000, stream=True) as reader:
+            self.assertEqual(''.join(reader), data[100:100100])
+            self.assertEqual(reader.read(), '')
+        fns = os.listdir(os.path.join(root, '.blobs'))
+        self.assertFalse([tmp for tmp in fns if tmp.endswith('.tmp')])
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_stream_error(self):
+        '''
+        Verify that a stream which fails part way leaves no temporary file
+        in the blob directory and no entry in the index
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root)
+
+        def gen():
+            yield 'start of the file'
+            raise IOError('The source went away')
+        self.assertRaises(IOError, db_.insert, 'foo', gen(), type_='file')
+        self.assertEqual(os.listdir(os.path.join(root, '.blobs')), [])
+        self.assertIsNone(db_.get('foo'))
+        db_.close()
+        shutil.rmtree(w_dir)
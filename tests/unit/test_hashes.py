@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 # Import sorbic libs
 import sorbic.db
+import sorbic.ind.hdht
 
 # Import python libs
 import os
+import sys
 import shutil
+import struct
 import unittest
 import tempfile
+import subprocess
 
 try:
     import libnacl.blake  # pylint: disable=W0611
@@ -37,3 +41,56 @@ class TestDB(unittest.TestCase):
         # don't use hashlib.algorithms, need to support 2.6
         for algo in ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512'):
             self._run_test(algo)
+
+    def test_digest_pos(self):
+        '''
+        Verify that new tables derive the bucket position from the digest
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db = sorbic.db.DB(root)
+        db.insert('foo', {1: 2})
+        c_key = db.index.raw_crypt_key('foo')
+        table_entry = db.index.get_table_entry('foo', c_key)
+        table = db.index.tables[table_entry['tfn']]
+        self.assertEqual(table['pos_hash'], 'digest')
+        pos = struct.unpack('>Q', c_key[:8])[0] & table['hash_limit']
+        self.assertEqual(
+                table_entry['pos'],
+                pos * table['bucket_size'] + table['header_len'])
+        shutil.rmtree(w_dir)
+
+    def test_legacy_pos(self):
+        '''
+        Verify that tables without a pos_hash in the header use the builtin
+        hash
+        '''
+        c_key = 'legacy crypt key'
+        self.assertEqual(
+                sorbic.ind.hdht._calc_pos(c_key, 0xfffff, 10, 1024),
+                (abs(hash(c_key) & 0xfffff) * 10) + 1024)
+
+    def test_cross_process(self):
+        '''
+        Verify that a table written in one process can be read from another
+        process with a different hash seed
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db = sorbic.db.DB(root)
+        for num in range(10):
+            db.insert('foo/{0}'.format(num), {1: num})
+        db.close()
+        code = (
+            'import sorbic.db\n'
+            'db = sorbic.db.DB({0!r})\n'
+            'for num in range(10):\n'
+            '    assert db.get("foo/{{0}}".format(num)) == {{1: num}}\n'
+            ).format(root)
+        env = dict(os.environ)
+        env['PYTHONHASHSEED'] = 'random'
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(sorbic.__file__))
+        self.assertEqual(
+                subprocess.call([sys.executable, '-c', code], env=env),
+                0)
+        shutil.rmtree(w_dir)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+'''
+Test the ordered key index
+'''
+# Import sorbic libs
+import sorbic.db
+import sorbic.ind.keys
+
+# Import python libs
+import os
+import shutil
+import unittest
+import tempfile
+
+
+class TestKeys(unittest.TestCase):
+    '''
+    Cover iter_keys and the key index files
+    '''
+    def test_iter_keys(self):
+        '''
+        Verify that keys come back sorted and bounded
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root)
+        for num in range(500):
+            db_.insert('foo/{0:04d}'.format(num), {1: num})
+        db_.insert('foo/0003', {1: 3})
+        db_.insert('foo/sub/key', {1: 1})
+        db_.insert('top', {1: 1})
+        keys = list(db_.iter_keys('foo/'))
+        self.assertEqual(
+            keys,
+            ['foo/{0:04d}'.format(num) for num in range(500)])
+        self.assertEqual(
+            list(db_.iter_keys('foo/00', start='foo/0050', limit=3)),
+            ['foo/0050', 'foo/0051', 'foo/0052'])
+        self.assertEqual(
+            list(db_.iter_keys('foo/', start='foo/0497')),
+            ['foo/0497', 'foo/0498', 'foo/0499'])
+        self.assertEqual(
+            list(db_.iter_keys('/foo/', end='foo/0002')),
+            ['foo/0000', 'foo/0001'])
+        self.assertEqual(list(db_.iter_keys('foo/sub/')), ['foo/sub/key'])
+        self.assertEqual(list(db_.iter_keys()), ['top'])
+        self.assertEqual(list(db_.iter_keys('bar/')), [])
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_rm_reopen(self):
+        '''
+        Verify that removed keys leave the index and that the log is read
+        back when the database is opened again
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root)
+        db_.insert_many(
+            [('foo/{0}'.format(num), {1: num}) for num in range(10)])
+        first = db_.insert('foo/1', {2: 1})
+        db_.rm('foo/1', first['id'])
+        for num in range(0, 10, 2):
+            db_.rm('foo/{0}'.format(num))
+        db_.compress('foo', 0)
+        db_.close()
+        db_ = sorbic.db.DB(root)
+        expected = ['foo/{0}'.format(num) for num in range(1, 10, 2)]
+        self.assertEqual(list(db_.iter_keys('foo/')), expected)
+        db_.insert('foo/0', {1: 0})
+        self.assertEqual(
+            list(db_.iter_keys('foo/', limit=2)),
+            ['foo/0', 'foo/1'])
+        db_.rmdir('foo')
+        self.assertEqual(list(db_.iter_keys('foo/')), [])
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_build(self):
+        '''
+        Verify that a directory written without a key index is scanned once
+        to build it, and that the log is folded into the sorted file
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, hash_limit=0xff)
+        for num in range(20):
+            db_.insert('foo/{0}'.format(num), {1: num})
+        db_.close()
+        os.remove(os.path.join(root, 'foo', sorbic.ind.keys.KEYS_FN))
+        os.remove(os.path.join(root, 'foo', sorbic.ind.keys.LOG_FN))
+        db_ = sorbic.db.DB(root, hash_limit=0xff)
+        self.assertEqual(
+            list(db_.iter_keys('foo/')),
+            sorted('foo/{0}'.format(num) for num in range(20)))
+        index = db_.index.key_index(os.path.join(root, 'foo'))
+        for num in range(20, sorbic.ind.keys.LOG_MIN + 40):
+            index.add('foo/{0}'.format(num))
+        self.assertTrue(index.logged < 40)
+        index.flush()
+        reread = sorbic.ind.keys.KeyIndex(index.fn_root)
+        reread.load()
+        self.assertEqual(reread.keys, index.keys)
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_log_merge(self):
+        '''
+        Verify that the logged changes are merged with the sorted file and
+        that the sorted file is only read when the keys are listed
+        '''
+        w_dir = tempfile.mkdtemp()
+        index = sorbic.ind.keys.KeyIndex(w_dir)
+        index.build(['a', 'c', 'e'])
+        index.add('b')
+        index.remove('c')
+        index.add('f')
+        index.remove('f')
+        index.remove('e')
+        index.add('e')
+        self.assertEqual(index.range(), ['a', 'b', 'e'])
+        self.assertEqual(index.range(after='a', limit=1), ['b'])
+        index.close()
+        reread = sorbic.ind.keys.KeyIndex(w_dir)
+        reread.load()
+        self.assertEqual(reread.written, 3)
+        self.assertIsNone(reread._fences)
+        self.assertEqual(reread.added, ['b', 'e'])
+        self.assertEqual(reread.keys, ['a', 'b', 'e'])
+        shutil.rmtree(w_dir)
+
+    def test_fences(self):
+        '''
+        Verify that listing seeks the sorted file from the fence keys across
+        the fence boundaries
+        '''
+        w_dir = tempfile.mkdtemp()
+        index = sorbic.ind.keys.KeyIndex(w_dir)
+        keys = ['{0:04d}'.format(num) for num in range(0, 2000, 2)]
+        index.build(keys)
+        index.add('0257')
+        index.remove('0258')
+        index.flush()
+        self.assertEqual(len(index._fences[0]), 8)
+        reread = sorbic.ind.keys.KeyIndex(w_dir)
+        reread.load()
+        self.assertEqual(reread.written, 1000)
+        self.assertEqual(reread.range(start='0255', limit=2), ['0256', '0257'])
+        self.assertEqual(reread._fences, index._fences)
+        self.assertEqual(
+            index.range(after='0256', limit=3),
+            ['0257', '0260', '0262'])
+        self.assertEqual(index.range(start='1999'), [])
+        self.assertEqual(
+            index.range('19', end='1906'),
+            ['1900', '1902', '1904'])
+        index.rewrite()
+        self.assertEqual(index.written, 1000)
+        self.assertEqual(index.keys[128:130], ['0256', '0257'])
+        shutil.rmtree(w_dir)
+
+    def test_compress_dropped(self):
+        '''
+        Verify that a key whose revisions were all removed by id is dropped
+        from the key index by compaction
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root)
+        id_ = db_.insert('d/a', {1: 1})['id']
+        db_.insert('d/b', {1: 2})
+        db_.rm('d/a', id_)
+        db_.compress('d', 0)
+        self.assertIsNone(db_.get('d/a'))
+        self.assertEqual(list(db_.iter_keys('d/')), ['d/b'])
+        db_.close()
+        db_ = sorbic.db.DB(root)
+        self.assertEqual(list(db_.iter_keys('d/')), ['d/b'])
+        db_.resize('d')
+        self.assertEqual(list(db_.iter_keys('d/')), ['d/b'])
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_bounded(self):
+        '''
+        Verify that only the recently used key indexes are kept and that
+        evicted indexes are read back from their files
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, hash_limit=0xf, max_open_tables=4)
+        for num in range(20):
+            for sub in range(3):
+                db_.insert('foo/{0}/{1}'.format(num, sub), {1: num})
+        db_.rm('foo/0/1')
+        self.assertEqual(len(db_.index.key_indexes), 4)
+        for num in range(20):
+            expected = ['foo/{0}/{1}'.format(num, sub) for sub in range(3)]
+            if not num:
+                expected.remove('foo/0/1')
+            keys = list(db_.iter_keys('foo/{0}/'.format(num)))
+            self.assertEqual(keys, expected)
+        db_.close()
+        shutil.rmtree(w_dir)
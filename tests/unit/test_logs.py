@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+Test tables which keep their data in segmented data logs
+'''
+# Import sorbic libs
+import sorbic.db
+
+# Import python libs
+import os
+import shutil
+import unittest
+import tempfile
+
+
+class TestLogs(unittest.TestCase):
+    '''
+    Cover the data log segments
+    '''
+    def _segs(self, root, prefix='sorbic_data_0_'):
+        return sorted(fn_ for fn_ in os.listdir(root) if fn_.startswith(prefix))
+
+    def _tables(self, root):
+        return sorted(fn_ for fn_ in os.listdir(root)
+                      if '_table_' in fn_ and not fn_.endswith('.occ'))
+
+    def test_rotate(self):
+        '''
+        Verify that data rolls over into new segments and stays readable
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(
+            root,
+            hash_limit=0xff,
+            data_logs=True,
+            segment_size=1024)
+        db_.insert('first', {0: 0})
+        table_fn = os.path.join(root, 'sorbic_table_0')
+        table_size = os.path.getsize(table_fn)
+        for num in range(100):
+            db_.insert(str(num), {1: num})
+        for num in range(100):
+            db_.insert(str(num), {2: num})
+        self.assertTrue(len(self._segs(root)) > 2)
+        self.assertEqual(table_size, os.path.getsize(table_fn))
+        for num in range(100):
+            self.assertEqual([{2: num}, {1: num}], db_.get(str(num), count=2))
+        db_.close()
+        db_ = sorbic.db.DB(root)
+        self.assertTrue(db_.data_logs)
+        db_.insert('new', {3: 3})
+        for num in range(100):
+            self.assertEqual({2: num}, db_.get(str(num)))
+        self.assertEqual({3: 3}, db_.get('new'))
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_compress(self):
+        '''
+        Verify that compression rewrites the data segments
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(
+            root,
+            hash_limit=0xff,
+            data_logs=True,
+            segment_size=1024)
+        for num in range(100):
+            db_.insert(str(num), {1: num})
+        for num in range(0, 100, 2):
+            db_.rm(str(num))
+        before = self._segs(root)
+        stats = db_.compress('', 0)
+        self.assertTrue(stats['bytes_after'] < stats['bytes_before'])
+        self.assertTrue(len(self._segs(root)) < len(before))
+        self.assertEqual(self._segs(root, 'trans_'), [])
+        for num in range(100):
+            if num % 2:
+                self.assertEqual({1: num}, db_.get(str(num)))
+            else:
+                self.assertIsNone(db_.get(str(num)))
+        db_.insert('0', {2: 0})
+        self.assertEqual({2: 0}, db_.get('0'))
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_resize(self):
+        '''
+        Verify that resizing moves the data segments with the tables
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(
+            root,
+            hash_limit=0xf,
+            data_logs=True,
+            segment_size=1024)
+        for num in range(100):
+            db_.insert(str(num), {1: num})
+        db_.resize('', 0xfffff)
+        self.assertEqual(self._tables(root), ['sorbic_table_0'])
+        self.assertEqual(self._segs(root, 'trans_'), [])
+        self.assertEqual(self._segs(root, 'sorbic_data_1_'), [])
+        for num in range(100):
+            self.assertEqual({1: num}, db_.get(str(num)))
+        db_.close()
+        shutil.rmtree(w_dir)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+'''
+Test sorbic.utils.lru and the bounded open table cache
+'''
+# Import sorbic libs
+import sorbic.db
+import sorbic.utils.lru
+
+# Import python libs
+import os
+import shutil
+import unittest
+import tempfile
+
+
+class TestLRU(unittest.TestCase):
+    '''
+    Cover the lru mapping and the open table cache
+    '''
+    def test_evict_entries(self):
+        '''
+        Verify that the least recently used entry is evicted
+        '''
+        evicted = []
+        lru = sorbic.utils.lru.LRU(
+                max_entries=2,
+                on_evict=lambda key, value: evicted.append(key))
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+        self.assertEqual(evicted, ['b'])
+        self.assertNotIn('b', lru)
+        self.assertIsNone(lru.get('b'))
+        stats = lru.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['evictions'], 1)
+
+    def test_peek(self):
+        '''
+        Verify that peeked entries are kept over entries which were not used
+        '''
+        evicted = []
+        lru = sorbic.utils.lru.LRU(
+                max_entries=2,
+                on_evict=lambda key, value: evicted.append(key))
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.peek('a'), 1)
+        self.assertIsNone(lru.peek('c'))
+        lru.set('c', 3)
+        self.assertEqual(evicted, ['b'])
+        lru.set('d', 4)
+        self.assertEqual(evicted, ['b', 'c'])
+        lru.set('e', 5)
+        self.assertEqual(evicted, ['b', 'c', 'a'])
+        stats = lru.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 0))
+
+    def test_evict_size(self):
+        '''
+        Verify that entries are evicted when the size bound is passed
+        '''
+        lru = sorbic.utils.lru.LRU(max_size=10)
+        lru.set('a', 'a', 4)
+        lru.set('b', 'b', 4)
+        lru.set('c', 'c', 4)
+        self.assertEqual(len(lru), 2)
+        self.assertEqual(lru.size, 8)
+        self.assertNotIn('a', lru)
+        lru.pop('b')
+        self.assertEqual(lru.size, 4)
+
+    def test_max_open_tables(self):
+        '''
+        Verify that tables are transparently reopened after eviction
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, hash_limit=0xff, max_open_tables=2)
+        keys = []
+        for num in range(20):
+            key = 'foo/{0}/bar/{1}'.format(num % 5, num)
+            keys.append(key)
+            db_.insert(key, {1: num})
+        self.assertTrue(len(db_.index.tables) <= 2)
+        for num, key in enumerate(keys):
+            self.assertEqual({1: num}, db_.get(key))
+        stats = db_.table_cache_stats()
+        self.assertTrue(stats['evictions'] > 0)
+        self.assertTrue(stats['hits'] > 0)
+        self.assertTrue(len(db_.index.headers) > len(db_.index.tables))
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_compress_one_open_table(self):
+        '''
+        Verify that compression works when only one table can be open
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, hash_limit=0xf, max_open_tables=1)
+        for num in range(50):
+            db_.insert(str(num), {1: num})
+        for num in range(0, 50, 2):
+            db_.rm(str(num))
+        db_.compress('', 0)
+        for num in range(50):
+            if num % 2:
+                self.assertEqual({1: num}, db_.get(str(num)))
+            else:
+                self.assertIsNone(db_.get(str(num)))
+        db_.close()
+        shutil.rmtree(w_dir)
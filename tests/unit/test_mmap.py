@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+'''
+Test the memory mapped hash table backend
+'''
+# Import sorbic libs
+import sorbic.db
+
+# Import python libs
+import os
+import shutil
+import unittest
+import tempfile
+
+
+class TestMmap(unittest.TestCase):
+    '''
+    Cover the mmap table functions
+    '''
+    def test_create(self):
+        '''
+        Verify that data can be inserted and retrived with mapped tables
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, mmap_tables=True)
+        data = {1: 2}
+        db_.insert('foo/bar', data)
+        fn_ = os.path.join(root, 'foo', 'sorbic_table_0')
+        self.assertIn('map', db_.index.tables[fn_])
+        self.assertEqual(data, db_.get('foo/bar'))
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_reopen(self):
+        '''
+        Verify that tables written through the map are readable without it
+        and the other way around
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, mmap_tables=True)
+        for num in range(100):
+            db_.insert(str(num), {1: num})
+        db_.close()
+        db_ = sorbic.db.DB(root)
+        for num in range(100):
+            self.assertEqual({1: num}, db_.get(str(num)))
+            db_.insert(str(num), {2: num})
+        db_.close()
+        db_ = sorbic.db.DB(root, mmap_tables=True)
+        for num in range(100):
+            self.assertEqual({2: num}, db_.get(str(num)))
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_rm_compress(self):
+        '''
+        Verify that removals and compression work on mapped tables
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, mmap_tables=True)
+        data = {1: 1}
+        for num in range(100):
+            db_.insert(str(num), data)
+        for num in range(0, 100, 2):
+            db_.rm(str(num))
+        self.assertEqual(len(db_.listdir('')), 50)
+        db_.compress('', 0)
+        for num in range(100):
+            if num % 2:
+                self.assertEqual(data, db_.get(str(num)))
+            else:
+                self.assertIsNone(db_.get(str(num)))
+        db_.close()
+        shutil.rmtree(w_dir)
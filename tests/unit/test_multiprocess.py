@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+'''
+Test sharing a database between processes
+'''
+# Import sorbic libs
+import sorbic.db
+
+# Import python libs
+import os
+import sys
+import shutil
+import unittest
+import tempfile
+import subprocess
+
+WRITER = '''
+import sorbic.db
+db = sorbic.db.DB({root!r}, multiprocess=True)
+for num in range(200):
+    db.insert('foo/{name}_{{0}}'.format(num), {{1: num}})
+    db.insert('foo/shared', {{1: num}})
+{extra}
+db.close()
+'''
+HOLDER = '''
+import time
+import sorbic.utils.dirlock
+locks = sorbic.utils.dirlock.DirLocks()
+locks.acquire([{fn_root!r}], True)
+print('locked')
+time.sleep(0.5)
+open({done!r}, 'w').close()
+locks.release()
+'''
+
+
+class TestMultiprocess(unittest.TestCase):
+    '''
+    Cover the directory locks and the stale table detection
+    '''
+    def _spawn(self, root, name, extra=''):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(sorbic.__file__))
+        code = WRITER.format(root=root, name=name, extra=extra)
+        return subprocess.Popen([sys.executable, '-c', code], env=env)
+
+    def test_shared_writers(self):
+        '''
+        Verify that processes can write to the same key directory at once
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, hash_limit=0xff, multiprocess=True)
+        db_.insert('foo/shared', {1: -1})
+        procs = [self._spawn(root, name) for name in ('a', 'b')]
+        for num in range(200):
+            db_.insert('foo/c_{0}'.format(num), {1: num})
+            self.assertEqual(db_.get('foo/c_{0}'.format(num)), {1: num})
+        self.assertEqual([proc.wait() for proc in procs], [0, 0])
+        for name in ('a', 'b', 'c'):
+            for num in range(200):
+                key = 'foo/{0}_{1}'.format(name, num)
+                self.assertEqual(db_.get(key), {1: num})
+        self.assertEqual(len(db_.get('foo/shared', count=1000)), 401)
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_rmdir_subdirs(self):
+        '''
+        Verify that rmdir waits for the locks other processes hold on the
+        directories below the removed directory
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, multiprocess=True)
+        db_.insert('foo/bar/baz', {1: 1})
+        db_.insert('foo/qux', {1: 2})
+        done = os.path.join(w_dir, 'done')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(sorbic.__file__))
+        code = HOLDER.format(
+            fn_root=os.path.join(root, 'foo', 'bar'),
+            done=done)
+        proc = subprocess.Popen(
+            [sys.executable, '-c', code],
+            env=env,
+            stdout=subprocess.PIPE)
+        self.assertEqual(proc.stdout.readline().strip(), b'locked')
+        db_.rmdir('foo')
+        self.assertTrue(os.path.isfile(done))
+        self.assertEqual(proc.wait(), 0)
+        self.assertIsNone(db_.get('foo/bar/baz'))
+        self.assertIsNone(db_.get('foo/qux'))
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_stale_tables(self):
+        '''
+        Verify that tables rebuilt by another process are reopened
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(
+            root,
+            hash_limit=0xf,
+            multiprocess=True,
+            cache_entries=10)
+        db_.insert('foo/shared', {1: -1})
+        self.assertEqual(db_.get('foo/shared'), {1: -1})
+        proc = self._spawn(root, 'a', "db.resize('foo', 0xfff)")
+        self.assertEqual(proc.wait(), 0)
+        self.assertEqual(db_.get('foo/shared'), {1: 199})
+        self.assertEqual(db_.get('foo/a_150'), {1: 150})
+        table = db_.index.get_hash_table(
+            os.path.join(root, 'foo', 'sorbic_table_0'))
+        self.assertEqual(table['hash_limit'], 0xfff)
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_meta_kept(self):
+        '''
+        Verify that opening a database does not rewrite the metadata
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        sorbic.db.DB(root, multiprocess=True).close()
+        meta_fn = os.path.join(root, 'sorbic_db_meta.mp')
+        meta = os.stat(meta_fn)
+        sorbic.db.DB(root, multiprocess=True).close()
+        self.assertEqual(meta.st_ino, os.stat(meta_fn).st_ino)
+        self.assertRaises(
+            ValueError,
+            sorbic.db.DB,
+            root,
+            wal=True,
+            multiprocess=True)
+        shutil.rmtree(w_dir)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+'''
+Test the occupancy bitmaps of the tables
+'''
+# Import sorbic libs
+import sorbic.db
+import sorbic.ind.hdht
+
+# Import python libs
+import os
+import shutil
+import unittest
+import tempfile
+
+
+class TestOcc(unittest.TestCase):
+    '''
+    Cover keeping, rebuilding and scanning the occupancy bitmaps
+    '''
+    def setUp(self):
+        self.w_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.w_dir, 'db_root')
+        self.table_fn = os.path.join(self.root, 'sorbic_table_0')
+
+    def tearDown(self):
+        shutil.rmtree(self.w_dir)
+
+    def _marked(self, db_):
+        '''
+        Return the positions of the buckets marked in the bitmap
+        '''
+        table = db_.index.get_hash_table(self.table_fn)
+        buckets = db_.index._iter_occupied_occ(table)
+        return sorted(bucket['pos'] for bucket in buckets)
+
+    def _scanned(self, db_):
+        table = db_.index.get_hash_table(self.table_fn)
+        buckets = db_.index._scan_occupied(table)
+        return sorted(bucket['pos'] for bucket in buckets)
+
+    def test_matches_scan(self):
+        '''
+        Verify that the bitmap follows inserts and removals
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xfff)
+        for num in range(200):
+            db_.insert(str(num), {1: num})
+        self.assertTrue(os.path.isfile(self.table_fn + '.occ'))
+        for num in range(0, 200, 4):
+            db_.rm(str(num))
+        self.assertEqual(self._marked(db_), self._scanned(db_))
+        table = db_.index.get_hash_table(self.table_fn)
+        self.assertEqual(db_.index._occ_count(table), len(self._scanned(db_)))
+        self.assertEqual(len(db_.listdir('')), 150)
+        db_.close()
+
+    def test_sparse_scan(self):
+        '''
+        Verify that sparse tables are listed and compressed through the
+        bitmap
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xffff)
+        for num in range(100):
+            db_.insert(str(num), {1: num})
+        for num in range(0, 100, 2):
+            db_.rm(str(num))
+
+        def fail(table):
+            raise AssertionError('The sparse table was scanned')
+        db_.index._scan_occupied = fail
+        self.assertEqual(len(db_.listdir('')), 50)
+        stats = db_.compress('', 0)
+        self.assertEqual(stats['keys'], 50)
+        del db_.index._scan_occupied
+        for num in range(1, 100, 2):
+            self.assertEqual({1: num}, db_.get(str(num)))
+        self.assertEqual(self._marked(db_), self._scanned(db_))
+        db_.close()
+
+    def test_rebuild(self):
+        '''
+        Verify that a dirty, missing or wrong sized bitmap is rebuilt
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xfff)
+        for num in range(50):
+            db_.insert(str(num), {1: num})
+        with open(self.table_fn + '.occ', 'rb') as fp_:
+            self.assertEqual(fp_.read(1), 'd')
+        positions = self._scanned(db_)
+        db_.close()
+        with open(self.table_fn + '.occ', 'rb') as fp_:
+            self.assertEqual(fp_.read(1), 'c')
+        with open(self.table_fn + '.occ', 'r+b') as fp_:
+            fp_.seek(sorbic.ind.hdht.SIDE_HEAD)
+            fp_.write('\0' * 64)
+            fp_.seek(0)
+            fp_.write('d')
+        db_ = sorbic.db.DB(self.root)
+        self.assertEqual(self._marked(db_), positions)
+        db_.close()
+        os.remove(self.table_fn + '.occ')
+        db_ = sorbic.db.DB(self.root)
+        self.assertEqual(self._marked(db_), positions)
+        db_.close()
+        with open(self.table_fn + '.occ', 'ab') as fp_:
+            fp_.write('\0')
+        db_ = sorbic.db.DB(self.root)
+        self.assertEqual(self._marked(db_), positions)
+        db_.close()
+
+    def test_resize(self):
+        '''
+        Verify that the bitmap is replaced along with the table
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xff)
+        for num in range(100):
+            db_.insert(str(num), {1: num})
+        db_.resize('', 0xffff)
+        fns = sorted(fn_ for fn_ in os.listdir(self.root)
+                     if fn_.endswith('.occ'))
+        self.assertEqual(fns, ['sorbic_table_0.occ'])
+        table = db_.index.get_hash_table(self.table_fn)
+        self.assertEqual(
+            os.path.getsize(self.table_fn + '.occ'),
+            db_.index._side_size(table, 'occ'))
+        self.assertEqual(self._marked(db_), self._scanned(db_))
+        self.assertEqual(len(self._marked(db_)), 100)
+        db_.close()
+
+    def test_create_race(self):
+        '''
+        Verify that a process which lost the race to create a table opens
+        the table and bitmap of the winner instead of truncating them
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xfff)
+        for num in range(50):
+            db_.insert(str(num), {1: num})
+        positions = self._scanned(db_)
+        other = sorbic.db.DB(self.root, hash_limit=0xfff)
+        exists = os.path.exists
+        # The other process checked for the table before it was created
+        os.path.exists = lambda path: path != self.table_fn and exists(path)
+        try:
+            other.index.get_hash_table(self.table_fn)
+        finally:
+            os.path.exists = exists
+        self.assertEqual(self._marked(db_), positions)
+        self.assertEqual(self._marked(other), positions)
+        self.assertEqual(other.get('49'), {1: 49})
+        self.assertEqual(
+            [fn_ for fn_ in os.listdir(self.root) if fn_.endswith('.tmp')],
+            [])
+        other.close()
+        db_.close()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+'''
+Test the linear probing table layout
+'''
+# Import sorbic libs
+import sorbic.db
+
+# Import python libs
+import os
+import shutil
+import unittest
+import tempfile
+
+
+class TestProbe(unittest.TestCase):
+    '''
+    Cover linear probing tables
+    '''
+    def setUp(self):
+        self.w_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.w_dir, 'db_root')
+
+    def tearDown(self):
+        shutil.rmtree(self.w_dir)
+
+    def _tables(self):
+        return [fn_ for fn_ in os.listdir(self.root)
+                if fn_.startswith('sorbic_table_') and
+                not fn_.endswith('.occ')]
+
+    def test_single_table(self):
+        '''
+        Verify that collisions stay within the table
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xff, probe='linear')
+        for num in range(128):
+            db_.insert(str(num), {1: num})
+        for num in range(128):
+            self.assertEqual({1: num}, db_.get(str(num)))
+        self.assertEqual(self._tables(), ['sorbic_table_0'])
+        table = db_.index.tables[os.path.join(self.root, 'sorbic_table_0')]
+        self.assertEqual(table['layout'], 'linear')
+        self.assertEqual(len(db_.listdir('')), 128)
+
+    def test_spill(self):
+        '''
+        Verify that keys spill to the next table past the probe limit
+        '''
+        db_ = sorbic.db.DB(
+            self.root,
+            hash_limit=0xf,
+            probe='linear',
+            probe_limit=4)
+        for num in range(100):
+            db_.insert(str(num), {1: num})
+        self.assertTrue(len(self._tables()) > 1)
+        self.assertEqual(db_.get_many([str(num) for num in range(100)]),
+                         [{1: num} for num in range(100)])
+
+    def test_rm_compress(self):
+        '''
+        Verify that removed keys leave the probe sequence intact
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xff, probe='linear')
+        for num in range(200):
+            db_.insert(str(num), {1: num})
+        for num in range(0, 200, 2):
+            db_.rm(str(num))
+        for num in range(200):
+            if num % 2:
+                self.assertEqual({1: num}, db_.get(str(num)))
+            else:
+                self.assertIsNone(db_.get(str(num)))
+        db_.compress('', 0)
+        for num in range(200):
+            if num % 2:
+                self.assertEqual({1: num}, db_.get(str(num)))
+            else:
+                self.assertIsNone(db_.get(str(num)))
+        db_.insert('0', {1: 'back'})
+        self.assertEqual({1: 'back'}, db_.get('0'))
+
+    def test_meta(self):
+        '''
+        Verify that the layout of an existing database is kept
+        '''
+        db_ = sorbic.db.DB(self.root, probe='linear')
+        db_.insert('foo', {1: 1})
+        db_.close()
+        db_ = sorbic.db.DB(self.root)
+        self.assertEqual(db_.probe, 'linear')
+        self.assertEqual({1: 1}, db_.get('foo'))
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+Test table resizing
+'''
+# Import sorbic libs
+import sorbic.db
+
+# Import python libs
+import os
+import shutil
+import unittest
+import tempfile
+
+
+class TestResize(unittest.TestCase):
+    '''
+    Cover online table resizing
+    '''
+    def setUp(self):
+        self.w_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.w_dir, 'db_root')
+
+    def tearDown(self):
+        shutil.rmtree(self.w_dir)
+
+    def _table_0(self, db_, d_key=''):
+        return db_.index.get_hash_table(
+                os.path.join(db_.index.dir_root(d_key), 'sorbic_table_0'))
+
+    def test_auto_resize(self):
+        '''
+        Verify that a table is grown once the load factor is passed
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xf, resize_load=0.75)
+        for num in range(500):
+            db_.insert('foo/{0}'.format(num), {1: num})
+        db_.wait_resize()
+        table = self._table_0(db_, 'foo')
+        self.assertTrue(table['hash_limit'] > 0xf)
+        self.assertTrue(table['keys'] <= 0.75 * (table['hash_limit'] + 1))
+        for num in range(500):
+            self.assertEqual({1: num}, db_.get('foo/{0}'.format(num)))
+        self.assertEqual(len(db_.listdir('foo')), 500)
+
+    def test_auto_resize_many(self):
+        '''
+        Verify that batch inserts trigger a resize
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xf, resize_load=0.75)
+        db_.insert_many([(str(num), {1: num}) for num in range(100)])
+        db_.wait_resize()
+        self.assertTrue(self._table_0(db_)['hash_limit'] > 0xf)
+        self.assertEqual(db_.get_many([str(num) for num in range(100)]),
+                         [{1: num} for num in range(100)])
+
+    def test_background(self):
+        '''
+        Verify that the writes made while a directory is rebuilt in the
+        background are kept by the swapped in tables
+        '''
+        step = sorbic.db.RESIZE_STEP
+        # Hand the lock over after every bucket
+        sorbic.db.RESIZE_STEP = 1
+        try:
+            for wal in (False, True):
+                root = os.path.join(self.w_dir, str(wal))
+                db_ = sorbic.db.DB(
+                    root,
+                    hash_limit=0xff,
+                    resize_load=0.75,
+                    wal=wal)
+                num = 0
+                while db_._resizer is None:
+                    db_.insert('foo/{0}'.format(num), {1: num})
+                    num += 1
+                seen = False
+                for num in range(num, num + 300):
+                    db_.insert('foo/{0}'.format(num), {1: num})
+                    db_.insert('foo/0', {1: num})
+                    seen = seen or db_._resizing is not None
+                db_.rm('foo/1')
+                db_.wait_resize()
+                self.assertTrue(seen)
+                self.assertTrue(self._table_0(db_, 'foo')['hash_limit'] > 0xff)
+                self.assertIsNone(db_.get('foo/1'))
+                self.assertEqual(len(db_.get('foo/0', count=400)), 301)
+                for key in range(2, num + 1):
+                    self.assertEqual({1: key}, db_.get('foo/{0}'.format(key)))
+                self.assertEqual(len(db_.listdir('foo')), num)
+                db_.close()
+                db_ = sorbic.db.DB(root)
+                self.assertEqual({1: num}, db_.get('foo/{0}'.format(num)))
+                db_.close()
+        finally:
+            sorbic.db.RESIZE_STEP = step
+
+    def test_resize_revs(self):
+        '''
+        Verify that the revisions of keys are kept by a resize
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xf, probe='linear')
+        ids = []
+        for num in range(10):
+            ids.append(db_.insert('foo/bar', {1: num})['id'])
+        for num in range(50):
+            db_.insert('foo/{0}'.format(num), {1: num})
+        db_.rm('foo/3')
+        db_.rm('foo/bar', ids[4])
+        self.assertTrue(db_.resize('foo', 0xfff))
+        table = self._table_0(db_, 'foo')
+        self.assertEqual(table['hash_limit'], 0xfff)
+        self.assertEqual(table['layout'], 'linear')
+        self.assertEqual(
+            db_.index.table_fns(db_.index.dir_root('foo')),
+            [os.path.join(self.root, 'foo', 'sorbic_table_0')])
+        self.assertEqual(
+                db_.get('foo/bar', count=10),
+                [{1: num} for num in range(9, -1, -1) if num != 4])
+        self.assertEqual({1: 7}, db_.get('foo/bar', ids[7]))
+        self.assertIsNone(db_.get('foo/3'))
+        for num in range(50):
+            if num != 3:
+                self.assertEqual({1: num}, db_.get('foo/{0}'.format(num)))
+
+    def test_key_count(self):
+        '''
+        Verify that the key count is kept in the table header
+        '''
+        db_ = sorbic.db.DB(self.root)
+        for num in range(100):
+            db_.insert(str(num), {1: num})
+            db_.insert(str(num), {1: num})
+        db_.rm('0')
+        db_.close()
+        db_ = sorbic.db.DB(self.root)
+        self.assertEqual(self._table_0(db_)['keys'], 99)
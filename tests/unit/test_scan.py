@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''
+Test the bulk bucket scans
+'''
+# Import sorbic libs
+import sorbic.db
+import sorbic.ind.hdht
+
+# Import python libs
+import os
+import shutil
+import unittest
+import tempfile
+
+
+class TestScan(unittest.TestCase):
+    '''
+    Cover the vectorized and plain occupied bucket scans
+    '''
+    def setUp(self):
+        self.has_numpy = sorbic.ind.hdht.HAS_NUMPY
+        self.w_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.w_dir, 'db_root')
+
+    def tearDown(self):
+        sorbic.ind.hdht.HAS_NUMPY = self.has_numpy
+        shutil.rmtree(self.w_dir)
+
+    def _scan(self, db_):
+        table = db_.index.get_hash_table(
+            os.path.join(self.root, 'sorbic_table_0'))
+        db_.index._dtypes.clear()
+        return list(db_.index._scan_occupied(table))
+
+    @unittest.skipUnless(sorbic.ind.hdht.HAS_NUMPY, 'numpy is not installed')
+    def test_vector_matches(self):
+        '''
+        Verify that the numpy scan finds the same buckets as the plain scan
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xffff)
+        for num in range(300):
+            db_.insert(str(num), {1: num})
+        for num in range(0, 300, 3):
+            db_.rm(str(num))
+        table = db_.index.get_hash_table(
+            os.path.join(self.root, 'sorbic_table_0'))
+        self.assertIsNotNone(db_.index._bucket_dtype(table))
+        vector = self._scan(db_)
+        sorbic.ind.hdht.HAS_NUMPY = False
+        plain = self._scan(db_)
+        self.assertEqual(vector, plain)
+        self.assertTrue(len(plain) >= 200)
+        db_.close()
+
+    def test_plain_scan(self):
+        '''
+        Verify listdir and compress without numpy
+        '''
+        sorbic.ind.hdht.HAS_NUMPY = False
+        db_ = sorbic.db.DB(self.root, hash_limit=0xffff)
+        for num in range(100):
+            db_.insert(str(num), {1: num})
+        for num in range(0, 100, 2):
+            db_.rm(str(num))
+        self.assertEqual(len(db_.listdir('')), 50)
+        stats = db_.compress('', 0)
+        self.assertEqual(stats['keys'], 50)
+        for num in range(1, 100, 2):
+            self.assertEqual({1: num}, db_.get(str(num)))
+        db_.close()
+
+    def test_dtype(self):
+        '''
+        Verify that bucket formats numpy can not read fall back
+        '''
+        db_ = sorbic.db.DB(self.root)
+        table = {'fmt': '@20sQH',
+                 'fmt_map': ['key', 'prev', 'rev'],
+                 'bucket_size': 30}
+        self.assertIsNone(db_.index._bucket_dtype(table))
+        table = dict(table, fmt='>20sQH')
+        if sorbic.ind.hdht.HAS_NUMPY:
+            self.assertEqual(db_.index._bucket_dtype(table).itemsize, 30)
+        db_.close()
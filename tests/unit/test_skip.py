@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+'''
+Test the skip links of the revision chains
+'''
+# Import sorbic libs
+import sorbic.db
+
+# Import python libs
+import os
+import shutil
+import unittest
+import tempfile
+
+
+class TestSkip(unittest.TestCase):
+    '''
+    Cover finding revisions and ids along the skip links
+    '''
+    def setUp(self):
+        self.w_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.w_dir, 'db_root')
+
+    def tearDown(self):
+        shutil.rmtree(self.w_dir)
+
+    def _reads(self, db_, func, *args, **kwargs):
+        '''
+        Call the function and return the result and the number of index
+        entries read
+        '''
+        reads = []
+        read_index_entry = db_.index._read_index_entry
+
+        def counted(table, prev):
+            reads.append(prev)
+            return read_index_entry(table, prev)
+        db_.index._read_index_entry = counted
+        try:
+            return func(*args, **kwargs), len(reads)
+        finally:
+            del db_.index._read_index_entry
+
+    def test_revs(self):
+        '''
+        Verify that revisions and ids are found in a logarithmic number of
+        reads
+        '''
+        db_ = sorbic.db.DB(self.root)
+        ids = []
+        for num in range(1000):
+            entry = db_.insert('conf', {1: num})
+            self.assertEqual(entry['rev'], num)
+            self.assertEqual(entry['r'], num + 1)
+            ids.append(entry['id'])
+        for num in (0, 1, 2, 3, 255, 256, 500, 511, 512, 998, 999):
+            ret, reads = self._reads(db_, db_.get, 'conf', rev=num)
+            self.assertEqual(ret, {1: num})
+            self.assertTrue(reads <= 30, reads)
+            ret, reads = self._reads(db_, db_.get, 'conf', ids[num])
+            self.assertEqual(ret, {1: num})
+            self.assertTrue(reads <= 60, reads)
+            meta = db_.get_meta('conf', ids[num])
+            self.assertEqual(meta['table']['rev'], num)
+        self.assertIsNone(db_.get('conf', rev=1000))
+        self.assertIsNone(db_.get('conf', rev=-1))
+        self.assertIsNone(db_.get('missing', rev=0))
+        self.assertEqual(
+            db_.get('conf', count=3),
+            [{1: 999}, {1: 998}, {1: 997}])
+        _, reads = self._reads(db_, db_.rm, 'conf', ids[100])
+        self.assertTrue(reads <= 60, reads)
+        self.assertEqual(db_.get_meta('conf', ids[100])['data']['_status'], 'r')
+        self.assertEqual(db_.get_meta('conf', ids[101])['data']['_status'], 'k')
+        db_.close()
+
+    def test_batches(self):
+        '''
+        Verify the skip links of keys written many times in one batch
+        '''
+        db_ = sorbic.db.DB(self.root)
+        ids = []
+        for num in range(20):
+            items = [('conf', {1: num * 10 + ind}) for ind in range(10)]
+            items.append(('other', {1: num}))
+            ids.extend(entry['id'] for entry in db_.insert_many(items)[:10])
+        for num in range(0, 200, 7):
+            self.assertEqual(db_.get('conf', rev=num), {1: num})
+            self.assertEqual(db_.get('conf', ids[num]), {1: num})
+        self.assertEqual(db_.get('other', rev=19), {1: 19})
+        db_.close()
+
+    def test_other_ids(self):
+        '''
+        Verify that ids which are not time ordered fall back to the chain
+        '''
+        db_ = sorbic.db.DB(self.root)
+        names = ['z', 'a', 'm', 'zzzzzzzzzzzzzzzzzzzz', '00000000000000000000']
+        for num, name in enumerate(names):
+            db_.insert('conf', {1: num}, id_=name)
+        for num, name in enumerate(names):
+            self.assertEqual(db_.get('conf', name), {1: num})
+            self.assertEqual(db_.get('conf', rev=num), {1: num})
+        db_.close()
+
+    def test_compress(self):
+        '''
+        Verify that compaction numbers the kept revisions again
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xff)
+        ids = [db_.insert('conf', {1: num})['id'] for num in range(100)]
+        for num in range(0, 100, 3):
+            db_.rm('conf', ids[num])
+        db_.compress('', 0)
+        kept = [num for num in range(100) if num % 3]
+        for rev, num in enumerate(kept):
+            self.assertEqual(db_.get('conf', rev=rev), {1: num})
+            self.assertEqual(db_.get('conf', ids[num]), {1: num})
+            meta = db_.get_meta('conf', ids[num])
+            self.assertEqual(meta['table']['rev'], rev)
+        entry = db_.insert('conf', {1: 100})
+        self.assertEqual(entry['r'], len(kept) + 1)
+        self.assertEqual(db_.get('conf', rev=len(kept)), {1: 100})
+        db_.close()
+
+    def test_many_revs(self):
+        '''
+        Verify that a key holds more than 65536 revisions
+        '''
+        db_ = sorbic.db.DB(self.root, hash_limit=0xff)
+        db_.insert_many([('conf', {1: num}) for num in range(65540)])
+        self.assertEqual(db_.get_meta('conf')['table']['rev'], 65539)
+        self.assertEqual(db_.get('conf', rev=65537), {1: 65537})
+        db_.insert('conf', {1: 65540})
+        self.assertEqual(db_.get('conf'), {1: 65540})
+        db_.close()
+
+    def test_rev_limit(self):
+        '''
+        Verify that writes past the revision limit of the fmt are refused
+        before anything is written, and that databases keep their fmt
+        '''
+        db_ = sorbic.db.DB(self.root, fmt='>KsQB', wal=True)
+        self.assertEqual(db_.index.rev_limit, 255)
+        ids = [db_.insert('conf', {1: num})['id'] for num in range(256)]
+        self.assertRaises(ValueError, db_.insert, 'conf', {1: 256})
+        self.assertRaises(
+            ValueError,
+            db_.insert_many,
+            [('other', {1: 1}), ('conf', {1: 256})])
+        self.assertIsNone(db_.get('other'))
+        self.assertEqual(db_.get('conf'), {1: 255})
+        db_.rm('conf', ids[0])
+        db_.compress('', 0)
+        db_.insert('conf', {1: 256})
+        db_.close()
+        db_ = sorbic.db.DB(self.root)
+        self.assertEqual(db_.index.rev_limit, 255)
+        self.assertEqual(db_.get('conf'), {1: 256})
+        self.assertEqual(db_.get('conf', rev=0), {1: 1})
+        db_.close()
+        db_ = sorbic.db.DB(os.path.join(self.w_dir, 'new'))
+        self.assertEqual(db_.index.rev_limit, 0xffffffff)
+        db_.close()
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+'''
+Test concurrent readers and writers sharing a database
+'''
+# Import sorbic libs
+import sorbic.db
+import sorbic.utils.rwlock
+
+# Import python libs
+import os
+import shutil
+import unittest
+import tempfile
+import threading
+import time
+
+
+class TestThreads(unittest.TestCase):
+    '''
+    Cover the database lock and the positional reads
+    '''
+    def _run(self, targets):
+        errors = []
+
+        def run(target):
+            try:
+                target()
+            except Exception as exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=run, args=(target,))
+                   for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def _readers(self, **kwargs):
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, hash_limit=0xff, **kwargs)
+        for num in range(200):
+            db_.insert('foo/{0}/{1}'.format(num % 4, num), {1: num})
+
+        def read():
+            for _ in range(5):
+                for num in range(200):
+                    key = 'foo/{0}/{1}'.format(num % 4, num)
+                    self.assertEqual({1: num}, db_.get(key))
+
+        def write():
+            for num in range(200, 400):
+                db_.insert('foo/{0}/{1}'.format(num % 4, num), {1: num})
+            db_.compress('foo/1', 0)
+
+        self.assertEqual(self._run([read] * 6 + [write]), [])
+        for num in range(400):
+            key = 'foo/{0}/{1}'.format(num % 4, num)
+            self.assertEqual({1: num}, db_.get(key))
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_readers(self):
+        '''
+        Verify that many threads can read while another one writes
+        '''
+        self._readers()
+
+    def test_readers_mmap(self):
+        '''
+        Verify concurrent reads of mapped tables as they are evicted
+        '''
+        self._readers(mmap_tables=True, max_open_tables=2, cache_entries=50)
+
+    def _evicting_readers(self, **kwargs):
+        '''
+        Read from many threads while the tables are evicted by other
+        readers, returns the errors
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, max_open_tables=2, **kwargs)
+        for num in range(200):
+            db_.insert('foo/{0}/{1}'.format(num % 8, num), {1: num})
+
+        def read():
+            for _ in range(3):
+                for num in range(200):
+                    key = 'foo/{0}/{1}'.format(num % 8, num)
+                    self.assertEqual({1: num}, db_.get(key))
+                    self.assertIsNone(db_.get('{0}_missing'.format(key)))
+                for num in range(8):
+                    keys = db_.listdir('foo/{0}'.format(num))
+                    self.assertEqual(len(keys), 25)
+
+        errors = self._run([read] * 6)
+        db_.close()
+        shutil.rmtree(w_dir)
+        return errors
+
+    def test_evicted_bitmaps(self):
+        '''
+        Verify that readers keep scanning the occupancy bitmaps while other
+        readers evict the tables
+        '''
+        self.assertEqual(self._evicting_readers(hash_limit=0xfff), [])
+
+    def test_evicted_blooms(self):
+        '''
+        Verify that lookups through the Bloom filters keep working while
+        other readers evict the tables
+        '''
+        errors = self._evicting_readers(hash_limit=0xff, bloom=True)
+        self.assertEqual(errors, [])
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'needs /proc/self/fd')
+    def test_bounded_fds(self):
+        '''
+        Verify that the read handles are closed with the evicted tables and
+        do not pile up as threads come and go
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        before = len(os.listdir('/proc/self/fd'))
+        db_ = sorbic.db.DB(root, hash_limit=0xf, max_open_tables=4)
+        for num in range(200):
+            db_.insert('foo/{0}/bar'.format(num), {1: num})
+
+        def read():
+            for num in range(200):
+                key = 'foo/{0}/bar'.format(num)
+                self.assertEqual({1: num}, db_.get(key))
+
+        for _ in range(5):
+            self.assertEqual(self._run([read] * 4), [])
+        opened = len(os.listdir('/proc/self/fd')) - before
+        self.assertTrue(opened < 30, opened)
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_buffered_ranges(self):
+        '''
+        Verify that reads only flush the buffered table writes which they
+        overlap
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root)
+        fn_ = os.path.join(root, 'sorbic_table_0')
+        for num in range(50):
+            db_.insert(str(num), {1: num})
+            self.assertIn(fn_, db_.index.unflushed)
+            self.assertIsNone(db_.get('missing'))
+            self.assertIn(fn_, db_.index.unflushed)
+        self.assertEqual({1: 49}, db_.get('49'))
+        for num in range(50):
+            self.assertEqual({1: num}, db_.get(str(num)))
+        db_.insert('49', {1: 50})
+        self.assertEqual([{1: 50}, {1: 49}], db_.get('49', count=2))
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_rwlock(self):
+        '''
+        Verify that the writer excludes readers and that both sides can be
+        taken again by the holding thread
+        '''
+        lock = sorbic.utils.rwlock.RWLock()
+        state = {'writing': False, 'bad': 0}
+
+        def read():
+            for _ in range(200):
+                with lock.read():
+                    with lock.read():
+                        if state['writing']:
+                            state['bad'] += 1
+
+        def write():
+            for _ in range(200):
+                with lock.write():
+                    state['writing'] = True
+                    with lock.write():
+                        with lock.read():
+                            pass
+                    state['writing'] = False
+
+        self.assertEqual(self._run([read] * 4 + [write] * 2), [])
+        self.assertEqual(state['bad'], 0)
+
+    def test_yield_write(self):
+        '''
+        Verify that a writer which yields the lock lets the waiting readers
+        and writers in and holds the lock again afterwards
+        '''
+        lock = sorbic.utils.rwlock.RWLock()
+        order = []
+        lock.acquire_write()
+        lock.acquire_write()
+
+        def read():
+            with lock.read():
+                order.append('read')
+
+        def write():
+            with lock.write():
+                order.append('write')
+
+        threads = [
+            threading.Thread(target=read),
+            threading.Thread(target=write)]
+        for thread in threads:
+            thread.start()
+        while lock._waiting + lock._blocked < 2:
+            time.sleep(0.001)
+        for _ in range(3):
+            lock.yield_write()
+            order.append('yield')
+        lock.release_write()
+        self.assertEqual(len(order), 5)
+        self.assertEqual(order[-1], 'yield')
+        self.assertEqual(lock._writer, threading.current_thread().ident)
+        lock.release_write()
+        for thread in threads:
+            thread.join()
+        self.assertIsNone(lock._writer)
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+'''
+Test the write ahead log
+'''
+# Import sorbic libs
+import sorbic.db
+import sorbic.stor.wal
+import sorbic.stor.files
+
+# Import python libs
+import os
+import errno
+import shutil
+import logging
+import unittest
+import tempfile
+import time
+
+
+class TestWAL(unittest.TestCase):
+    '''
+    Cover logging, group commit and replay
+    '''
+    def _crash(self, db_):
+        '''
+        Drop the open database without a checkpoint, as a crash would
+        '''
+        for table in list(db_.index.tables):
+            db_.index.tables[table]['fp'].flush()
+        os.close(db_.wal.fd)
+
+    def test_group_commit(self):
+        '''
+        Verify that writes are fsynced in groups of sync_writes
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(
+            root,
+            wal=True,
+            wal_sync_ms=60000,
+            wal_sync_writes=10)
+        for num in range(25):
+            db_.insert(str(num), {1: num})
+        self.assertEqual(db_.wal.seq, 25)
+        self.assertEqual(db_.wal.synced, 20)
+        db_.insert('sync', {1: 1}, sync=True)
+        self.assertEqual(db_.wal.synced, 26)
+        self.assertEqual(db_.sync(), 26)
+        db_.close()
+        log_fn = os.path.join(root, 'sorbic_wal.log')
+        self.assertEqual(os.path.getsize(log_fn), 0)
+        shutil.rmtree(w_dir)
+
+    def test_held_buckets(self):
+        '''
+        Verify that bucket writes only reach the table file once the log
+        records of their old contents are fsynced, and are read before that
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(
+            root,
+            wal=True,
+            wal_sync_ms=60000,
+            wal_sync_writes=10)
+        c_key = db_.index.raw_crypt_key('foo')
+        db_.insert('foo', {1: 1})
+        entry = db_.index.get_table_entry('foo', c_key)
+        db_.index.flush()
+
+        def on_disk():
+            with open(entry['tfn'], 'rb') as fp_:
+                fp_.seek(entry['pos'])
+                return fp_.read(len(c_key)) == c_key
+
+        self.assertFalse(on_disk())
+        self.assertEqual(db_.get('foo'), {1: 1})
+        self.assertEqual(len(db_.listdir('')), 1)
+        db_.sync()
+        db_.index.flush()
+        self.assertTrue(on_disk())
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_sync_timer(self):
+        '''
+        Verify that the last writes are fsynced once sync_ms has passed
+        without waiting for another write
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, wal=True, wal_sync_ms=20, wal_sync_writes=1000)
+        db_.insert('foo', {1: 1})
+        db_.insert('bar', {1: 2})
+        self.assertEqual(db_.wal.synced, 0)
+        for _ in range(500):
+            if db_.wal.synced == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(db_.wal.synced, 2)
+        self.assertEqual(db_.index.held, {})
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_checkpoint(self):
+        '''
+        Verify that the log is emptied once it passes the wal_size
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, wal=True, wal_size=4096)
+        for num in range(100):
+            db_.insert(str(num), {1: num})
+            self.assertTrue(db_.wal.size() < 4096)
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_replay(self):
+        '''
+        Verify that logged writes are applied again after a crash, with the
+        same ids and with buckets left pointing past the written data
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, hash_limit=0xff, wal=True)
+        db_.insert('keep', {1: 1})
+        db_.close()
+        db_ = sorbic.db.DB(root, wal=True, wal_sync='always')
+        fn_ = os.path.join(root, 'sorbic_table_0')
+        size = os.path.getsize(fn_)
+        ids = {}
+        for num in range(50):
+            ids[num] = db_.insert(str(num), {1: num})['id']
+        db_.insert_many([('many', {2: 2}), ('keep', {3: 3})])
+        db_.rm('0')
+        self._crash(db_)
+        # Lose the data written since the checkpoint but keep the buckets
+        with open(fn_, 'r+b') as fp_:
+            fp_.truncate(size)
+        db_ = sorbic.db.DB(root, wal=True)
+        self.assertIsNone(db_.get('0'))
+        for num in range(1, 50):
+            ret = db_.get(str(num), meta=True)
+            self.assertEqual({1: num}, ret['data'])
+            self.assertEqual(ids[num], ret['meta']['data']['id'])
+        self.assertEqual({2: 2}, db_.get('many'))
+        self.assertEqual([{3: 3}, {1: 1}], db_.get('keep', count=2))
+        self.assertEqual(db_.wal.size(), 0)
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_replay_files(self):
+        '''
+        Verify that replaying a removal never releases a shared file twice
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, wal=True)
+        db_.insert('foo', 'shared', type_='file')
+        db_.insert('foo', 'shared', type_='file')
+        db_.insert('bar', 'shared', type_='file')
+        db_.close()
+        db_ = sorbic.db.DB(root, wal=True)
+        db_.rm('foo')
+        self._crash(db_)
+        db_ = sorbic.db.DB(root, wal=True)
+        self.assertIsNone(db_.get('foo'))
+        self.assertEqual('shared', db_.get('bar'))
+        db_.rm('bar')
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_replay_failed_write(self):
+        '''
+        Verify that the database opens again after a write which failed
+        was logged, and that a logged write which fails on replay is dropped
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, wal=True)
+        db_.insert('foo', {1: 1})
+        self.assertRaises(TypeError, db_.rm, 'missing')
+        self.assertRaises(
+            UnicodeDecodeError,
+            db_.insert,
+            'bar',
+            {1: '\xff\xfe'},
+            serial='json')
+        db_.insert('baz', {1: 2}, sync=True)
+        self._crash(db_)
+        db_ = sorbic.db.DB(root, wal=True)
+        self.assertEqual({1: 1}, db_.get('foo'))
+        self.assertIsNone(db_.get('bar'))
+        self.assertEqual({1: 2}, db_.get('baz'))
+        # A failed write whose abort record was lost
+        db_.wal.log('rm', key='missing', id=None)
+        db_.wal.sync()
+        self._crash(db_)
+        dropped = []
+        handler = logging.Handler()
+        handler.emit = dropped.append
+        sorbic.db.log.addHandler(handler)
+        try:
+            db_ = sorbic.db.DB(root, wal=True)
+        finally:
+            sorbic.db.log.removeHandler(handler)
+        self.assertEqual(len(dropped), 1)
+        self.assertIn('missing', dropped[0].getMessage())
+        self.assertEqual({1: 1}, db_.get('foo'))
+        self.assertEqual(db_.wal.size(), 0)
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_replay_io_error(self):
+        '''
+        Verify that an I/O error while a logged write is applied again keeps
+        the database from opening and leaves the log in place
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, wal=True)
+        db_.insert('foo', {1: 1}, sync=True)
+        self._crash(db_)
+        replay = sorbic.db.DB._replay_record
+
+        def failing(self, record):
+            raise IOError(errno.ENOSPC, 'No space left on device')
+        sorbic.db.DB._replay_record = failing
+        try:
+            self.assertRaises(IOError, sorbic.db.DB, root, wal=True)
+        finally:
+            sorbic.db.DB._replay_record = replay
+        db_ = sorbic.db.DB(root, wal=True)
+        self.assertEqual({1: 1}, db_.get('foo'))
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_replay_refs(self):
+        '''
+        Verify that replaying a file insert does not count the reference to
+        its blob twice
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, wal=True)
+        db_.insert('foo', 'shared', type_='file')
+        db_.close()
+        db_ = sorbic.db.DB(root, wal=True)
+        db_.insert('bar', 'shared', type_='file')
+        db_.insert('baz', 'other', type_='file', sync=True)
+        self._crash(db_)
+        db_ = sorbic.db.DB(root, wal=True)
+        shared = db_.get_meta('foo')['data']['path']
+        self.assertEqual(sorbic.stor.files._refs(shared), 2)
+        other = db_.get_meta('baz')['data']['path']
+        self.assertEqual(sorbic.stor.files._refs(other), 1)
+        self.assertEqual('shared', db_.get('bar'))
+        self.assertEqual('other', db_.get('baz'))
+        db_.rm('foo')
+        db_.rm('bar')
+        self.assertFalse(os.path.exists(shared))
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_replay_without_wal(self):
+        '''
+        Verify that a left over log is replayed and removed when the
+        database is opened without the log
+        '''
+        w_dir = tempfile.mkdtemp()
+        root = os.path.join(w_dir, 'db_root')
+        db_ = sorbic.db.DB(root, wal=True)
+        db_.insert('foo', {1: 1}, sync=True)
+        self._crash(db_)
+        db_ = sorbic.db.DB(root)
+        self.assertEqual({1: 1}, db_.get('foo'))
+        self.assertFalse(os.path.isfile(os.path.join(root, 'sorbic_wal.log')))
+        db_.close()
+        shutil.rmtree(w_dir)
+
+    def test_torn_record(self):
+        '''
+        Verify that a torn record at the end of the log is ignored
+        '''
+        w_dir = tempfile.mkdtemp()
+        log = sorbic.stor.wal.WAL(os.path.join(w_dir, 'wal'))
+        log.open()
+        log.log('rm', key='foo', id=None)
+        log.log('rm', key='bar', id=None)
+        log.close()
+        with open(log.path, 'r+b') as fp_:
+            fp_.truncate(os.path.getsize(log.path) - 2)
+        self.assertEqual(['foo'], [rec['key'] for rec in log.records()])
+        shutil.rmtree(w_dir)